@@ -1,10 +1,13 @@
 """Useful entities."""
+import hashlib
+import os
 import subprocess
 from collections import OrderedDict
+from pathlib import Path
 
 import click
-import yaml
 
+from pfb_fhir import model as model_module
 from pfb_fhir.model import Model
 import logging
 import cProfile, pstats
@@ -12,6 +15,15 @@ import cProfile, pstats
 DEFAULT_OUTPUT_PATH = './DATA'
 DEFAULT_CONFIG_PATH = './config.yaml'
 
+DEFAULT_ROW_GROUP_SIZE = 10000
+"""Rows per parquet row group."""
+PFB_CODECS = ['null', 'deflate', 'snappy', 'zstandard']
+"""Avro block compression."""
+DEFAULT_CODEC = 'null'
+"""Same as `pfb from` / `pfb add`."""
+DEFAULT_SYNC_INTERVAL = 16000
+"""Approximate size of avro blocks in bytes before compression, fastavro's default."""
+
 logger = logging.getLogger(__name__)
 
 PROFILER = None
@@ -36,9 +48,52 @@ class NaturalOrderGroup(click.Group):
 
 
 def initialize_model(config_path):
-    """Build the model."""
-    model_ = Model.parse_file(config_path)
-    model_.dependency_order = list(yaml.safe_load(open(config_path))['entities'])
+    """Build the model, entities in dependency order."""
+    return Model.parse_file(config_path)
+
+
+def _package_version() -> str:
+    """Installed version of pfb_fhir, part of the compiled model's key."""
+    from importlib_metadata import distribution, PackageNotFoundError
+
+    try:
+        return distribution('pfb_fhir').version
+    except PackageNotFoundError:
+        return 'unknown'
+
+
+def _model_cache_path(config_path) -> Path:
+    """Compiled model location, keyed by the config's content, the model's code and the package version."""
+    hash_ = hashlib.sha256()
+    for path in [config_path, model_module.__file__]:
+        with open(path, 'rb') as fp:
+            hash_.update(fp.read())
+    hash_.update(_package_version().encode())
+    cache_path = Path(os.environ.get("PFB_FHIR_CACHE_PATH", 'cache'), 'models')
+    return Path(cache_path, f"{hash_.hexdigest()}.json")
+
+
+def load_model(config_path):
+    """Build the model, or load it from the compiled model cache.
+
+    The compiled model is stored as json, validated on load; a file in the cache is data, never executed.
+    """
+    cache_path = _model_cache_path(config_path)
+    if cache_path.is_file():
+        try:
+            return Model.parse_raw(cache_path.read_text())
+        except (ValueError, OSError) as e:
+            logger.warning(f"Ignoring compiled model {cache_path} {e}")
+    model_ = initialize_model(config_path)
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # write then rename, concurrent readers never see a partial file
+        temp_path = Path(cache_path.parent, f"{cache_path.name}.{os.getpid()}")
+        with open(temp_path, 'w') as fp:
+            fp.write(model_.json())
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        logger.warning(f"Could not write compiled model {cache_path} {e}")
     return model_
 
 
@@ -0,0 +1,183 @@
+"""Aggregate many PFBs into a network of entities and edges, e.g. for cytoscape."""
+import json
+import logging
+import os
+import pathlib
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Iterable, Tuple
+
+from fastavro import reader
+from pydantic import BaseModel
+
+from pfb_fhir.inspector import read_summary
+from pfb_fhir.model import InspectionResults
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+"""Bump when FileSummary changes."""
+
+
+class FileSummary(BaseModel):
+    """Entities and edges found in a PFB."""
+
+    path: str
+    """PFB file."""
+    size: int
+    """Size of the PFB when summarized."""
+    mtime_ns: int
+    """Modification time of the PFB when summarized."""
+    entities: List[str] = []
+    """Entity names, excluding Metadata."""
+    edges: Dict[str, List[str]] = {}
+    """Source entity name to destination entity names."""
+
+    def is_current(self) -> bool:
+        """True if the PFB hasn't changed since it was summarized."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return stat.st_size == self.size and stat.st_mtime_ns == self.mtime_ns
+
+
+class AggregateMetrics(BaseModel):
+    """Where file summaries came from."""
+
+    sidecar: int = 0
+    """Read from the PFB's summary sidecar."""
+    cached: int = 0
+    """Read from the aggregate cache."""
+    scanned: int = 0
+    """Decoded the PFB."""
+
+    def __str__(self) -> str:
+        """Human friendly summary."""
+        return f"sidecar: {self.sidecar} cached: {self.cached} scanned: {self.scanned}"
+
+
+def _stat(path: str) -> Tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def from_results(path: str, results: InspectionResults) -> FileSummary:
+    """Summarize from inspection results."""
+    size, mtime_ns = _stat(path)
+    return FileSummary(
+        path=path, size=size, mtime_ns=mtime_ns,
+        entities=[name for name in results.counts if name != 'Metadata'],
+        edges={name: list(summary.relationships) for name, summary in results.counts.items() if summary.relationships}
+    )
+
+
+def scan_file(path: str) -> FileSummary:
+    """Decode the PFB, collect entity and edge names."""
+    # stat first, if the file changes while we read it the summary is stale
+    size, mtime_ns = _stat(path)
+    entities = {}
+    edges = defaultdict(dict)
+    with open(path, 'rb') as fo:
+        for record in reader(fo):
+            # skip metadata
+            if record['name'] == 'Metadata':
+                continue
+            entities[record['name']] = None
+            for relation in record['relations']:
+                edges[record['name']][relation['dst_name']] = None
+    return FileSummary(path=path, size=size, mtime_ns=mtime_ns, entities=list(entities),
+                       edges={name: list(dst_names) for name, dst_names in edges.items()})
+
+
+def load_cache(cache_path: str) -> Dict[str, FileSummary]:
+    """Path to summary, empty if missing or a different version."""
+    if not cache_path or not os.path.isfile(cache_path):
+        return {}
+    with open(cache_path) as fp:
+        cache = json.load(fp)
+    if cache.get('version') != CACHE_VERSION:
+        return {}
+    return {summary['path']: FileSummary.parse_obj(summary) for summary in cache['files']}
+
+
+def save_cache(cache_path: str, summaries: Iterable[FileSummary]) -> None:
+    """Write cache."""
+    pathlib.Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(cache_path, 'w') as fp:
+        json.dump({'version': CACHE_VERSION, 'files': [summary.dict() for summary in summaries]}, fp)
+
+
+def summarize_files(file_paths: List[str], cache: Dict[str, FileSummary],
+                    processes: int = 1) -> Tuple[List[FileSummary], AggregateMetrics]:
+    """Summary per file from its sidecar, the cache, or decode stale files in parallel.
+
+    :return: summaries in file_paths order, where they came from.
+    """
+    metrics = AggregateMetrics()
+    summaries = {}
+    to_scan = []
+    for path in file_paths:
+        results = read_summary(path)
+        if results is not None:
+            summaries[path] = from_results(path, results)
+            metrics.sidecar += 1
+        elif path in cache and cache[path].is_current():
+            summaries[path] = cache[path]
+            metrics.cached += 1
+        else:
+            to_scan.append(path)
+    if processes > 1 and len(to_scan) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            for summary in executor.map(scan_file, to_scan):
+                logger.info(f"Scanned {summary.path}")
+                summaries[summary.path] = summary
+    else:
+        for path in to_scan:
+            logger.info(f"Scanning {path}")
+            summaries[path] = scan_file(path)
+    metrics.scanned = len(to_scan)
+    return [summaries[path] for path in file_paths], metrics
+
+
+def network_table(summaries: List[FileSummary]) -> List[Tuple[str, str, int, int]]:
+    """Rows of (source, target, files with edge, files with source)."""
+    node_files = defaultdict(set)
+    edge_files = defaultdict(lambda: defaultdict(set))
+    for summary in summaries:
+        for name in summary.entities:
+            node_files[name].add(summary.path)
+        for source, targets in summary.edges.items():
+            for target in targets:
+                edge_files[source][target].add(summary.path)
+    return [
+        (source, target, len(edge_files[source][target]), len(node_files[source]))
+        for source in edge_files
+        for target in edge_files[source]
+    ]
+
+
+def write_network_table(table_path: str, rows: List[Tuple[str, str, int, int]]) -> None:
+    """Write cytoscape friendly tsv."""
+    pathlib.Path(table_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(table_path, "w") as fp:
+        print("source\ttarget\tsource_count\tedge_count", file=fp)
+        for row in rows:
+            print("\t".join(str(column) for column in row), file=fp)
+
+
+def aggregate(file_paths: List[str], table_path: str, cache_path: str = None, processes: int = 1) -> AggregateMetrics:
+    """Aggregate PFBs into a network table.
+
+    :param file_paths: PFB files.
+    :param table_path: tsv to write.
+    :param cache_path: per file summaries, keyed by path, size and modification time.
+    :param processes: decode stale PFBs in this many processes.
+    """
+    cache = load_cache(cache_path)
+    summaries, metrics = summarize_files(file_paths, cache, processes=processes)
+    if cache_path:
+        cache.update({summary.path: summary for summary in summaries})
+        save_cache(cache_path, cache.values())
+    write_network_table(table_path, network_table(summaries))
+    return metrics
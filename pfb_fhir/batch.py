@@ -0,0 +1,167 @@
+"""Transform many resources of the same type as one columnar batch."""
+import logging
+from typing import Any, Dict, Iterable, Iterator, List, Set
+
+import numpy as np
+from flatten_json import flatten
+
+from pfb_fhir.model import Entity, Model, Property, TransformerContext
+from pfb_fhir.resources import instantiate
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 10000
+"""Resources per batch."""
+
+NUMPY_TYPES = {
+    bool: np.bool_,
+    int: np.int64,
+    float: np.float64,
+}
+"""Columns whose values are all present and of one of these types are stored unboxed."""
+
+
+def _column(values: List[Any]) -> np.ndarray:
+    """Typed array if every value is present and of the same primitive type, otherwise an object array."""
+    types = set(value.__class__ for value in values)
+    if len(types) == 1:
+        dtype = NUMPY_TYPES.get(types.pop())
+        if dtype is not None:
+            try:
+                return np.array(values, dtype=dtype)
+            except OverflowError:
+                pass
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+def _item(value: Any) -> Any:
+    """Python value of an array element."""
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class ColumnarBatch(object):
+    """Flattened values of resources of one type, a column per flattened key.
+
+    Missing values are None, `properties` builds the row wise view of a resource on demand.
+    """
+
+    def __init__(self, entity: Entity, resources: List[dict], columns: Dict[str, np.ndarray],
+                 metadata: Dict[str, Property], description: str = None) -> None:
+        """Columns and their metadata.
+
+        :param entity: Model Entity associated with the resources.
+        :param resources: raw json dictionaries, in column order.
+        :param columns: flattened key to values, one per resource.
+        :param metadata: flattened key to FHIR definition, value omitted.
+        :param description: FHIR documentation for the resource.
+        """
+        self.entity = entity
+        self.resources = resources
+        self.columns = columns
+        self.metadata = metadata
+        self.description = description
+
+    def __len__(self) -> int:
+        """Number of resources."""
+        return len(self.resources)
+
+    @property
+    def resource_type(self) -> str:
+        """Type shared by all resources."""
+        return self.entity.id
+
+    def properties(self, index: int) -> Dict[str, Property]:
+        """Row wise view of a resource, same as TransformerContext.properties."""
+        properties = {}
+        for flattened_key, column in self.columns.items():
+            value = _item(column[index])
+            if value is None:
+                continue
+            properties[flattened_key] = self.metadata[flattened_key].copy(
+                update={'value': value, 'typ': value.__class__.__name__})
+        return properties
+
+    def rows(self) -> Iterator[Dict[str, Any]]:
+        """Flattened key to value of each resource, missing values omitted."""
+        columns = [(flattened_key, column.tolist()) for flattened_key, column in self.columns.items()]
+        for index in range(len(self)):
+            yield {flattened_key: values[index] for flattened_key, values in columns if values[index] is not None}
+
+
+class BatchTransformer(object):
+    """Flatten batches of one resource type, resolve FHIR metadata once per flattened key.
+
+    A key is resolved by the row wise transform of the first resource that has it, resources are only
+    marshalled into fhirclient models when they introduce new keys.
+    Keys the row wise transform would not produce (e.g. elements fhirclient ignores) are dropped.
+    """
+
+    def __init__(self, entity: Entity, strict: bool = False) -> None:
+        """No keys resolved.
+
+        :param entity: Model Entity of the resources.
+        :param strict: passed to fhirclient when a resource is marshalled.
+        """
+        self.entity = entity
+        self.strict = strict
+        self.metadata: Dict[str, Property] = {}
+        self.ignored: Set[str] = set()
+        self.description: str = None
+        self.resolved = 0
+        """Number of resources marshalled to resolve metadata."""
+
+    def _resolve(self, resource: dict) -> None:
+        """Row wise transform of the resource, keep the metadata of its properties."""
+
+        context = TransformerContext(resource=instantiate(resource, strict=self.strict), entity=self.entity)
+        self.description = context.resource.__doc__
+        for flattened_key, property_ in context.properties.items():
+            if flattened_key not in self.metadata:
+                self.metadata[flattened_key] = property_.copy(update={'value': None})
+        self.resolved += 1
+
+    def transform(self, resources: List[dict]) -> ColumnarBatch:
+        """Flatten resources into columns."""
+        flattened = []
+        for resource in resources:
+            assert resource['resourceType'] == self.entity.id, \
+                f"Expected {self.entity.id}, got {resource['resourceType']}"
+            flattened_ = flatten(resource, separator='.')
+            new_keys = [key for key in flattened_ if key not in self.metadata and key not in self.ignored]
+            if new_keys:
+                self._resolve(resource)
+                self.ignored.update(key for key in new_keys if key not in self.metadata)
+            flattened.append(flattened_)
+        # column order follows the row wise transform
+        keys = set(key for flattened_ in flattened for key in flattened_)
+        columns = {
+            key: _column([flattened_.get(key) for flattened_ in flattened])
+            for key in self.metadata if key in keys
+        }
+        return ColumnarBatch(entity=self.entity, resources=resources, columns=columns, metadata=self.metadata,
+                             description=self.description)
+
+
+def iter_batches(model: Model, resources: Iterable[dict], batch_size: int = DEFAULT_BATCH_SIZE,
+                 strict: bool = False) -> Iterator[ColumnarBatch]:
+    """Group consecutive resources of the same type into batches.
+
+    :param model: resource type to Entity.
+    :param resources: raw json dictionaries, e.g. from homogeneous ndjson.
+    :param batch_size: maximum resources per batch.
+    :param strict: passed to fhirclient when a resource is marshalled.
+    """
+    transformers: Dict[str, BatchTransformer] = {}
+    batch = []
+    for resource in resources:
+        if batch and (len(batch) >= batch_size or resource['resourceType'] != batch[0]['resourceType']):
+            yield transformers[batch[0]['resourceType']].transform(batch)
+            batch = []
+        resource_type = resource['resourceType']
+        if resource_type not in transformers:
+            transformers[resource_type] = BatchTransformer(model.entities[resource_type], strict=strict)
+        batch.append(resource)
+    if batch:
+        yield transformers[batch[0]['resourceType']].transform(batch)
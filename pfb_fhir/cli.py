@@ -1,28 +1,35 @@
 """Implements command line."""
 
 import glob
-import importlib
 import json
 import logging
+import mmap
 import os
+from functools import partial, lru_cache
 from pathlib import Path
-from typing import Iterator, Iterable
+from typing import Iterator, Iterable, List, Tuple, Optional
 
 import click
-import matplotlib.pyplot as plt
-import networkx as nx
 from click_loglevel import LogLevel
 from fhirclient.models.domainresource import DomainResource
-from importlib_metadata import distribution
 
-from pfb_fhir import NaturalOrderGroup, DEFAULT_OUTPUT_PATH, DEFAULT_CONFIG_PATH, initialize_model, run_cmd
-from pfb_fhir.emitter import inspect_pfb
-from pfb_fhir.emitter import pfb
-from pfb_fhir.model import TransformerContext
+# heavy dependencies (plotting, avro, gen3 dictionary) are imported by the commands that need them
+from pfb_fhir import NaturalOrderGroup, DEFAULT_OUTPUT_PATH, DEFAULT_CONFIG_PATH, load_model, run_cmd, \
+    DEFAULT_ROW_GROUP_SIZE, PFB_CODECS, DEFAULT_CODEC, DEFAULT_SYNC_INTERVAL
+from pfb_fhir.inspector import load_results
+from pfb_fhir.model import TransformerContext, Model
+from pfb_fhir.shard import SHARD_BY, DEFAULT_SHARD_SIZE, DEFAULT_SHARD_COUNT
+from pfb_fhir.pipeline import Pipeline, Stage
+from pfb_fhir.resources import instantiate, resource_class
+from pfb_fhir.reader import read_file, DEFAULT_READ_AHEAD, DEFAULT_BLOCK_SIZE
+from pfb_fhir.transform_pool import TransformPool, DEFAULT_PROCESSES, DEFAULT_TRANSFORM_BATCH_SIZE
 
 LOG_FORMAT = '%(asctime)s %(name)s %(levelname)-8s %(message)s'
 logger = logging.getLogger(__name__)
 
+IO_MODES = ['buffered', 'mmap']
+DEFAULT_IO = 'buffered'
+
 
 @click.group(cls=NaturalOrderGroup)
 @click.option("-l", "--log-level", type=LogLevel(), default=logging.INFO)
@@ -41,14 +48,23 @@ def cli(ctx, log_level, output_path, config_path):
     if not os.path.isdir(output_path):
         logger.debug(f"{output_path} does not exist")
     ctx.obj['output_path'] = output_path
-    if os.path.isfile(config_path):
-        model = initialize_model(config_path)
-        ctx.obj['model'] = model
+    # the model is loaded by the commands that need it
+    ctx.obj['config_path'] = config_path
+
+
+def _model(ctx) -> Optional[Model]:
+    """Load the model the first time a command needs it, None if there is no config file."""
+    if 'model' not in ctx.obj:
+        config_path = ctx.obj['config_path']
+        ctx.obj['model'] = load_model(config_path) if os.path.isfile(config_path) else None
+    return ctx.obj['model']
 
 
 @cli.command()
 def version():
     """Print the version."""
+    from importlib_metadata import distribution
+
     dist = distribution('pfb_fhir')
     print(dist.version)
 
@@ -58,25 +74,83 @@ def version():
 @click.option('--pfb_path', help='Location to write PFB.')
 @click.option('--simplify', is_flag=True, show_default=True, default=False, help="Remove FHIR scaffolding, make data frame friendly.")
 @click.option('--strict', is_flag=True, show_default=True, default=False, help="Stop on any FHIR validation error.")
+@click.option('--read_ahead', type=int, show_default=True, default=DEFAULT_READ_AHEAD,
+              help="Number of files read ahead on a background thread, 0 reads inline.")
+@click.option('--block_size', type=int, show_default=True, default=DEFAULT_BLOCK_SIZE,
+              help="Size of each sequential read when reading ahead.")
+@click.option('--io', 'io_', type=click.Choice(IO_MODES), show_default=True, default=DEFAULT_IO,
+              help="How to read input files, mmap is best for local disks.")
+@click.option('--parquet', is_flag=True, show_default=True, default=False,
+              help="Also write a parquet dataset per entity to <output_path>/parquet.")
+@click.option('--row_group_size', type=int, show_default=True, default=DEFAULT_ROW_GROUP_SIZE,
+              help="Rows per parquet row group.")
+@click.option('--write_schemas', is_flag=True, show_default=True, default=False,
+              help="Also write gen3 schemas and dump-ordered.json to <output_path>, for debugging.")
+@click.option('--codec', type=click.Choice(PFB_CODECS), show_default=True, default=DEFAULT_CODEC,
+              help="PFB avro block compression.")
+@click.option('--avro_block_size', type=int, show_default=True, default=DEFAULT_SYNC_INTERVAL,
+              help="Approximate size of PFB avro blocks in bytes, before compression.")
+@click.option('--shard_by', type=click.Choice(SHARD_BY), default=None,
+              help="Write dependency closed PFB shards and a manifest instead of one PFB.")
+@click.option('--shard_size', type=int, show_default=True, default=DEFAULT_SHARD_SIZE,
+              help="--shard_by size, approximate size of a shard in bytes of json records.")
+@click.option('--shard_count', type=int, show_default=True, default=DEFAULT_SHARD_COUNT,
+              help="--shard_by patient, number of patient shards.")
+@click.option('--validate_codes', is_flag=True, show_default=True, default=False,
+              help="Check coded values against required ValueSets, report violations.")
+@click.option('--processes', type=int, show_default=True, default=DEFAULT_PROCESSES,
+              help="Transform resources in this many worker processes, 1 transforms inline.")
+@click.option('--batch_size', type=int, show_default=True, default=DEFAULT_TRANSFORM_BATCH_SIZE,
+              help="Resources per task sent to a worker process.")
+@click.option('--transform_cache', is_flag=True, show_default=True, default=False,
+              help="Re-use the records of resources unchanged since a previous run, report hits and misses.")
+@click.option('--transform_cache_path', default=None,
+              help="Transform cache file. [default: <PFB_FHIR_CACHE_PATH>/transform.sqlite]")
 @click.pass_context
-def transform(ctx, input_path, pfb_path, simplify, strict):
+def transform(ctx, input_path, pfb_path, simplify, strict, read_ahead, block_size, io_, parquet, row_group_size,
+              write_schemas, codec, avro_block_size, shard_by, shard_size, shard_count, validate_codes, processes,
+              batch_size, transform_cache, transform_cache_path):
     """Transform FHIR resources from directory."""
-    model = ctx.obj['model']
+    from contextlib import nullcontext
+    from pfb_fhir.emitter import pfb
+    from pfb_fhir.transform_cache import TransformCache, transform_cache_path as default_transform_cache_path, \
+        transform_namespace
+
+    model = _model(ctx)
     if not model:
         logger.error("Please provide a config file.")
         return
 
-    with pfb(ctx.obj['output_path'], pfb_path, model) as pfb_:
-        for context in process_files(model, input_path, simplify=simplify, strict=strict):
-            pfb_.emit(context)
+    cache = nullcontext()
+    if transform_cache:
+        cache = TransformCache(transform_cache_path or default_transform_cache_path(),
+                               transform_namespace(model, simplify, strict), simplify=simplify)
+    with cache, pfb(ctx.obj['output_path'], pfb_path, model, parquet=parquet, row_group_size=row_group_size,
+                    write_schemas=write_schemas, codec=codec, sync_interval=avro_block_size, shard_by=shard_by,
+                    shard_size=shard_size, shard_count=shard_count, validate_codes=validate_codes) as pfb_:
+        stages = transform_stages(model, simplify=simplify, strict=strict, read_ahead=read_ahead,
+                                  block_size=block_size, io=io_, processes=processes, batch_size=batch_size,
+                                  transform_cache=cache if transform_cache else None)
+        stages.append(Stage('emit', partial(_emit, pfb_)))
+        for _ in Pipeline(stages).run(_expand_paths(input_path)):
+            pass
+    if validate_codes:
+        for info in pfb_.results.info:
+            logger.info(info)
+        for warning in pfb_.results.warnings:
+            logger.warning(warning)
 
 
 @cli.command("inspect")
 @click.option('--pfb_path', help='Location to read PFB.')
+@click.option('--processes', type=int, show_default=True, default=lambda: os.cpu_count(),
+              help='Decode avro blocks in this many processes, if the summary sidecar is stale.')
+@click.option('--verify', is_flag=True, show_default=True, default=False,
+              help='Compare the content hash of the summary sidecar, not just size and modification time.')
 @click.pass_context
-def inspect(ctx, pfb_path):
+def inspect(ctx, pfb_path, processes, verify):
     """Inspect a PFB."""
-    results = inspect_pfb(pfb_path)
+    results = load_results(pfb_path, processes=processes, verify=verify)
     if len(results.errors) == 0:
         print('No errors.')
     else:
@@ -99,10 +173,17 @@ def inspect(ctx, pfb_path):
 @cli.command("visualize")
 @click.option('--pfb_path', help='Location to read PFB.')
 @click.option('--layout', show_default=True, default='planar_layout', help='Position nodes algorithm. see https://networkx.org/documentation/stable/reference/drawing.html')
+@click.option('--processes', type=int, show_default=True, default=lambda: os.cpu_count(),
+              help='Decode avro blocks in this many processes, if the summary sidecar is stale.')
+@click.option('--verify', is_flag=True, show_default=True, default=False,
+              help='Compare the content hash of the summary sidecar, not just size and modification time.')
 @click.pass_context
-def visualize(ctx, pfb_path, layout):
+def visualize(ctx, pfb_path, layout, processes, verify):
     """Create a simple visualization."""
-    results = inspect_pfb(pfb_path)
+    import matplotlib.pyplot as plt
+    import networkx as nx
+
+    results = load_results(pfb_path, processes=processes, verify=verify)
     graph = nx.MultiDiGraph()
     node_dict = {}
     edge_dict = {}
@@ -145,19 +226,7 @@ def _sniff(file_path) -> Iterator[dict]:
         try:
             # see if this file, in its entirety is json
             fhir_resources = json.load(fhir_resource_file)
-            if isinstance(fhir_resources, dict) and 'entry' in fhir_resources:
-                # this looks like a bundle
-                for entry in fhir_resources['entry']:
-                    yield entry['resource']
-                return
-            if isinstance(fhir_resources, dict):
-                # it's a single dict
-                yield fhir_resources
-                return
-            for fhir_resource in fhir_resources:
-                # it's a list
-                yield fhir_resource
-                return
+            yield from _unwrap(fhir_resources)
         except json.decoder.JSONDecodeError:
             # re-try,  assume this is ndjson
             fhir_resource_file.seek(0)
@@ -165,24 +234,77 @@ def _sniff(file_path) -> Iterator[dict]:
                 yield json.loads(line)
 
 
-def read_resources(file_path: str, strict=True) -> Iterable[DomainResource]:
+def _sniff_mmap(file_path) -> Iterator[dict]:
+    """Sniff json or ndjson from a memory mapped file, yield json raw dictionary.
+
+    ndjson lines are sliced from the mapped buffer and decoded as bytes, no per line text decode.
+    """
+    with open(file_path, "rb") as fhir_resource_file:
+        if os.fstat(fhir_resource_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(fhir_resource_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            if hasattr(buffer, 'madvise'):
+                buffer.madvise(mmap.MADV_SEQUENTIAL)
+            if not _is_ndjson(buffer):
+                yield from _unwrap(json.loads(buffer[:]))
+                return
+            # mmap.readline slices the mapped buffer in C
+            for line in iter(buffer.readline, b''):
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _is_ndjson(buffer) -> bool:
+    """True if the first line is a complete json object followed by more content."""
+    end = buffer.find(b'\n')
+    if end == -1 or not buffer[end:].strip():
+        return False
+    try:
+        return isinstance(json.loads(buffer[:end]), dict)
+    except json.decoder.JSONDecodeError:
+        return False
+
+
+def _sniff_buffer(buffer: bytes) -> Iterator[dict]:
+    """Sniff json or ndjson already read into memory, yield json raw dictionary."""
+    try:
+        # see if this buffer, in its entirety is json
+        fhir_resources = json.loads(buffer)
+    except json.decoder.JSONDecodeError:
+        # re-try,  assume this is ndjson
+        for line in buffer.splitlines():
+            if line.strip():
+                yield json.loads(line)
+        return
+    yield from _unwrap(fhir_resources)
+
+
+def _unwrap(fhir_resources) -> Iterator[dict]:
+    """Yield resources from a bundle, a single resource or a list."""
+    if isinstance(fhir_resources, dict) and 'entry' in fhir_resources:
+        # this looks like a bundle
+        for entry in fhir_resources['entry']:
+            yield entry['resource']
+        return
+    if isinstance(fhir_resources, dict):
+        # it's a single dict
+        yield fhir_resources
+        return
+    for fhir_resource in fhir_resources:
+        # it's a list
+        yield fhir_resource
+        return
+
+
+def read_resources(file_path: str, strict=True, io=DEFAULT_IO) -> Iterable[DomainResource]:
     """Read a json payload from path, marshall into fhirclient.models FHIR resource."""
-    for resource_dict in _sniff(file_path):
-        # dynamically import model
-        assert 'resourceType' in resource_dict
-        resource_type = resource_dict['resourceType']
-        module_name = f"fhirclient.models.{resource_type.lower()}"
-        module = importlib.import_module(module_name)
-        assert module
-        clazz = getattr(module, resource_type)
-        assert clazz
-        # create instance
-        yield clazz(resource_dict, strict=strict)
-
-
-def process_files(model, input_paths, simplify=False, strict=True) -> Iterator[TransformerContext]:
-    """Set up context and stream files into the model."""
-    # handle either file or path pattern
+    sniff = _sniff_mmap if io == 'mmap' else _sniff
+    for resource_dict in sniff(file_path):
+        yield instantiate(resource_dict, strict=strict)
+
+
+def _expand_paths(input_paths) -> Iterator[str]:
+    """Handle either file or path pattern."""
     if not isinstance(input_paths, (list, tuple, )):
         input_paths = [input_paths]
     for input_path in input_paths:
@@ -191,14 +313,180 @@ def process_files(model, input_paths, simplify=False, strict=True) -> Iterator[T
         else:
             files = glob.glob(input_path)
         assert len(files) > 0, f"Did not find any json files in {input_path}"
-        # process the data
         for file in files:
-            logger.info(file)
-            for resource in read_resources(file, strict=strict):
-                assert isinstance(resource,
-                                  DomainResource), f"Error reading {file}. Should be DomainResource, was {resource.__class__}"
-                context = TransformerContext(resource=resource, simplify=simplify, entity=model.entities[resource.resource_type])
-                yield context
+            yield file
+
+
+def _read_files(file_paths: Iterable[str], block_size=DEFAULT_BLOCK_SIZE) -> Iterator[Tuple[str, bytes]]:
+    """Yield file_path, buffer; the entire file using large sequential reads."""
+    for file in file_paths:
+        yield file, read_file(file, block_size)
+
+
+@lru_cache(maxsize=None)
+def _is_domain_resource(resource_type: str) -> bool:
+    """True if the fhirclient.models class of the resource type is a DomainResource."""
+    return issubclass(resource_class(resource_type), DomainResource)
+
+
+def _check_resources(file, resource_dicts: Iterable[dict]) -> Iterator[dict]:
+    """Yield json raw dictionaries of DomainResources, fail with the file they were read from otherwise."""
+    for resource_dict in resource_dicts:
+        resource_type = resource_dict.get('resourceType')
+        assert resource_type and _is_domain_resource(resource_type), \
+            f"Error reading {file}. Should be DomainResource, was {resource_type}"
+        yield resource_dict
+
+
+def _parse_buffers(buffers: Iterable[Tuple[str, bytes]]) -> Iterator[dict]:
+    """Yield json raw dictionaries from files already read into memory."""
+    for file, buffer in buffers:
+        logger.info(file)
+        yield from _check_resources(file, _sniff_buffer(buffer))
+
+
+def _parse_files(file_paths: Iterable[str], io=DEFAULT_IO) -> Iterator[dict]:
+    """Yield json raw dictionaries, files are read as they are parsed."""
+    sniff = _sniff_mmap if io == 'mmap' else _sniff
+    for file in file_paths:
+        logger.info(file)
+        yield from _check_resources(file, sniff(file))
+
+
+def _transform_inline(model, resource_dicts: Iterable[dict], simplify=False,
+                      strict=True) -> Iterator[TransformerContext]:
+    """Marshall and transform resources on the calling process, the parse stage checked they are DomainResources."""
+    for resource_dict in resource_dicts:
+        resource = instantiate(resource_dict, strict=strict)
+        yield TransformerContext(resource=resource, simplify=simplify, entity=model.entities[resource.resource_type])
+
+
+def _transform(model, resource_dicts: Iterable[dict], simplify=False, strict=True, processes=DEFAULT_PROCESSES,
+               batch_size=DEFAULT_TRANSFORM_BATCH_SIZE, transform_cache=None) -> Iterator[TransformerContext]:
+    """Marshall and transform resources inline or in a pool, reading unchanged ones from the cache."""
+    pool = None
+    if processes > 1:
+        pool = TransformPool(model, processes=processes, batch_size=batch_size, simplify=simplify, strict=strict)
+        transform_ = pool.transform
+    else:
+        transform_ = partial(_transform_inline, model, simplify=simplify, strict=strict)
+    if transform_cache is not None:
+        yield from transform_cache.contexts(model, resource_dicts, transform_)
+    else:
+        yield from transform_(resource_dicts)
+    if pool:
+        logger.info(f"transform {pool.metrics}")
+
+
+def _emit(emitter, contexts: Iterable[TransformerContext]) -> Iterator[TransformerContext]:
+    """Render and write each context."""
+    for context in contexts:
+        emitter.emit(context)
+        yield context
+
+
+def transform_stages(model, simplify=False, strict=True, read_ahead=DEFAULT_READ_AHEAD, block_size=DEFAULT_BLOCK_SIZE,
+                     io=DEFAULT_IO, processes=DEFAULT_PROCESSES, batch_size=DEFAULT_TRANSFORM_BATCH_SIZE,
+                     transform_cache=None) -> List[Stage]:
+    """Stages from file paths to contexts: read, parse and transform (flatten and simplify).
+
+    Add stages, e.g. an emitter's, to the returned list; see process_files for parameters.
+    """
+    assert io in IO_MODES, f"io should be one of {IO_MODES}"
+    if io == 'mmap' and read_ahead > 0:
+        logger.warning("read_ahead is ignored when io is mmap")
+        read_ahead = 0
+    if read_ahead > 0:
+        stages = [
+            Stage('read', partial(_read_files, block_size=block_size), mode='thread', queue_size=read_ahead),
+            Stage('parse', _parse_buffers),
+        ]
+    else:
+        stages = [Stage('parse', partial(_parse_files, io=io))]
+    stages.append(Stage('transform', partial(_transform, model, simplify=simplify, strict=strict, processes=processes,
+                                             batch_size=batch_size, transform_cache=transform_cache)))
+    return stages
+
+
+def process_files(model, input_paths, simplify=False, strict=True, read_ahead=DEFAULT_READ_AHEAD,
+                  block_size=DEFAULT_BLOCK_SIZE, io=DEFAULT_IO, processes=DEFAULT_PROCESSES,
+                  batch_size=DEFAULT_TRANSFORM_BATCH_SIZE, transform_cache=None) -> Iterator[TransformerContext]:
+    """Set up context and stream files into the model.
+
+    :param read_ahead: if positive, read this many files ahead on a background thread.
+    :param block_size: size of each sequential read when reading ahead.
+    :param io: one of IO_MODES, 'mmap' maps local files and slices lines from the mapped buffer.
+    :param processes: if more than one, transform resources in this many worker processes.
+    :param batch_size: resources per task sent to a worker process.
+    :param transform_cache: if set, read unchanged resources' records from this TransformCache.
+    """
+    pipeline = Pipeline(transform_stages(model, simplify=simplify, strict=strict, read_ahead=read_ahead,
+                                         block_size=block_size, io=io, processes=processes, batch_size=batch_size,
+                                         transform_cache=transform_cache))
+    yield from pipeline.run(_expand_paths(input_paths))
+
+
+@cli.command("merge")
+@click.option('--input_path', multiple=True, required=True, help='PFBs to merge, may be a glob.')
+@click.option('--pfb_path', required=True, help='Location to write merged PFB.')
+@click.option('--codec', type=click.Choice(PFB_CODECS), show_default=True, default=DEFAULT_CODEC,
+              help="PFB avro block compression.")
+@click.option('--avro_block_size', type=int, show_default=True, default=DEFAULT_SYNC_INTERVAL,
+              help="Approximate size of PFB avro blocks in bytes, before compression.")
+@click.pass_context
+def merge(ctx, input_path, pfb_path, codec, avro_block_size):
+    """Merge PFBs, skip duplicate records, check links across all of them."""
+    from pfb_fhir.merge import merge_pfbs
+
+    file_paths = [path for path in _expand_paths(input_paths=input_path) if path != pfb_path]
+    results = merge_pfbs(file_paths, pfb_path, ctx.obj['output_path'], codec=codec, sync_interval=avro_block_size)
+    for info in results.info:
+        logger.info(info)
+    if len(results.errors) > 0:
+        logger.warning(f"{len(results.errors)} errors, see `pfb_fhir inspect --pfb_path {pfb_path}`")
+    logger.info(f"Wrote {pfb_path}")
+
+
+@cli.command("aggregate")
+@click.option('--path', default='.', help='Search this path for pattern [*.pfb]', show_default=True)
+@click.option('--pattern', default='**/*.pfb.avro', help='Search pattern', show_default=True)
+@click.option('--table_path', default=None, help='Where to write the tsv. [default: <output_path>/network_table.tsv]')
+@click.option('--cache_path', default=None,
+              help='Per file summaries, keyed by path, size and mtime. [default: <output_path>/aggregate-cache.json]')
+@click.option('--processes', type=int, show_default=True, default=lambda: os.cpu_count(),
+              help='Decode changed PFBs in this many processes.')
+@click.pass_context
+def aggregate_(ctx, path, pattern, table_path, cache_path, processes):
+    """Aggregate avro pfb files into a cytoscape friendly tsv."""
+    from pfb_fhir.aggregate import aggregate
+
+    table_path = table_path or os.path.join(ctx.obj['output_path'], 'network_table.tsv')
+    cache_path = cache_path or os.path.join(ctx.obj['output_path'], 'aggregate-cache.json')
+    file_paths = sorted(str(file_path) for file_path in Path(path).glob(pattern))
+    metrics = aggregate(file_paths, table_path, cache_path=cache_path, processes=processes)
+    logger.info(f"Aggregated {len(file_paths)} files, {metrics}")
+    logger.info(f"Wrote {table_path}")
+
+
+@cli.group()
+def terminology():
+    """Terminology snapshot shared by workers."""
+    pass
+
+
+@terminology.command("build")
+@click.option('--snapshot_path', default=None,
+              help='Where to write the snapshot. Read from PFB_FHIR_TERMINOLOGY_PATH '
+                   '[default: <PFB_FHIR_CACHE_PATH>/terminology-v<version>.sqlite]')
+def terminology_build(snapshot_path):
+    """Expand all ValueSets into a read-only snapshot, used by transform when present."""
+    from pfb_fhir.terminology.snapshot import build_snapshot, snapshot_path as default_snapshot_path
+    from pfb_fhir.terminology.value_sets import ValueSets
+
+    snapshot_path = snapshot_path or default_snapshot_path()
+    meta = build_snapshot(ValueSets(), snapshot_path)
+    for key, value in meta.items():
+        logger.info(f"{key}: {value}")
 
 
 @cli.command()
@@ -207,10 +495,14 @@ def process_files(model, input_paths, simplify=False, strict=True) -> Iterator[T
 @click.pass_context
 def config(ctx, format_):
     """Print the config."""
+    model = _model(ctx)
+    if not model:
+        logger.error("Please provide a config file.")
+        return
     if format_ == 'yaml':
-        print(ctx.obj['model'].yaml())
+        print(model.yaml())
     else:
-        print(ctx.obj['model'].json())
+        print(model.json())
 
 
 @cli.group()
@@ -1,15 +1,101 @@
 """Useful functions."""
-from typing import Any
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
 
-LOGGED_ALREADY = set({})
+MAX_EXEMPLARS = 3
+"""Distinct messages kept per warning, most recently seen."""
+MAX_WARNINGS = 1000
+"""Distinct (category, template) kept, least recently seen are dropped."""
 
 
-def first_occurrence(message: str) -> bool:
-    """Return True if we haven't logged message already."""
-    if message in LOGGED_ALREADY:
+def _is_power_of_ten(count: int) -> bool:
+    """1, 10, 100 ..."""
+    while count % 10 == 0:
+        count //= 10
+    return count == 1
+
+
+class WarningSummary(object):
+    """Occurrences of one (category, template)."""
+
+    def __init__(self, category: str, template: str) -> None:
+        """No occurrences."""
+        self.category = category
+        self.template = template
+        self.count = 0
+        self.exemplars: Dict[str, None] = OrderedDict()
+
+    def observe(self, message: str, max_exemplars: int) -> None:
+        """Count message, keep it as an exemplar."""
+        self.count += 1
+        if message in self.exemplars:
+            self.exemplars.move_to_end(message)
+            return
+        self.exemplars[message] = None
+        if len(self.exemplars) > max_exemplars:
+            self.exemplars.popitem(last=False)
+
+    def __str__(self) -> str:
+        """Human friendly summary."""
+        return f"{self.category}: {self.count} x {self.template} e.g. {list(self.exemplars)}"
+
+
+class WarningAggregator(object):
+    """Count warnings by (category, template), log the first occurrence and every power of ten, summarize at the end.
+
+    Memory is bounded by max_warnings * max_exemplars messages regardless of how many records are processed.
+    """
+
+    def __init__(self, max_warnings: int = MAX_WARNINGS, max_exemplars: int = MAX_EXEMPLARS) -> None:
+        """No warnings."""
+        self.max_warnings = max_warnings
+        self.max_exemplars = max_exemplars
+        self.warnings: Dict[Tuple[str, str], WarningSummary] = OrderedDict()
+        self.dropped = 0
+
+    def warn(self, logger_: logging.Logger, category: str, template: str, **values) -> bool:
+        """Count the warning, return True if it was logged.
+
+        :param logger_: logs the warning on behalf of the caller.
+        :param category: groups templates, e.g. 'link'.
+        :param template: str.format template, values that vary per record (ids) belong in values, not the template.
+        """
+        key = (category, template)
+        summary = self.warnings.get(key)
+        if summary is None:
+            summary = self.warnings[key] = WarningSummary(category, template)
+            if len(self.warnings) > self.max_warnings:
+                self.warnings.popitem(last=False)
+                self.dropped += 1
+        else:
+            self.warnings.move_to_end(key)
+        message = template.format(**values)
+        summary.observe(message, self.max_exemplars)
+        if _is_power_of_ten(summary.count):
+            logger_.warning(message if summary.count == 1 else f"{message} (seen {summary.count} times)")
+            return True
         return False
-    LOGGED_ALREADY.add(message)
-    return True
+
+    def summary(self) -> List[WarningSummary]:
+        """Warnings, most frequent first."""
+        return sorted(self.warnings.values(), key=lambda summary: summary.count, reverse=True)
+
+    def log_summary(self, logger_: logging.Logger) -> None:
+        """Log a line per warning."""
+        for summary in self.summary():
+            logger_.warning(str(summary))
+        if self.dropped:
+            logger_.warning(f"{self.dropped} other warnings not summarized.")
+
+    def clear(self) -> None:
+        """Forget all warnings, e.g. at the start of a run."""
+        self.warnings.clear()
+        self.dropped = 0
+
+
+WARNINGS = WarningAggregator()
+"""Warnings of the current run."""
 
 
 def is_primitive(obj: Any) -> bool:
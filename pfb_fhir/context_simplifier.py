@@ -23,7 +23,6 @@ class ContextSimplifier(object):
         :rtype: object
         """
         assert context.properties
-        logger.info(f"{context.resource['resourceType']}/{context.resource['id']}")
         simplified_properties = ContextSimplifier._group_by_root(context)
         simplified_properties = ContextSimplifier._extensions(simplified_properties)
         simplified_properties = ContextSimplifier._single_item_lists(simplified_properties)
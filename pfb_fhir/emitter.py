@@ -3,25 +3,35 @@ import abc
 import io
 import json
 import os.path
+import tempfile
 from collections import defaultdict
 from collections.abc import Iterator
 from copy import deepcopy
-from typing import List, Dict
+from typing import List, Dict, Tuple, Sequence, Mapping, Optional
 import pathlib
-from fastavro import reader
 
 import inflection as inflection
 import yaml
 from pydantic import BaseModel, PrivateAttr
 
-from pfb_fhir import run_cmd
-from pfb_fhir.model import TransformerContext, FHIR_TYPES, InspectionResults, EntitySummary, EdgeSummary, Model
+from pfb_fhir.model import TransformerContext, InspectionResults, Model, SchemaAccumulator, \
+    EntitySchema
 from contextlib import contextmanager
 import pkg_resources
-from dictionaryutils import dump_schemas_from_dir
+from dictionaryutils import DataDictionary, dictionary, DICTCOMMIT, DICTVERSION
+from pfb.base import avro_record, encode_enum
+from pfb.writer import PFBWriter, make_avro_schema
+import fastavro
 import logging
-from pfb_fhir.common import first_occurrence
-from pfb_fhir.terminology.value_sets import ValueSets
+from pfb_fhir import DEFAULT_ROW_GROUP_SIZE, PFB_CODECS, DEFAULT_CODEC, DEFAULT_SYNC_INTERVAL  # noqa: F401
+from pfb_fhir.batch import ColumnarBatch
+from pfb_fhir.common import WARNINGS, is_primitive
+from pfb_fhir.gen3dict import parse_dictionary, get_ontology_references
+from pfb_fhir.metadata import MetadataCompiler, PropertyMetadata, CodeValidator, normalize_type
+from pfb_fhir.inspector import inspect_pfb, InspectionAccumulator, write_summary  # noqa: F401
+from pfb_fhir.shard import spool_shards, shard_base, manifest_path, ShardManifest, DEFAULT_SHARD_SIZE, \
+    DEFAULT_SHARD_COUNT
+from pfb_fhir.terminology.snapshot import open_value_sets
 
 logger = logging.getLogger(__name__)
 
@@ -66,20 +76,34 @@ class DictionaryEmitter(Emitter):
     """Writes gen3 schema elements."""
 
     template: dict
+    write_files: bool = False
+    """Write a yaml file per entity, for debugging or the gen3 data dictionary workflow."""
     _value_sets: object = PrivateAttr()
+    _schemas: SchemaAccumulator = PrivateAttr()
+    _metadata: MetadataCompiler = PrivateAttr()
 
     class Config:
         """Allow arbitrary user types for fields (since we have reference to dict)."""
 
         arbitrary_types_allowed = True
 
-    def __init__(self, **data):
-        """Append /gen3 to output_path, init template."""
+    def __init__(self, schemas: SchemaAccumulator, **data):
+        """Append /gen3 to output_path, init template.
+
+        :param schemas: union of properties observed, shared with PFB.
+        """
         data["work_dir"] = data["work_dir"] + "/gen3"
         data["template"] = self._get_template()
         super().__init__(**data)
         assert self.template
-        self._value_sets = ValueSets()
+        self._value_sets = open_value_sets()
+        self._schemas = schemas
+        self._metadata = MetadataCompiler(self._value_sets)
+
+    @property
+    def metadata(self) -> MetadataCompiler:
+        """Compiled property and Value/Code set metadata."""
+        return self._metadata
 
     @staticmethod
     def _get_template():
@@ -89,36 +113,62 @@ class DictionaryEmitter(Emitter):
         return yaml.load(template_file, Loader=yaml.SafeLoader)
 
     def emit(self, context: TransformerContext) -> bool:
-        """Ensure file open, write row."""
-        path = f'{self.work_dir}/{context.entity.id}.yaml'
-        if path in self.open_files:
-            # already wrote schema
-            return True
-
-        self.open_files[path] = open(path, "w")
-        yaml.dump(self.render_schema(self.template, context), self.open_files[path])
-        self.open_files[path].flush()
-
-    def render_schema(self, template, context):
-        """Render context into a gen3 schema."""
+        """Nothing to do per record, schemas are rendered from accumulated properties on close."""
+        return True
+
+    def close(self) -> None:
+        """Optionally, write a schema file per entity."""
+        if self.write_files:
+            for path, schema in self.render_schemas().items():
+                with open(f'{self.work_dir}/{path}', "w") as fp:
+                    yaml.dump(schema, fp)
+        super().close()
+
+    def render_schemas(self) -> Dict[str, dict]:
+        """Render a schema per entity, keyed by file name, see `dump_schemas_from_dir`."""
+        return {
+            f'{entity_schema.id}.yaml': self.render_schema(self.template, entity_schema)
+            for entity_schema in self._schemas.entities.values()
+        }
+
+    def static_schemas(self) -> Dict[str, dict]:
+        """Gen3 boilerplate, from work_dir if present, otherwise from this package."""
+        schemas = {}
+        for static_entity in STATIC_ENTITIES:
+            path = f'{self.work_dir}/{static_entity}.yaml'
+            if os.path.isfile(path):
+                with open(path) as fp:
+                    schemas[f'{static_entity}.yaml'] = yaml.safe_load(fp)
+            else:
+                stream = pkg_resources.resource_stream(__name__, f'schema_dependencies/{static_entity}.yaml')
+                schemas[f'{static_entity}.yaml'] = yaml.load(stream, Loader=yaml.SafeLoader)
+        # match dump_schemas_from_dir
+        schemas['_settings.yaml'] = schemas['_settings.yaml'] or {}
+        schemas['_settings.yaml']['_dict_commit'] = DICTCOMMIT
+        schemas['_settings.yaml']['_dict_version'] = DICTVERSION
+        return schemas
+
+    def render_schema(self, template, entity_schema: EntitySchema):
+        """Render accumulated properties into a gen3 schema."""
         schema = deepcopy(template)
-        schema['id'] = context.entity.id
-        schema['title'] = context.entity.id
-        schema['category'] = context.entity.category
-        schema['description'] = context.resource.__doc__
-        schema['links'] = [link for link in self.render_links(context)]
-        schema['required'] = [required.replace('.', '_') for required in self.render_required(context)]
-        for property_name, schema_property in self.render_property(context):
+        schema['id'] = entity_schema.id
+        schema['title'] = entity_schema.id
+        schema['category'] = entity_schema.entity.category
+        schema['description'] = entity_schema.description
+        schema['links'] = [link for link in self.render_links(entity_schema.entity)]
+        schema['required'] = [required.replace('.', '_') for required in self.render_required(entity_schema)]
+        for property_name, schema_property in self.render_property(entity_schema,
+                                                                   self._metadata.table(entity_schema)):
             schema['properties'][property_name] = schema_property
         return schema
 
     @staticmethod
-    def render_links(context) -> Iterator[dict]:
+    def render_links(entity) -> Iterator[dict]:
         """Gen3 link collection."""
-        for link_key, link in context.entity.links.items():
+        for link_key, link in entity.links.items():
             _neighbor = link.targetProfile
             target_type = _neighbor.split('/')[-1]
-            backref = inflection.pluralize(context.entity.id)
+            backref = inflection.pluralize(entity.id)
             name = inflection.pluralize(target_type)
             yield {
                 'name': name,
@@ -130,101 +180,49 @@ class DictionaryEmitter(Emitter):
             }
 
     @staticmethod
-    def render_required(context) -> Iterator[str]:
+    def render_required(entity_schema: EntitySchema) -> Iterator[str]:
         """Return fields that are mandatory."""
         for property_name in ['submitter_id', 'type']:
             yield property_name
 
-        for property_ in context.properties.values():
-            if property_.not_optional:
-                yield property_.flattened_key
+        for flattened_key in entity_schema.columns():
+            if entity_schema.properties[flattened_key].metadata.not_optional:
+                yield flattened_key
 
     @staticmethod
-    def render_property(context) -> tuple[str, dict]:
-        """Render the property type and description."""
-        for property_ in context.properties.values():
-
-            required = property_.not_optional
-            type_codes = [DictionaryEmitter.normalize_type(property_.typ, property_)]
-            if not required:
+    def render_property(entity_schema: EntitySchema, table: Mapping[str, PropertyMetadata]) -> tuple[str, dict]:
+        """Render the property type and description.
+
+        :param table: compiled metadata of the entity's flattened keys, see MetadataCompiler.
+        """
+        for flattened_key in entity_schema.columns():
+            property_schema = entity_schema.properties[flattened_key]
+            metadata = table[flattened_key]
+
+            # prefer the widest type observed, the first occurrence may have been null
+            if property_schema.json_type:
+                type_codes = [normalize_type(property_schema.json_type)]
+            else:
+                type_codes = [metadata.json_type]
+            if not metadata.required:
                 type_codes.append('null')
 
-            schema_property = {
-                    'type': type_codes, 'description': '. '.join(DictionaryEmitter.description(property_))
-                }
+            schema_property = {'type': type_codes, 'description': metadata.description}
 
-            if property_.enum:
-                description = '. '.join(DictionaryEmitter.description(property_) + [property_.enum.url])
-                term_def = DictionaryEmitter.get_term_def(property_)
-                schema_property = {
-                    'type': type_codes,
-                    'description': description,
-                    'term': {'termDef': term_def, 'description': description}
-                }
+            term = metadata.term
+            if term:
+                schema_property['term'] = {'termDef': dict(term.term_def), 'description': metadata.description}
                 # add enum
-                enum_codes = property_.enum.restricted_to
-                if enum_codes and property_.enum.binding_strength in ['required', 'preferred']:
+                if term.codes and term.constrained:
                     del schema_property['type']
-                    schema_property['enum'] = enum_codes
-                elif enum_codes:
-                    schema_property['description'] = schema_property['description'] + ' ' + '|'.join(enum_codes)
+                    schema_property['enum'] = list(term.codes)
+                elif term.codes:
+                    schema_property['description'] = metadata.description + ' ' + term.code_list
                     schema_property['term']['description'] = schema_property['description']
                 else:
-                    logger.debug(f"No enumeration found for: {property_.flattened_key} {property_.enum.url}")
+                    logger.debug(f"No enumeration found for: {flattened_key} {term.url}")
 
-            yield property_.flattened_key.replace('.', '_'), schema_property
-
-    @staticmethod
-    def get_term_def(property_) -> str:
-        """Cast to json schema types."""
-        value_set_id = property_.enum.url
-        value_set_version = None
-        if '|' in property_.enum.url:
-            value_set_version = value_set_id.split('|')[-1]
-        term_def = {
-            'term': value_set_id,
-            'source': 'fhir',
-            'cde_id': value_set_id,
-            'cde_version': value_set_version,
-            'term_url': value_set_id,
-            'strength': property_.enum.binding_strength
-        }
-        return term_def
-
-    @staticmethod
-    def normalize_type(code, property_) -> str:
-        """Cast to json schema types."""
-        if code in FHIR_TYPES:
-            return FHIR_TYPES[code].json_type
-        if code in ['code', 'uri', 'url', 'canonical', 'xhtml', 'date', 'instant', 'id', 'markdown', 'base64Binary',
-                    'string', 'dateTime', 'String', 'Code', 'DateTime', 'str']:
-            return 'string'
-        if code in ['decimal', 'positiveInt', 'integer', 'Decimal', 'Integer', 'int', 'float']:
-            return "number"
-        if code in ['boolean', 'Boolean', 'bool']:
-            return 'boolean'
-        if first_occurrence(f"No mapping for {code} default to string"):
-            logger.warning(f"No mapping for {code} default to string")
-        return 'string'
-
-    @staticmethod
-    def description(property_) -> List[str]:
-        """Concatenates descriptions (utility)."""
-        # descriptions = []
-        # # add short description of ancestors
-        # for leaf_element in property_.leaf_elements[:-1]:
-        #     if leaf_element['short'] not in descriptions:
-        #         descriptions.append(leaf_element['short'])
-        # # add long description of leaf
-        # leaf_element = property_.leaf_elements[-1]
-        # if leaf_element['short'] not in descriptions:
-        #     descriptions.append(leaf_element.get('definition', leaf_element['short']))
-        #
-        # return descriptions
-        # TODO - should we concatenate hierarchy of doc strings?
-        if property_.docstring:
-            return [property_.docstring]
-        return ['']
+            yield flattened_key.replace('.', '_'), schema_property
 
 
 class IdentifierAlias(BaseModel):
@@ -238,16 +236,22 @@ class PFBJsonEmitter(Emitter):
     """Writes transform to PFB friendly JSON."""
 
     aliases: Dict[str, IdentifierAlias] = {}
+    _code_validator: Optional[CodeValidator] = PrivateAttr()
+    _alias_lookups: int = PrivateAttr(default=0)
 
     class Config:
         """Allow arbitrary user types for fields (since we have reference to dict)."""
 
         arbitrary_types_allowed = True
 
-    def __init__(self, **data):
-        """Append /pfb to output_path."""
+    def __init__(self, code_validator: CodeValidator = None, **data):
+        """Append /pfb to output_path.
+
+        :param code_validator: if set, check coded values against required bindings.
+        """
         data["work_dir"] = data["work_dir"] + "/pfb"
         super().__init__(**data)
+        self._code_validator = code_validator
 
     def _update_aliases(self, pfb_dict: dict) -> None:
         """Maintain a lookup table."""
@@ -259,7 +263,7 @@ class PFBJsonEmitter(Emitter):
                 if value not in pfb_dict['object']:
                     value = f"identifier_{i}_id"
                     if value not in pfb_dict['object']:
-                        logger.warning(f"identifier_{i}_system - no value or id found?")
+                        WARNINGS.warn(logger, 'identifier', "identifier_{i}_system - no value or id found?", i=i)
                         continue
                 self.aliases[f"{pfb_dict['object'][system]}/{pfb_dict['object'][value]}"] = \
                     IdentifierAlias(resource_type=pfb_dict['name'], submitter_id=pfb_dict['id'])
@@ -268,11 +272,27 @@ class PFBJsonEmitter(Emitter):
                 break
 
     def emit(self, context: TransformerContext) -> bool:
-        """Ensure file open, write row."""
+        """Ensure file open, write row; a record already rendered (e.g. by TransformCache) is written through.
+
+        A callable in `obj['on_render']` is called with the context once its record is rendered.
+        """
         path = f'{self.work_dir}/{context.resource.resource_type}.ndjson'
         if path not in self.open_files:
             self.open_files[path] = open(path, "w")
-        pfb_dict = self.render_json(context)
+        pfb_dict = context.obj.get('pfb_record')
+        if pfb_dict is None:
+            alias_lookups = self._alias_lookups
+            pfb_dict = self.render_json(context)
+            if self._alias_lookups != alias_lookups:
+                # links depend on other records, see TransformCache
+                context.obj['aliased'] = True
+            # share with downstream emitters
+            context.obj['pfb_record'] = pfb_dict
+            on_render = context.obj.pop('on_render', None)
+            if on_render:
+                on_render(context)
+        if self._code_validator:
+            self._code_validator.check(context.entity.id, context.properties)
         self._update_aliases(pfb_dict)
         json.dump(pfb_dict, self.open_files[path])
         self.open_files[path].write('\n')
@@ -283,16 +303,17 @@ class PFBJsonEmitter(Emitter):
         links = []
         for link_key, link in context.entity.links.items():
             if not hasattr(context.resource, link_key):
-                msg = f"{context.resource.resource_type}.{link_key} not found, attempting to add _fhir suffix."
-                if first_occurrence(msg):
-                    logger.warning(msg)
+                WARNINGS.warn(logger, 'link', "{resource_type}.{link_key} not found, attempting to add _fhir suffix.",
+                              resource_type=context.resource.resource_type, link_key=link_key)
                 link_key += '_fhir'
             if not hasattr(context.resource, link_key):
-                logger.warning(f"{context.resource.resource_type}.{link_key}' not found in {[p[0] for p in context.resource.elementProperties()]}")
+                WARNINGS.warn(logger, 'link', "{resource_type}.{link_key} not found in {properties}",
+                              resource_type=context.resource.resource_type, link_key=link_key,
+                              properties=[p[0] for p in context.resource.elementProperties()])
                 continue
             if not getattr(context.resource, link_key) and link.required:
-                if first_occurrence(f"Could not find {link_key} in {context.resource.resource_type}"):
-                    logger.warning(f"Could not find {link_key} in {context.resource.resource_type}.{context.resource.id}")
+                WARNINGS.warn(logger, 'link', "Could not find {link_key} in {resource_type}.{id}", link_key=link_key,
+                              resource_type=context.resource.resource_type, id=context.resource.id)
             if getattr(context.resource, link_key):
                 references = getattr(context.resource, link_key)
                 if not isinstance(references, list):
@@ -368,6 +389,7 @@ class PFBJsonEmitter(Emitter):
             if 'http' in fhir_reference.identifier.system:
                 key = f"{fhir_reference.identifier.system}/{fhir_reference.identifier.value}"
                 assert key in self.aliases, f"{key} not seen"
+                self._alias_lookups += 1
                 alias = self.aliases[key]
                 return {
                     'submitter_id': alias.submitter_id,
@@ -376,6 +398,217 @@ class PFBJsonEmitter(Emitter):
         raise Exception(f'Not supported pfb link {fhir_reference}')
 
 
+JSON_TYPES_TO_ARROW = {
+    'string': 'string',
+    'number': 'float64',
+    'decimal': 'float64',
+    'integer': 'int64',
+    'boolean': 'bool_',
+}
+"""Map gen3 (json schema) types to pyarrow type factories."""
+
+
+class ParquetEmitter(Emitter):
+    """Writes transform to a parquet dataset per entity.
+
+    Rows are spooled to arrow segments as they arrive, on close each dataset is written as one file,
+    every row group typed by the entity's final accumulated schema.
+    """
+
+    row_group_size: int = DEFAULT_ROW_GROUP_SIZE
+    """Rows per row group, and rows buffered per entity before a segment is spooled."""
+    _schemas: SchemaAccumulator = PrivateAttr()
+    _rows: Dict[str, List[dict]] = PrivateAttr()
+    _segments: Dict[str, List[pathlib.Path]] = PrivateAttr()
+    _columns: Dict[str, set] = PrivateAttr()
+
+    def __init__(self, schemas: SchemaAccumulator, **data):
+        """Append /parquet to output_path, ensure pyarrow available.
+
+        :param schemas: types and stable column order for each entity, shared with PFB.
+        """
+        data["work_dir"] = data["work_dir"] + "/parquet"
+        super().__init__(**data)
+        self._schemas = schemas
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError as exc:
+            raise ImportError("ParquetEmitter requires pyarrow, `pip install pfb_fhir[parquet]`") from exc
+        self._rows = defaultdict(list)
+        self._segments = defaultdict(list)
+        self._columns = defaultdict(set)
+
+    def emit(self, context: TransformerContext) -> bool:
+        """Buffer row, spool a segment when a row group is full."""
+        entity_id = context.entity.id
+        if 'pfb_record' in context.obj:
+            row = context.obj['pfb_record']['object']
+        else:
+            row = {p.flattened_key.replace('.', '_'): p.value for p in context.properties.values()}
+        rows = self._rows[entity_id]
+        rows.append(row)
+        if len(rows) >= self.row_group_size:
+            self._flush(entity_id)
+        return True
+
+    def emit_batch(self, batch: ColumnarBatch) -> bool:
+        """Spool the batch's columns as a segment, no row wise view needed."""
+        entity_id = batch.entity.id
+        # keep segments in arrival order
+        self._flush(entity_id)
+        columns = {flattened_key.replace('.', '_'): column for flattened_key, column in batch.columns.items()}
+        self._spool(entity_id, self.render_columns(self._schemas.entities[entity_id], columns))
+        return True
+
+    def _flush(self, entity_id: str) -> None:
+        """Spool buffered rows."""
+        rows = self._rows[entity_id]
+        if not rows:
+            return
+        self._spool(entity_id, self.render_table(self._schemas.entities[entity_id], rows))
+        self._rows[entity_id] = []
+
+    def _spool(self, entity_id: str, table) -> None:
+        """Write a transient arrow segment, typed by the schema accumulated so far."""
+        import pyarrow as pa
+
+        self._columns[entity_id].update(table.column_names)
+        path = pathlib.Path(self.work_dir, entity_id)
+        path.mkdir(parents=True, exist_ok=True)
+        segment_path = path / f".segment-{len(self._segments[entity_id]):05d}.arrow"
+        with pa.OSFile(str(segment_path), 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        self._segments[entity_id].append(segment_path)
+
+    def _write_dataset(self, entity_id: str):
+        """Write the entity's segments as one file, return its schema.
+
+        A column that doesn't convert to its accumulated type in every segment is written as string in all of them.
+        """
+        import pyarrow as pa
+
+        fields = self.render_fields(self._schemas.entities[entity_id], self._columns[entity_id])
+        strings = set()
+        while True:
+            schema = pa.schema([pa.field(field.name, pa.string()) if field.name in strings else field
+                                for field in fields])
+            try:
+                self._write_segments(entity_id, schema)
+                return schema
+            except _ConformError as e:
+                logger.debug(f"{entity_id}.{e.column} written as string")
+                strings.add(e.column)
+
+    def _write_segments(self, entity_id: str, schema) -> None:
+        """Conform segments to schema, write row groups of row_group_size rows."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        with pq.ParquetWriter(str(pathlib.Path(self.work_dir, entity_id, 'part-00000.parquet')), schema) as writer:
+            pending = None
+            for segment_path in self._segments[entity_id]:
+                with pa.memory_map(str(segment_path)) as source:
+                    table = self.conform(pa.ipc.open_file(source).read_all(), schema)
+                pending = table if pending is None else pa.concat_tables([pending, table])
+                while pending.num_rows >= self.row_group_size:
+                    writer.write_table(pending.slice(0, self.row_group_size))
+                    pending = pending.slice(self.row_group_size)
+            if pending is not None and pending.num_rows > 0:
+                writer.write_table(pending)
+
+    @staticmethod
+    def conform(table, schema):
+        """Add missing columns, cast the others to the schema; raise _ConformError if a column doesn't convert."""
+        import pyarrow as pa
+
+        arrays = []
+        for field in schema:
+            if field.name not in table.column_names:
+                arrays.append(pa.nulls(table.num_rows, field.type))
+                continue
+            column = table.column(field.name)
+            if column.type != field.type:
+                if field.type == pa.string():
+                    # same as render_columns' fallback
+                    column = pa.array([v if v is None else str(v) for v in column.to_pylist()], type=pa.string())
+                else:
+                    try:
+                        column = column.cast(field.type)
+                    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+                        raise _ConformError(field.name) from e
+            arrays.append(column)
+        return pa.Table.from_arrays(arrays, schema=schema)
+
+    @staticmethod
+    def render_fields(entity_schema: EntitySchema, columns: List[str] = None) -> list:
+        """Arrow fields in the entity's stable column order, typed by the widest type observed."""
+        import pyarrow as pa
+
+        json_types = {k.replace('.', '_'): p.json_type for k, p in entity_schema.properties.items()}
+        ordered = [k.replace('.', '_') for k in entity_schema.columns()]
+        if columns is not None:
+            # columns not rendered from properties e.g. submitter_id
+            ordered = [c for c in ordered if c in columns] + sorted(c for c in columns if c not in json_types)
+        return [pa.field(column, getattr(pa, JSON_TYPES_TO_ARROW.get(json_types.get(column), 'string'))())
+                for column in ordered]
+
+    @staticmethod
+    def render_table(entity_schema: EntitySchema, rows: List[dict]):
+        """Create an arrow table from rows."""
+        columns = {}
+        for row in rows:
+            for column in row:
+                columns[column] = None
+        return ParquetEmitter.render_columns(entity_schema,
+                                             {column: [row.get(column) for row in rows] for column in columns})
+
+    @staticmethod
+    def render_columns(entity_schema: EntitySchema, columns: Dict[str, Sequence]):
+        """Create an arrow table, fall back to string if values don't match the accumulated type.
+
+        :param columns: column name to values, lists or numpy arrays e.g. ColumnarBatch.columns
+        """
+        import pyarrow as pa
+
+        arrays = []
+        fields = []
+        for field in ParquetEmitter.render_fields(entity_schema, set(columns)):
+            values = columns[field.name]
+            if getattr(values, 'dtype', object) == object:
+                values = [v if v is None or is_primitive(v) else json.dumps(v) for v in values]
+            try:
+                array = pa.array(values, type=field.type)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, TypeError, ValueError,
+                    OverflowError):
+                field = pa.field(field.name, pa.string())
+                array = pa.array([v if v is None else str(v) for v in values], type=field.type)
+            arrays.append(array)
+            fields.append(field)
+        return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+    def close(self) -> None:
+        """Spool remaining rows, write each dataset and its schema to _common_metadata, remove segments."""
+        import pyarrow.parquet as pq
+
+        for entity_id in list(self._rows):
+            self._flush(entity_id)
+        for entity_id in list(self._segments):
+            schema = self._write_dataset(entity_id)
+            pq.write_metadata(schema, pathlib.Path(self.work_dir, entity_id, '_common_metadata'))
+            for segment_path in self._segments[entity_id]:
+                segment_path.unlink()
+        super().close()
+
+
+class _ConformError(Exception):
+    """A column of a segment doesn't convert to the dataset's type."""
+
+    def __init__(self, column: str):
+        """Name the column."""
+        super().__init__(column)
+        self.column = column
+
+
 class PFB(BaseModel):
     """Delegate to a set of emitters."""
 
@@ -387,9 +620,24 @@ class PFB(BaseModel):
     """Model that processed the data."""
 
     _results: InspectionResults = PrivateAttr()
+    _schemas: SchemaAccumulator = PrivateAttr()
+
+    def __init__(self, schemas: SchemaAccumulator = None, **data):
+        """Share schemas with emitters.
+
+        :param schemas: union of properties observed, shared with emitters.
+        """
+        super().__init__(**data)
+        self._schemas = schemas or SchemaAccumulator()
+
+    @property
+    def schemas(self) -> SchemaAccumulator:
+        """Union of properties observed."""
+        return self._schemas
 
     def emit(self, context: TransformerContext) -> bool:
-        """Delegate."""
+        """Accumulate schema, delegate."""
+        self.schemas.observe(context)
         return any([emitter.emit(context) for emitter in self.emitters])
 
     def close(self) -> None:
@@ -412,18 +660,40 @@ class PFB(BaseModel):
 
 
 @contextmanager
-def pfb(work_dir: str, file_path: str, model: Model) -> Iterator[PFB]:
+def pfb(work_dir: str, file_path: str, model: Model, parquet: bool = False,
+        row_group_size: int = DEFAULT_ROW_GROUP_SIZE, write_schemas: bool = False, codec: str = DEFAULT_CODEC,
+        sync_interval: int = DEFAULT_SYNC_INTERVAL, shard_by: str = None, shard_size: int = DEFAULT_SHARD_SIZE,
+        shard_count: int = DEFAULT_SHARD_COUNT, validate_codes: bool = False) -> Iterator[PFB]:
     """Create a context with our emitters, close when done.
 
     :param work_dir: Used for transient files, will create if it doesn't exist.
     :param file_path: Path to PFB file output.
     :param model: schema entities written out in config files order.
+    :param parquet: Also write a parquet dataset per entity to work_dir/parquet.
+    :param row_group_size: Rows per parquet row group, each entity's dataset is one file.
+    :param write_schemas: Also write work_dir/gen3/<entity>.yaml and work_dir/dump-ordered.json.
+    :param codec: PFB avro block compression, see PFB_CODECS.
+    :param sync_interval: Approximate size of PFB avro blocks in bytes, before compression.
+    :param shard_by: If set, write dependency closed shards and a manifest instead of file_path, see SHARD_BY.
+    :param shard_size: shard_by=size, approximate size of a shard in bytes of json records.
+    :param shard_count: shard_by=patient, number of patient shards.
+    :param validate_codes: Check coded values against required ValueSets, violations are reported in results.
     """
+    # fail before transforming, not after
+    check_codec(codec)
+    WARNINGS.clear()
     # create emitters
-    pfb_json_emitter = PFBJsonEmitter(work_dir=work_dir)
-    data_dictionary_emitter = DictionaryEmitter(work_dir=work_dir)
+    schemas = SchemaAccumulator()
+    data_dictionary_emitter = DictionaryEmitter(work_dir=work_dir, schemas=schemas, write_files=write_schemas)
+    # shares compiled Value/Code sets with the dictionary
+    code_validator = CodeValidator(data_dictionary_emitter.metadata) if validate_codes else None
+    pfb_json_emitter = PFBJsonEmitter(work_dir=work_dir, code_validator=code_validator)
+    emitters = [pfb_json_emitter, data_dictionary_emitter]
+    if parquet:
+        # after pfb_json_emitter, re-uses its rendered record
+        emitters.append(ParquetEmitter(work_dir=work_dir, row_group_size=row_group_size, schemas=schemas))
     ok = False
-    pfb_ = PFB(emitters=[pfb_json_emitter, data_dictionary_emitter], file_path=file_path, model=model)
+    pfb_ = PFB(emitters=emitters, file_path=file_path, model=model, schemas=schemas)
     try:
         # return to caller
         yield pfb_
@@ -436,126 +706,194 @@ def pfb(work_dir: str, file_path: str, model: Model) -> Iterator[PFB]:
             return
         # tell emitters to close
         pfb_.close()
-        # ask gen3 to create a single dump file. See WORK_FILES
-        schema_dump_path = f"{work_dir}/dump.json"
-        schema_dump_ordered_path = f"{work_dir}/dump-ordered.json"
-        with open(schema_dump_path, 'w') as f:
-            json.dump(dump_schemas_from_dir(data_dictionary_emitter.work_dir), f)
-        # verify this worked
-        schema = json.load(open(schema_dump_path))
-        assert schema
-        assert len(schema.keys()) > 0
-
-        # Note: `dump_schemas_from_dir` creates the schema in an unspecified order, as
-        # under the covers it uses `glob to find the files`).
-        # However, we need to reshape the schema:
-        # * avro delivers records to its reader in the order they were defined in the schema
-        # * terra processes the file a page at a time, and verifies link integrity (both sides of the edge must exist)
-        # so all records must be read in a specific order.
-        #
-
-        # write the keys back in a specific order
-        ordered_entities = [f"{e}.yaml" for e in model.dependency_order if f"{e}.yaml" in schema]
-        # only entities that exist
-        assert len(ordered_entities) > 0, f"No schemas in {data_dictionary_emitter.work_dir}/*.yaml"
-        additional_entities = [e for e in schema if e not in ordered_entities]
-        ordered_keys = ordered_entities + additional_entities
-        ordered_schema = {k: schema[k] for k in ordered_keys}
-        with open(schema_dump_ordered_path, "w") as fp:
-            json.dump(ordered_schema, fp, sort_keys=False)
-
-        # deprecate jq, do this in python
-        # jq_script = ", ".join([f'"{e}.yaml": .["{e}.yaml"]' for e in ordered_entities + STATIC_ENTITIES])
-        # cmd_line = f"jq '. | {{ {jq_script} }}' {schema_dump_path}  > {schema_dump_ordered_path}"
-        # run_cmd(cmd_line)
-        # to verify
-        # jq '. | keys_unsorted'  dump-ordered.json
-
-        # create pfb file with the schema
-        logger.info("Creating pfb file with the schema")
-        run_cmd(f"pfb from -o {file_path} dict {schema_dump_ordered_path}")
-
-        # now we can add the data to the pfb
-
-        for e in model.dependency_order:
-            if os.path.isfile(f"{pfb_json_emitter.work_dir}/{e}.ndjson"):
-                logger.info(f"adding {pfb_json_emitter.work_dir}/{e}.ndjson to {file_path}")
-                cmd_line = f"pfb add -i {pfb_json_emitter.work_dir}/{e}.ndjson {file_path}"
-                run_cmd(cmd_line)
-
-        pfb_.set_results(inspect_pfb(file_path))
-
-        # clean up
-        os.remove(schema_dump_path)
-        # os.remove(schema_dump_ordered_path)
+        WARNINGS.log_summary(logger)
+
+        # assemble the gen3 dictionary in memory, entities in dependency order
+        schema = data_dictionary_emitter.render_schemas()
+        assert len(schema.keys()) > 0, "No schemas rendered"
+        schema.update(data_dictionary_emitter.static_schemas())
+        ordered_schema = order_schema(model, schema)
+
+        if write_schemas:
+            # intermediate file for the gen3 data dictionary workflow
+            with open(f"{work_dir}/dump-ordered.json", "w") as fp:
+                json.dump(ordered_schema, fp, sort_keys=False)
+
+        # create pfb file with the schema, add the data in dependency order
+        record_paths = [f"{pfb_json_emitter.work_dir}/{e}.ndjson" for e in model.dependency_order]
+        record_paths = [path for path in record_paths if os.path.isfile(path)]
+        accumulator = InspectionAccumulator()
+        if shard_by:
+            logger.info(f"Creating pfb shards {manifest_path(file_path)}")
+            write_shards(file_path, ordered_schema, record_paths, work_dir, shard_by, shard_size=shard_size,
+                         shard_count=shard_count, accumulator=accumulator, codec=codec, sync_interval=sync_interval)
+            results = accumulator.finish(file_path)
+            if code_validator:
+                code_validator.update_results(results)
+            pfb_.set_results(results)
+            return
+        logger.info(f"Creating pfb file {file_path}")
+        write_pfb(file_path, ordered_schema, record_paths, accumulator, codec=codec, sync_interval=sync_interval)
+
+        # summarized while writing, no need to re-scan the file
+        results = accumulator.finish(file_path)
+        if code_validator:
+            code_validator.update_results(results)
+        write_summary(file_path, results)
+        pfb_.set_results(results)
         # done!
 
 
-def inspect_pfb(file_name) -> InspectionResults:
-    """Show details of the pfb."""
-    # TODO - simplify
-    results = InspectionResults()
-    # raw records
-    records = []
-    # TODO - should this be a generator?
-    with open(file_name, 'rb') as fo:
-        records = [record for record in reader(fo)]
-
-    # ensure loaded in the correct order
-
-    def recursive_default_dict():
-        """Recursive default dict."""
-        return defaultdict(recursive_default_dict)
-
-    seen_already = set()
-
-    def log_first_occurrence(obj_):
-        seen_already.add(obj_['name'])
-
-    def check_links(obj_, graph_) -> Iterator[str]:
-        """Make sure relations from obj exist in graph."""
-        assert 'relations' in obj_
-        for r in obj_['relations']:
-            if not graph_[r['dst_name']][r['dst_id']]:
-                yield f"{r['dst_name']}.{r['dst_id']} , referenced from {obj_['name']}.{obj_['id']} not found in Graph "
-
-    graph = recursive_default_dict()
-
-    for obj in records:
-        log_first_occurrence(obj)
-        graph[obj['name']][obj['id']] = obj
-        for error in check_links(obj, graph):
-            results.errors.append(error)
-
-    # ensure no duplicates
-    seen_already = set()
-
-    def check_duplicates(obj_):
-        if obj_['id'] in seen_already:
-            yield f"Duplicate {obj_['name']}/{obj_['id']}"
-        seen_already.add(obj_['id'])
-
-    for obj in records:
-        for error in check_duplicates(obj):
-            results.errors.append(error)
-
-    with_relations = [r for r in records if len(r['relations']) > 0]
-    results.info.append(f"'Records with relationships': {len(with_relations)}")
-    results.info.append(f"'Records': {len(records)}")
-
-    assert len(records) > 1, f"Should have more than just metadata {file_name}"
-    if len(with_relations) == 0:
-        results.warnings.append("No records have relationships.")
-
-    for obj in records:
-        if obj['name'] not in results.counts:
-            results.counts[obj['name']] = EntitySummary(name=obj['name'])
-        summary = results.counts[obj['name']]
-        summary.count += 1
-        for r in obj['relations']:
-            if r['dst_name'] not in summary.relationships:
-                summary.relationships[r['dst_name']] = EdgeSummary(src=summary.name, dst=r['dst_name'])
-            edge_summary = summary.relationships[r['dst_name']]
-            edge_summary.count += 1
-
-    return results
+def order_schema(model: Model, schema: Dict[str, dict]) -> Dict[str, dict]:
+    """Order the schema's keys by the model's dependency order.
+
+    * avro delivers records to its reader in the order they were defined in the schema
+    * terra processes the file a page at a time, and verifies link integrity (both sides of the edge must exist)
+    so all records must be read in a specific order.
+    """
+    ordered_entities = [f"{e}.yaml" for e in model.dependency_order if f"{e}.yaml" in schema]
+    # only entities that exist
+    assert len(ordered_entities) > 0, f"No schemas for {model.dependency_order}"
+    additional_entities = [e for e in schema if e not in ordered_entities]
+    ordered_keys = ordered_entities + additional_entities
+    return {k: schema[k] for k in ordered_keys}
+
+
+def load_dictionary(schema: Dict[str, dict]) -> DataDictionary:
+    """Load a gen3 dictionary, the ordered schema is written to a single transient json file."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        local_file = os.path.join(tmp_dir, 'dump-ordered.json')
+        with open(local_file, 'w') as fp:
+            json.dump(schema, fp)
+        return DataDictionary(local_file=local_file)
+
+
+def _read_records(record_paths: List[str]) -> Iterator[dict]:
+    """Stream pfb records from ndjson files."""
+    for record_path in record_paths:
+        logger.info(f"adding {record_path}")
+        with open(record_path) as fp:
+            for line in fp:
+                yield json.loads(line)
+
+
+def check_codec(codec: str) -> None:
+    """Raise ValueError if the codec is unknown or its library is not installed."""
+    if codec not in PFB_CODECS:
+        raise ValueError(f"Unknown codec {codec}, expected one of {PFB_CODECS}")
+    try:
+        fastavro.writer(io.BytesIO(), {'type': 'record', 'name': 'probe', 'fields': []}, [{}], codec=codec)
+    except ValueError as e:
+        raise ValueError(f"codec {codec} is not available, `pip install pfb_fhir[{codec}]`: {e}")
+
+
+class PFBCodecWriter(PFBWriter):
+    """A PFBWriter with a configurable codec and block size."""
+
+    def __init__(self, file_or_path, codec: str = DEFAULT_CODEC, sync_interval: int = DEFAULT_SYNC_INTERVAL):
+        """Set codec and block size.
+
+        :param codec: avro block compression, see PFB_CODECS.
+        :param sync_interval: approximate size of avro blocks in bytes, before compression.
+        """
+        super().__init__(file_or_path)
+        self.codec = codec
+        self.sync_interval = sync_interval
+
+    def write(self, iterable=None, metadata=True):
+        """Same as PFBWriter.write, pass codec and sync_interval to fastavro."""
+        def _iter():
+            if metadata:
+                yield avro_record(None, "Metadata", self._metadata, [])
+            if iterable is not None:
+                for record in iterable:
+                    obj = record["object"]
+                    name = record["name"]
+                    record["object"] = (name, obj)
+                    for hook in self._hooks:
+                        record = hook(record)
+                    for field, value in list(obj.items()):
+                        if value is not None and self.is_encode(name, field):
+                            if isinstance(value, list):
+                                # don't encode list brackets
+                                obj[field] = [encode_enum(element) for element in value]
+                            else:
+                                obj[field] = encode_enum(value)
+                    yield record
+
+        fastavro.writer(self._file_obj, make_avro_schema(self.schema), _iter(), codec=self.codec,
+                        sync_interval=self.sync_interval)
+
+
+def _observe_records(records: Iterator[dict], accumulator: InspectionAccumulator) -> Iterator[dict]:
+    """Summarize records in the order they are written."""
+    for record in records:
+        relations = [(relation['dst_name'], relation['dst_id']) for relation in record.get('relations', [])]
+        accumulator.observe(record['name'], record['id'], relations)
+        yield record
+
+
+def pfb_schema(schema: Dict[str, dict]) -> Tuple[list, dict]:
+    """Convert the gen3 dictionary to the PFB's avro schema and metadata."""
+    data_dictionary = load_dictionary(schema)
+    dictionary.init(data_dictionary)
+    records, ontology_references, links = parse_dictionary(data_dictionary)
+    metadata = get_ontology_references(ontology_references, links)
+    return records, metadata
+
+
+def write_records(file_path: str, records_schema: list, metadata: dict, pfb_records: Iterator[dict],
+                  codec: str = DEFAULT_CODEC, sync_interval: int = DEFAULT_SYNC_INTERVAL) -> None:
+    """Write the schema, metadata and records to a PFB file."""
+    with PFBCodecWriter(file_path, codec=codec, sync_interval=sync_interval) as writer:
+        writer.set_schema(records_schema)
+        writer.set_metadata(metadata)
+        writer.write(pfb_records)
+
+
+def write_pfb(file_path: str, schema: Dict[str, dict], record_paths: List[str],
+              accumulator: InspectionAccumulator = None, codec: str = DEFAULT_CODEC,
+              sync_interval: int = DEFAULT_SYNC_INTERVAL) -> None:
+    """Write the dictionary and records to a PFB file, equivalent to `pfb from dict` followed by `pfb add`.
+
+    :param accumulator: if set, summarize records as they are written.
+    :param codec: avro block compression, see PFB_CODECS.
+    :param sync_interval: approximate size of avro blocks in bytes, before compression.
+    """
+    records_schema, metadata = pfb_schema(schema)
+    pfb_records = _read_records(record_paths)
+    if accumulator:
+        # the writer emits the metadata record first
+        accumulator.observe('Metadata', None, [])
+        pfb_records = _observe_records(pfb_records, accumulator)
+    write_records(file_path, records_schema, metadata, pfb_records, codec=codec, sync_interval=sync_interval)
+
+
+def write_shards(file_path: str, schema: Dict[str, dict], record_paths: List[str], work_dir: str, shard_by: str,
+                 shard_size: int = DEFAULT_SHARD_SIZE, shard_count: int = DEFAULT_SHARD_COUNT,
+                 accumulator: InspectionAccumulator = None, codec: str = DEFAULT_CODEC,
+                 sync_interval: int = DEFAULT_SYNC_INTERVAL) -> ShardManifest:
+    """Write the records to several PFB files, each with the complete schema, and a manifest.
+
+    :param file_path: shards are named <file_path>.<n>.pfb.avro, manifest <file_path>.manifest.json
+    :param work_dir: transient files.
+    :param shard_by: see SHARD_BY.
+    :param accumulator: if set, summarize all shards' records in load order, as if they were one PFB.
+    """
+    records_schema, metadata = pfb_schema(schema)
+    shards = spool_shards(record_paths, f"{work_dir}/shards", shard_by, shard_size=shard_size, shard_count=shard_count)
+    if accumulator:
+        # one metadata record, as if the shards were loaded into one PFB
+        accumulator.observe('Metadata', None, [])
+    base = shard_base(file_path)
+    for index, shard in enumerate(shards):
+        shard.path = f"{base}.{index:05d}.pfb.avro"
+        logger.info(f"Creating pfb shard {shard.path} {shard.counts}")
+        pfb_records = _read_records([shard.spool])
+        if accumulator:
+            pfb_records = _observe_records(pfb_records, accumulator)
+        write_records(shard.path, records_schema, metadata, pfb_records, codec=codec, sync_interval=sync_interval)
+        os.unlink(shard.spool)
+    manifest = ShardManifest(shard_by=shard_by, shards=shards)
+    manifest.write(manifest_path(file_path))
+    return manifest
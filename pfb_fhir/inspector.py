@@ -0,0 +1,401 @@
+"""Inspect a PFB, decode avro blocks in parallel."""
+import hashlib
+import io
+import logging
+import os
+from collections import deque
+from typing import Callable, Dict, List, Tuple, Iterator, Optional
+
+from pydantic import BaseModel
+
+from pfb_fhir.model import InspectionResults, EntitySummary, EdgeSummary
+
+logger = logging.getLogger(__name__)
+
+AVRO_MAGIC = b'Obj\x01'
+SYNC_SIZE = 16
+CHUNKS_PER_PROCESS = 4
+"""Split the file into more chunks than processes, to balance load."""
+FUTURES_PER_PROCESS = 2
+"""Chunks submitted ahead of the reduce per process, bounds the summaries held by the parent."""
+SUMMARY_VERSION = 1
+"""Bump when the sidecar format changes."""
+KEY_DIGEST_SIZE = 16
+"""Bytes of hash kept per record identity, instead of its name and id."""
+
+
+def _read_long(fp) -> int:
+    """Read a zig-zag encoded avro long."""
+    shift = 0
+    accumulator = 0
+    while True:
+        byte = fp.read(1)
+        if not byte:
+            raise EOFError("Unexpected end of avro file")
+        b = byte[0]
+        accumulator |= (b & 0x7F) << shift
+        if not b & 0x80:
+            break
+        shift += 7
+    return (accumulator >> 1) ^ -(accumulator & 1)
+
+
+def read_header(fp) -> Tuple[int, bytes]:
+    """Skip over the avro header, return (offset of first block, sync marker)."""
+    assert fp.read(4) == AVRO_MAGIC, "Not an avro container file"
+    # metadata map: blocks of (key, value) until a zero count
+    while True:
+        count = _read_long(fp)
+        if count == 0:
+            break
+        if count < 0:
+            # negative count is followed by the block size in bytes
+            _read_long(fp)
+            count = -count
+        for _ in range(count):
+            fp.seek(_read_long(fp), os.SEEK_CUR)  # key
+            fp.seek(_read_long(fp), os.SEEK_CUR)  # value
+    sync = fp.read(SYNC_SIZE)
+    return fp.tell(), sync
+
+
+def block_offsets(file_name: str) -> Tuple[int, List[Tuple[int, int]]]:
+    """Find block boundaries without decoding, return (header size, [(block start, block end), ...])."""
+    offsets = []
+    with open(file_name, 'rb') as fp:
+        header_size, sync = read_header(fp)
+        file_size = os.fstat(fp.fileno()).st_size
+        start = header_size
+        while start < file_size:
+            fp.seek(start)
+            _read_long(fp)  # record count
+            size = _read_long(fp)
+            end = fp.tell() + size + SYNC_SIZE
+            fp.seek(end - SYNC_SIZE)
+            assert fp.read(SYNC_SIZE) == sync, f"{file_name} sync marker not found at {end - SYNC_SIZE}"
+            offsets.append((start, end))
+            start = end
+    return header_size, offsets
+
+
+def chunk_blocks(offsets: List[Tuple[int, int]], chunk_count: int) -> List[Tuple[int, int]]:
+    """Group contiguous blocks into at most chunk_count (start, end) ranges of similar size."""
+    if not offsets:
+        return []
+    total = offsets[-1][1] - offsets[0][0]
+    target = max(1, total // max(1, chunk_count))
+    chunks = []
+    chunk_start = offsets[0][0]
+    for _, end in offsets:
+        if end - chunk_start >= target:
+            chunks.append((chunk_start, end))
+            chunk_start = end
+    if chunk_start < offsets[-1][1]:
+        chunks.append((chunk_start, offsets[-1][1]))
+    return chunks
+
+
+def key_digest(*parts: Optional[str]) -> bytes:
+    """Compact hash of a record's identity e.g. (name, id), memory doesn't grow with the length of ids."""
+    key = '\0'.join('\1' if part is None else part for part in parts)
+    return hashlib.blake2b(key.encode(), digest_size=KEY_DIGEST_SIZE).digest()
+
+
+def _digests(digests: bytes) -> Iterator[bytes]:
+    """Split concatenated digests."""
+    for offset in range(0, len(digests), KEY_DIGEST_SIZE):
+        yield digests[offset:offset + KEY_DIGEST_SIZE]
+
+
+class ChunkSummary(BaseModel):
+    """Partial counts and digests of a chunk's records, no names or ids are sent back from workers."""
+
+    record_count: int = 0
+    """Number of records."""
+    with_relations: int = 0
+    """Number of records with relations."""
+    counts: Dict[str, int] = {}
+    """Records per entity, in order of first occurrence."""
+    edges: Dict[str, Dict[str, int]] = {}
+    """Links per entity and destination entity, in order of first occurrence."""
+    keys: bytes = b''
+    """key_digest(name, id) of each record, concatenated."""
+    ids: bytes = b''
+    """key_digest(id) of each record, concatenated in file order."""
+    links: List[Tuple[bytes, str, str, int]] = []
+    """(key_digest(dst_name, dst_id), name, dst_name, ordinal) of links not to an earlier record of the chunk."""
+
+
+def _read_chunk(file_name: str, header_size: int, start: int, end: int) -> Iterator[dict]:
+    """Decode blocks [start, end), header + blocks make a valid avro file."""
+    from fastavro import reader
+
+    with open(file_name, 'rb') as fp:
+        buffer = io.BytesIO()
+        buffer.write(fp.read(header_size))
+        fp.seek(start)
+        buffer.write(fp.read(end - start))
+    buffer.seek(0)
+    yield from reader(buffer)
+
+
+def summarize_chunk(file_name: str, header_size: int, start: int, end: int) -> ChunkSummary:
+    """Count the records of blocks [start, end), links that may be dangling are resolved by the reduce."""
+    counts = {}
+    edges = {}
+    keys = []
+    ids = []
+    links = []
+    seen = set()
+    ordinal = 0
+    with_relations = 0
+    for record in _read_chunk(file_name, header_size, start, end):
+        name = record['name']
+        key = key_digest(name, record['id'])
+        seen.add(key)
+        keys.append(key)
+        ids.append(key_digest(record['id']))
+        counts[name] = counts.get(name, 0) + 1
+        relations = record['relations']
+        if relations:
+            with_relations += 1
+            edge_counts = edges.setdefault(name, {})
+        for relation in relations:
+            dst_name = relation['dst_name']
+            edge_counts[dst_name] = edge_counts.get(dst_name, 0) + 1
+            dst_key = key_digest(dst_name, relation['dst_id'])
+            if dst_key not in seen:
+                links.append((dst_key, name, dst_name, ordinal))
+            ordinal += 1
+    return ChunkSummary.construct(record_count=len(keys), with_relations=with_relations, counts=counts, edges=edges,
+                                  keys=b''.join(keys), ids=b''.join(ids), links=links)
+
+
+def describe_chunk(file_name: str, header_size: int, start: int, end: int, dangling: List[int],
+                   duplicates: List[int]) -> Tuple[List[str], List[str]]:
+    """Messages of the dangling links (by ordinal) and duplicate records (by position) of blocks [start, end)."""
+    dangling = set(dangling)
+    duplicates = set(duplicates)
+    errors = []
+    duplicate_errors = []
+    ordinal = 0
+    for position, record in enumerate(_read_chunk(file_name, header_size, start, end)):
+        for relation in record['relations']:
+            if ordinal in dangling:
+                errors.append(f"{relation['dst_name']}.{relation['dst_id']} , referenced from "
+                              f"{record['name']}.{record['id']} not found in Graph ")
+            ordinal += 1
+        if position in duplicates:
+            duplicate_errors.append(f"Duplicate {record['name']}/{record['id']}")
+    return errors, duplicate_errors
+
+
+def _map_chunks(function: Callable, file_name: str, header_size: int, chunks: List[tuple],
+                processes: int) -> Iterator:
+    """Yield function(file_name, header_size, *chunk) in file order, in a process pool if processes > 1.
+
+    At most FUTURES_PER_PROCESS chunks per process are in flight, each result is released once yielded.
+    """
+    if processes <= 1:
+        for chunk in chunks:
+            yield function(file_name, header_size, *chunk)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for chunk in chunks:
+            pending.append(executor.submit(function, file_name, header_size, *chunk))
+            if len(pending) >= processes * FUTURES_PER_PROCESS:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class InspectionAccumulator(object):
+    """Reduce (name, id, relations) in file order: links must refer to records earlier in the file."""
+
+    def __init__(self) -> None:
+        """Empty results."""
+        self.results = InspectionResults()
+        # digests of (name, id) and id
+        self._seen = set()
+        self._seen_ids = set()
+        self._duplicates = []
+        self.record_count = 0
+        self.with_relations = 0
+
+    def observe(self, name: str, id_: Optional[str], relations: List[Tuple[str, str]]) -> None:
+        """Count the record, check its links."""
+        self.record_count += 1
+        self._seen.add(key_digest(name, id_))
+        if name not in self.results.counts:
+            self.results.counts[name] = EntitySummary(name=name)
+        summary = self.results.counts[name]
+        summary.count += 1
+        for dst_name, dst_id in relations:
+            if dst_name not in summary.relationships:
+                summary.relationships[dst_name] = EdgeSummary(src=summary.name, dst=dst_name)
+            edge = summary.relationships[dst_name]
+            edge.count += 1
+            if key_digest(dst_name, dst_id) not in self._seen:
+                edge.dangling += 1
+                self.results.errors.append(f"{dst_name}.{dst_id} , referenced from {name}.{id_} not found in Graph ")
+        # ensure no duplicates
+        id_digest = key_digest(id_)
+        if id_digest in self._seen_ids:
+            self._duplicates.append(f"Duplicate {name}/{id_}")
+        self._seen_ids.add(id_digest)
+        if len(relations) > 0:
+            self.with_relations += 1
+
+    def observe_chunk(self, chunk: ChunkSummary) -> Tuple[List[int], List[int]]:
+        """Merge a chunk's counts and digests, return ordinals of its dangling links and positions of its duplicates.
+
+        Chunks are observed in file order, messages are added with `describe`.
+        """
+        self.record_count += chunk.record_count
+        self.with_relations += chunk.with_relations
+        for name, count in chunk.counts.items():
+            if name not in self.results.counts:
+                self.results.counts[name] = EntitySummary(name=name)
+            self.results.counts[name].count += count
+        for name, edge_counts in chunk.edges.items():
+            summary = self.results.counts[name]
+            for dst_name, count in edge_counts.items():
+                if dst_name not in summary.relationships:
+                    summary.relationships[dst_name] = EdgeSummary(src=summary.name, dst=dst_name)
+                summary.relationships[dst_name].count += count
+        dangling = []
+        for dst_key, name, dst_name, ordinal in chunk.links:
+            if dst_key not in self._seen:
+                self.results.counts[name].relationships[dst_name].dangling += 1
+                dangling.append(ordinal)
+        duplicates = []
+        for position, id_digest in enumerate(_digests(chunk.ids)):
+            if id_digest in self._seen_ids:
+                duplicates.append(position)
+            self._seen_ids.add(id_digest)
+        self._seen.update(_digests(chunk.keys))
+        return dangling, duplicates
+
+    def describe(self, errors: List[str], duplicates: List[str]) -> None:
+        """Add messages of a chunk's dangling links and duplicates, see describe_chunk."""
+        self.results.errors.extend(errors)
+        self._duplicates.extend(duplicates)
+
+    def finish(self, file_name: str) -> InspectionResults:
+        """Add info and warnings, return results."""
+        results = self.results
+        results.errors.extend(self._duplicates)
+        self._duplicates = []
+        results.info.append(f"'Records with relationships': {self.with_relations}")
+        results.info.append(f"'Records': {self.record_count}")
+
+        assert self.record_count > 1, f"Should have more than just metadata {file_name}"
+        if self.with_relations == 0:
+            results.warnings.append("No records have relationships.")
+
+        return results
+
+
+def inspect_pfb(file_name, processes: int = 1) -> InspectionResults:
+    """Show details of the pfb.
+
+    :param file_name: PFB file.
+    :param processes: decode avro blocks in this many processes, partial results are merged in file order.
+    """
+    header_size, offsets = block_offsets(file_name)
+    chunks = chunk_blocks(offsets, processes * CHUNKS_PER_PROCESS if processes > 1 else 1)
+    accumulator = InspectionAccumulator()
+    # chunks with dangling links or duplicates are decoded again, for their messages
+    problems = []
+    for (start, end), chunk in zip(chunks, _map_chunks(summarize_chunk, file_name, header_size, chunks, processes)):
+        dangling, duplicates = accumulator.observe_chunk(chunk)
+        if dangling or duplicates:
+            problems.append((start, end, dangling, duplicates))
+    for errors, duplicates in _map_chunks(describe_chunk, file_name, header_size, problems, processes):
+        accumulator.describe(errors, duplicates)
+    return accumulator.finish(file_name)
+
+
+class PFBSummary(BaseModel):
+    """Sidecar written next to the PFB, avoids re-scanning it."""
+
+    version: int = SUMMARY_VERSION
+    """Format of this summary."""
+    size: int
+    """Size of the PFB when summarized."""
+    mtime_ns: int
+    """Modification time of the PFB when summarized."""
+    sha256: str
+    """Content hash of the PFB."""
+    results: InspectionResults
+    """Counts, edges, dangling links."""
+
+
+def summary_path(file_name: str) -> str:
+    """Location of the sidecar."""
+    return f"{file_name}.summary.json"
+
+
+def file_hash(file_name: str, block_size: int = 1024 * 1024) -> str:
+    """sha256 of the file's content."""
+    hash_ = hashlib.sha256()
+    with open(file_name, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(block_size), b''):
+            hash_.update(chunk)
+    return hash_.hexdigest()
+
+
+def write_summary(file_name: str, results: InspectionResults) -> str:
+    """Write the sidecar, return its path."""
+    stat = os.stat(file_name)
+    summary = PFBSummary(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=file_hash(file_name), results=results)
+    path = summary_path(file_name)
+    with open(path, 'w') as fp:
+        fp.write(summary.json())
+    return path
+
+
+def read_summary(file_name: str, verify: bool = False) -> Optional[InspectionResults]:
+    """Results from the sidecar, None if it is missing or stale.
+
+    :param file_name: PFB file.
+    :param verify: also compare the content hash, otherwise size and modification time.
+    """
+    path = summary_path(file_name)
+    if not os.path.isfile(path):
+        return None
+    try:
+        summary = PFBSummary.parse_file(path)
+    except ValueError as e:
+        logger.warning(f"Ignoring {path} {e}")
+        return None
+    stat = os.stat(file_name)
+    if summary.version != SUMMARY_VERSION or summary.size != stat.st_size or summary.mtime_ns != stat.st_mtime_ns:
+        logger.info(f"{path} is stale")
+        return None
+    if verify and summary.sha256 != file_hash(file_name):
+        logger.info(f"{path} content hash does not match")
+        return None
+    return summary.results
+
+
+def load_results(file_name: str, processes: int = 1, verify: bool = False) -> InspectionResults:
+    """Read the sidecar, fall back to scanning the PFB (and refresh the sidecar).
+
+    :param file_name: PFB file.
+    :param processes: decode avro blocks in this many processes, when scanning.
+    :param verify: also compare the content hash of the sidecar.
+    """
+    results = read_summary(file_name, verify=verify)
+    if results is not None:
+        return results
+    logger.info(f"Scanning {file_name}")
+    results = inspect_pfb(file_name, processes=processes)
+    try:
+        write_summary(file_name, results)
+    except OSError as e:
+        logger.warning(f"Could not write {summary_path(file_name)} {e}")
+    return results
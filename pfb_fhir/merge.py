@@ -0,0 +1,235 @@
+"""Merge several PFBs into one."""
+import json
+import logging
+import os
+import pathlib
+from copy import deepcopy
+from typing import List, Dict, Iterator, Tuple
+
+import fastavro
+
+from pfb_fhir.emitter import DEFAULT_CODEC, DEFAULT_SYNC_INTERVAL, check_codec
+from pfb_fhir.inspector import InspectionAccumulator, write_summary, key_digest
+from pfb_fhir.model import InspectionResults
+
+logger = logging.getLogger(__name__)
+
+METADATA = 'Metadata'
+"""Name of the PFB metadata record."""
+
+
+def read_pfb_header(file_name: str) -> Tuple[dict, dict]:
+    """Return the avro schema and the metadata object of a PFB."""
+    with open(file_name, 'rb') as fp:
+        avro_reader = fastavro.reader(fp)
+        schema = avro_reader.writer_schema
+        metadata = next(avro_reader)
+    assert metadata['name'] == METADATA, f"{file_name} first record should be {METADATA}"
+    return schema, metadata['object']
+
+
+def _field(schema: dict, name: str) -> dict:
+    """Field of a record schema."""
+    return next(field for field in schema['fields'] if field['name'] == name)
+
+
+def _type_name(type_) -> str:
+    """Name of a named type, or the primitive."""
+    if isinstance(type_, dict):
+        return type_.get('name', type_['type'])
+    return type_
+
+
+def _merge_type(entity: str, field_name: str, type_, other):
+    """Merge two types of a field, union enum symbols and union members; raise ValueError if they conflict."""
+    if type_ == other:
+        return type_
+    if isinstance(type_, list) and isinstance(other, list):
+        merged = list(type_)
+        names = [_type_name(member) for member in merged]
+        for member in other:
+            name = _type_name(member)
+            if name in names:
+                index = names.index(name)
+                merged[index] = _merge_type(entity, field_name, merged[index], member)
+            else:
+                merged.append(member)
+                names.append(name)
+        return merged
+    if isinstance(type_, dict) and isinstance(other, dict) and type_.get('type') == other.get('type') == 'enum':
+        merged = deepcopy(type_)
+        merged['symbols'] += [symbol for symbol in other['symbols'] if symbol not in type_['symbols']]
+        return merged
+    raise ValueError(f"Can't merge {entity}.{field_name}, its type is {type_} in one PFB and {other} in another; "
+                     f"records of one of them would not encode")
+
+
+def _merge_entity(entity_schema: dict, other: dict) -> dict:
+    """Union the fields of two record schemas of the same entity."""
+    merged = deepcopy(entity_schema)
+    fields = {field['name']: field for field in merged['fields']}
+    for field in other['fields']:
+        if field['name'] not in fields:
+            merged['fields'].append(deepcopy(field))
+            continue
+        fields[field['name']]['type'] = _merge_type(merged['name'], field['name'], fields[field['name']]['type'],
+                                                    field['type'])
+    return merged
+
+
+def merge_order(orders: List[List[str]]) -> List[str]:
+    """Merge dependency orders, a new name is placed after its predecessor in the order that introduced it."""
+    merged = []
+    for order in orders:
+        position = 0
+        for name in order:
+            if name in merged:
+                position = merged.index(name) + 1
+            else:
+                merged.insert(position, name)
+                position += 1
+    return merged
+
+
+def link_order(order: List[str], metadata: dict) -> List[str]:
+    """Order names so link destinations come before sources, ties (and cycles) are broken by position in order."""
+    position = {name: index for index, name in enumerate(order)}
+    depends_on = {name: set() for name in order}
+    for node in metadata['nodes']:
+        if node['name'] not in depends_on:
+            continue
+        depends_on[node['name']].update(
+            link['dst'] for link in node['links'] if link['dst'] in depends_on and link['dst'] != node['name']
+        )
+    ordered = []
+    remaining = list(order)
+    while remaining:
+        ready = [name for name in remaining if not depends_on[name] - set(ordered)]
+        if not ready:
+            logger.warning(f"Link cycle between {remaining}, using input order")
+            ready = remaining
+        name = min(ready, key=position.get)
+        ordered.append(name)
+        remaining.remove(name)
+    return ordered
+
+
+def merge_schemas(schemas: List[dict], metadata: dict) -> Tuple[dict, List[str]]:
+    """Union the entities of several PFB schemas.
+
+    :param metadata: merged metadata, its links order the entities.
+    :return: avro schema, entity names in dependency order.
+    """
+    entities: Dict[str, dict] = {}
+    orders = []
+    for schema in schemas:
+        order = []
+        for entity_schema in _field(schema, 'object')['type']:
+            name = entity_schema['name']
+            order.append(name)
+            entities[name] = _merge_entity(entities[name], entity_schema) if name in entities else deepcopy(entity_schema)
+        orders.append(order)
+    order = [METADATA] + link_order([name for name in merge_order(orders) if name != METADATA], metadata)
+    merged = deepcopy(schemas[0])
+    _field(merged, 'object')['type'] = [entities[name] for name in order]
+    return merged, [name for name in order if name != METADATA]
+
+
+def merge_metadata(metadatas: List[dict]) -> dict:
+    """Union metadata nodes, their links and properties."""
+    nodes: Dict[str, dict] = {}
+    misc = {}
+    for metadata in metadatas:
+        misc.update(metadata.get('misc', {}))
+        for node in metadata['nodes']:
+            if node['name'] not in nodes:
+                nodes[node['name']] = deepcopy(node)
+                continue
+            merged = nodes[node['name']]
+            for key in ['links', 'properties']:
+                merged[key] += [item for item in node[key] if item not in merged[key]]
+    return {'nodes': list(nodes.values()), 'misc': misc}
+
+
+def spool_records(file_paths: List[str], work_dir: str) -> Tuple[Dict[str, str], int]:
+    """Stream records from the PFBs into a transient file per entity, skip duplicate (name, id).
+
+    :return: entity name to spool path, number of duplicates.
+    """
+    pathlib.Path(work_dir).mkdir(parents=True, exist_ok=True)
+    seen = set()
+    duplicates = 0
+    spools = {}
+    files = {}
+    try:
+        for file_path in file_paths:
+            logger.info(f"Reading {file_path}")
+            with open(file_path, 'rb') as fp:
+                for record in fastavro.reader(fp):
+                    name = record['name']
+                    if name == METADATA:
+                        continue
+                    digest = key_digest(name, record['id'])
+                    if digest in seen:
+                        duplicates += 1
+                        continue
+                    seen.add(digest)
+                    if name not in files:
+                        spools[name] = os.path.join(work_dir, f"{name}.ndjson")
+                        files[name] = open(spools[name], 'w')
+                    json.dump(record, files[name])
+                    files[name].write('\n')
+    finally:
+        for fp in files.values():
+            fp.close()
+    return spools, duplicates
+
+
+def _read_spools(metadata: dict, order: List[str], spools: Dict[str, str],
+                 accumulator: InspectionAccumulator) -> Iterator[dict]:
+    """Metadata, then records in dependency order."""
+    accumulator.observe(METADATA, None, [])
+    yield {'id': None, 'name': METADATA, 'object': (METADATA, metadata), 'relations': []}
+    for name in order:
+        if name not in spools:
+            continue
+        with open(spools[name]) as fp:
+            for line in fp:
+                record = json.loads(line)
+                relations = [(relation['dst_name'], relation['dst_id']) for relation in record['relations']]
+                accumulator.observe(name, record['id'], relations)
+                record['object'] = (name, record['object'])
+                yield record
+        os.unlink(spools[name])
+
+
+def merge_pfbs(file_paths: List[str], file_path: str, work_dir: str, codec: str = DEFAULT_CODEC,
+               sync_interval: int = DEFAULT_SYNC_INTERVAL) -> InspectionResults:
+    """Merge PFBs into file_path, each (name, id) is written once, first one wins.
+
+    :param file_paths: PFBs to merge.
+    :param file_path: merged PFB.
+    :param work_dir: transient files, records are spooled to disk so inputs can be larger than memory.
+    :param codec: avro block compression, see PFB_CODECS.
+    :param sync_interval: approximate size of avro blocks in bytes, before compression.
+    :return: inspection of the merged PFB, links are checked across all inputs.
+    """
+    assert len(file_paths) > 0, "No PFBs to merge"
+    check_codec(codec)
+    headers = [read_pfb_header(path) for path in file_paths]
+    metadata = merge_metadata([metadata for _, metadata in headers])
+    schema, order = merge_schemas([schema for schema, _ in headers], metadata)
+
+    spools, duplicates = spool_records(file_paths, f"{work_dir}/merge")
+    if duplicates:
+        logger.info(f"Skipped {duplicates} duplicate records")
+
+    accumulator = InspectionAccumulator()
+    pathlib.Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(file_path, 'wb') as fp:
+        fastavro.writer(fp, schema, _read_spools(metadata, order, spools, accumulator), codec=codec,
+                        sync_interval=sync_interval)
+    results = accumulator.finish(file_path)
+    results.info.append(f"'Duplicates skipped': {duplicates}")
+    write_summary(file_path, results)
+    return results
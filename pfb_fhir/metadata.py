@@ -0,0 +1,241 @@
+"""Compile gen3 dictionary and Value/Code set metadata once, rendering and validating codes are lookups."""
+import logging
+from types import MappingProxyType
+from typing import Dict, FrozenSet, List, Mapping, Optional, Tuple
+
+from pydantic import BaseModel
+
+from pfb_fhir.common import WARNINGS
+from pfb_fhir.model import AttributeEnum, EntitySchema, FHIR_TYPES, InspectionResults, Property
+
+logger = logging.getLogger(__name__)
+
+JSON_TYPES: Mapping[str, str] = MappingProxyType({
+    **{code: 'string' for code in ['code', 'uri', 'url', 'canonical', 'xhtml', 'date', 'instant', 'id', 'markdown',
+                                   'base64Binary', 'string', 'dateTime', 'String', 'Code', 'DateTime', 'str']},
+    **{code: 'number' for code in ['decimal', 'positiveInt', 'integer', 'Decimal', 'Integer', 'int', 'float',
+                                   'number']},
+    **{code: 'boolean' for code in ['boolean', 'Boolean', 'bool']},
+    **{code: alias.json_type for code, alias in FHIR_TYPES.items()},
+})
+"""FHIR type code or python class name to json schema type."""
+
+CONSTRAINED_BINDINGS = frozenset(['required', 'preferred'])
+"""Binding strengths rendered as an enum, others list the codes in the description."""
+VALIDATED_BINDING = 'required'
+"""Binding strength checked by CodeValidator."""
+MAX_VIOLATIONS = 1000
+"""Distinct (entity, flattened key) reported by CodeValidator, others are only counted."""
+MAX_VIOLATION_VALUES = 5
+"""Distinct invalid values kept per violation."""
+MAX_DESCRIPTION_CODES = 100
+"""Codes appended to a description, others are elided."""
+
+
+def normalize_type(code: str) -> str:
+    """Cast to json schema types."""
+    json_type = JSON_TYPES.get(code)
+    if json_type is None:
+        WARNINGS.warn(logger, 'schema', "No mapping for {code} default to string", code=code)
+        return 'string'
+    return json_type
+
+
+class TermMetadata(BaseModel):
+    """Value/Code set of an enumerated property, shared by every property bound to it."""
+
+    url: str
+    """Value/Code set url."""
+    term_def: Tuple[Tuple[str, Optional[str]], ...]
+    """Gen3 termDef items."""
+    codes: Tuple[str, ...] = ()
+    """Enumerated values, from the FHIR class."""
+    constrained: bool = False
+    """Render codes as an enum, otherwise append them to the description."""
+
+    @property
+    def code_list(self) -> str:
+        """Codes appended to the description, at most MAX_DESCRIPTION_CODES."""
+        if len(self.codes) > MAX_DESCRIPTION_CODES:
+            return '|'.join(self.codes[:MAX_DESCRIPTION_CODES] + ('...',))
+        return '|'.join(self.codes)
+
+    class Config:
+        """Frozen."""
+
+        allow_mutation = False
+
+
+class PropertyMetadata(BaseModel):
+    """Everything needed to render a property, except the observed json type."""
+
+    flattened_key: str
+    """The key in a flattened representation."""
+    json_type: str
+    """Json schema type of the FHIR definition, used if no values were observed."""
+    required: bool
+    """Not optional."""
+    description: str
+    """FHIR documentation for the element, and the Value/Code set url if enumerated."""
+    term: Optional[TermMetadata] = None
+    """Value/Code set, if enumerated."""
+
+    class Config:
+        """Frozen."""
+
+        allow_mutation = False
+
+
+class MetadataCompiler(object):
+    """Compile each Value/Code set once, and each flattened key of an entity once."""
+
+    def __init__(self, value_sets=None) -> None:
+        """Nothing compiled.
+
+        :param value_sets: ValueSets, expands Value/Code sets the FHIR class doesn't enumerate, for validation only;
+            the dictionary renders the FHIR class's codes.
+        """
+        self.value_sets = value_sets
+        self._terms: Dict[Tuple[str, str], TermMetadata] = {}
+        self._tables: Dict[str, Dict[str, PropertyMetadata]] = {}
+        self._expansions: Dict[str, Tuple[str, ...]] = {}
+
+    def expansion(self, enum: AttributeEnum) -> Tuple[str, ...]:
+        """Codes enumerated by the FHIR class, or the ValueSets expansion, once per url."""
+        if enum.restricted_to or self.value_sets is None:
+            return tuple(enum.restricted_to)
+        if enum.url not in self._expansions:
+            self._expansions[enum.url] = tuple(self.value_sets.codes(enum.url) or [])
+        return self._expansions[enum.url]
+
+    def term(self, enum: AttributeEnum) -> TermMetadata:
+        """Compile the Value/Code set, once per url and binding strength."""
+        key = (enum.url, enum.binding_strength)
+        term = self._terms.get(key)
+        if term is None:
+            term = self._terms[key] = TermMetadata(
+                url=enum.url,
+                term_def=(
+                    ('term', enum.url),
+                    ('source', 'fhir'),
+                    ('cde_id', enum.url),
+                    ('cde_version', enum.url.split('|')[-1] if '|' in enum.url else None),
+                    ('term_url', enum.url),
+                    ('strength', enum.binding_strength),
+                ),
+                codes=tuple(enum.restricted_to),
+                constrained=enum.binding_strength in CONSTRAINED_BINDINGS,
+            )
+        return term
+
+    def compile_property(self, property_: Property) -> PropertyMetadata:
+        """Compile a property's definition."""
+        description = property_.docstring or ''
+        term = None
+        if property_.enum:
+            term = self.term(property_.enum)
+            description = '. '.join([description, term.url])
+        return PropertyMetadata(flattened_key=property_.flattened_key, json_type=normalize_type(property_.typ),
+                                required=property_.not_optional, description=description, term=term)
+
+    def table(self, entity_schema: EntitySchema) -> Mapping[str, PropertyMetadata]:
+        """Flattened key to metadata, keys are compiled the first time they are seen."""
+        table = self._tables.setdefault(entity_schema.id, {})
+        for flattened_key, property_schema in entity_schema.properties.items():
+            if flattened_key not in table:
+                table[flattened_key] = self.compile_property(property_schema.metadata)
+        return MappingProxyType(table)
+
+
+class CodeViolation(BaseModel):
+    """Values of a property that are not in its required Value/Code set."""
+
+    entity: str
+    """Entity id."""
+    flattened_key: str
+    """The key in a flattened representation."""
+    url: str
+    """Value/Code set url."""
+    count: int = 0
+    """Number of invalid values."""
+    values: List[str] = []
+    """First distinct invalid values, at most MAX_VIOLATION_VALUES."""
+
+    def __str__(self) -> str:
+        """Human friendly summary."""
+        return f"{self.entity}.{self.flattened_key} has {self.count} values not in {self.url}, e.g. {self.values}"
+
+
+class CodeValidator(object):
+    """Check coded values against required bindings, compiles each Value/Code set into a frozenset once."""
+
+    def __init__(self, compiler: MetadataCompiler, max_violations: int = MAX_VIOLATIONS,
+                 max_values: int = MAX_VIOLATION_VALUES) -> None:
+        """No values checked.
+
+        :param compiler: source of Value/Code set codes.
+        :param max_violations: distinct (entity, flattened key) reported.
+        :param max_values: distinct invalid values kept per violation.
+        """
+        self.compiler = compiler
+        self.max_violations = max_violations
+        self.max_values = max_values
+        self.checked = 0
+        """Number of values checked."""
+        self.invalid = 0
+        """Number of values not in their Value/Code set."""
+        self.violations: Dict[Tuple[str, str], CodeViolation] = {}
+        self._members: Dict[str, Optional[FrozenSet[str]]] = {}
+
+    def members(self, enum: AttributeEnum) -> Optional[FrozenSet[str]]:
+        """Codes of the Value/Code set, None if it has no codes to check against."""
+        if enum.url not in self._members:
+            codes = self.compiler.expansion(enum)
+            self._members[enum.url] = frozenset(codes) if codes else None
+            if not codes:
+                logger.debug(f"No codes for {enum.url}, values will not be checked")
+        return self._members[enum.url]
+
+    def check(self, entity_id: str, properties: Dict[str, Property]) -> int:
+        """Check the coded properties of a record, return the number of invalid values."""
+        invalid = 0
+        for flattened_key, property_ in properties.items():
+            enum = property_.enum
+            if enum is None or enum.binding_strength != VALIDATED_BINDING:
+                continue
+            members = self.members(enum)
+            if members is None:
+                continue
+            self.checked += 1
+            if property_.value in members:
+                continue
+            invalid += 1
+            self._violation(entity_id, flattened_key, enum.url, property_.value)
+        self.invalid += invalid
+        return invalid
+
+    def _violation(self, entity_id: str, flattened_key: str, url: str, value) -> None:
+        """Count the invalid value, keep a bounded sample."""
+        key = (entity_id, flattened_key)
+        violation = self.violations.get(key)
+        if violation is None:
+            if len(self.violations) >= self.max_violations:
+                return
+            violation = self.violations[key] = CodeViolation(entity=entity_id, flattened_key=flattened_key, url=url)
+        violation.count += 1
+        value = str(value)
+        if len(violation.values) < self.max_values and value not in violation.values:
+            violation.values.append(value)
+
+    def report(self) -> List[CodeViolation]:
+        """Violations, most frequent first."""
+        return sorted(self.violations.values(), key=lambda violation: violation.count, reverse=True)
+
+    def update_results(self, results: InspectionResults) -> None:
+        """Add counts to info, violations to warnings."""
+        results.info.append(f"'Codes checked': {self.checked}")
+        results.info.append(f"'Codes not in required ValueSet': {self.invalid}")
+        results.warnings.extend(str(violation) for violation in self.report())
+        unreported = self.invalid - sum(violation.count for violation in self.violations.values())
+        if unreported:
+            results.warnings.append(f"{unreported} other values not in their required ValueSet.")
@@ -5,14 +5,16 @@ import json
 import logging
 import os
 from copy import deepcopy
-from typing import Optional, Dict, Any, List, OrderedDict
+from typing import Optional, Dict, Any, List, OrderedDict, Set, TYPE_CHECKING
 
-import requests
 import yaml
 from fhirclient.models.resource import Resource
 from flatten_json import flatten
 from pydantic import BaseModel, PrivateAttr
 
+if TYPE_CHECKING:
+    from pfb_fhir.batch import ColumnarBatch
+
 logger = logging.getLogger(__name__)
 
 
@@ -74,6 +76,8 @@ class FHIRProfileRetriever(object):
                 logger.debug(f'found in cache {file_name}')
                 return json.load(input_)
 
+        import requests
+
         logger.info(f"fetching profile_name {profile_name} {url}")
         response = requests.get(url)
         if response.status_code != 200:
@@ -224,7 +228,66 @@ class Model(BaseModel):
         for entity in needs_adding:
             config['entities'][entity['id']] = entity
 
-        return Model.parse_obj(config)
+        model = Model.parse_obj(config)
+        if not model.dependency_order:
+            model.dependency_order = model.topological_order()
+        return model
+
+    def link_target(self, target_profile: str) -> Optional[str]:
+        """Entity id for a link's targetProfile, None if the target is not in the model."""
+        for entity in self.entities.values():
+            if entity.source and entity.source == target_profile:
+                return entity.id
+        entity_id = target_profile.rstrip('/').split('/')[-1]
+        if entity_id in self.entities:
+            return self.entities[entity_id].id
+        return None
+
+    def topological_order(self) -> List[str]:
+        """Entity ids ordered so that link targets come before the entities that link to them.
+
+        Terra verifies link integrity a page at a time, so targets must be written first.
+        Ties are broken by order in the config file. Self links (e.g. Organization.partOf) are ignored.
+        Cycles are broken by taking the entity in a cycle that appears first in the config file, its links to the
+        other entities in the cycle will refer to records later in the PFB, a warning names those links.
+        """
+        entity_ids = list(dict.fromkeys(entity.id for entity in self.entities.values()))
+        position = {entity_id: index for index, entity_id in enumerate(entity_ids)}
+        depends_on = {entity_id: set() for entity_id in entity_ids}
+        for entity in self.entities.values():
+            for link in (entity.links or {}).values():
+                target = self.link_target(link.targetProfile)
+                if target and target != entity.id:
+                    depends_on[entity.id].add(target)
+
+        ordered = []
+        remaining = set(entity_ids)
+        while remaining:
+            ready = [entity_id for entity_id in remaining if not depends_on[entity_id] & remaining]
+            if not ready:
+                in_cycle = [entity_id for entity_id in remaining if self._reaches(entity_id, entity_id, depends_on, remaining)]
+                entity_id = min(in_cycle, key=position.get)
+                logger.warning(f"Dependency cycle, writing {entity_id} before {sorted(depends_on[entity_id] & remaining)}")
+                ready = [entity_id]
+            entity_id = min(ready, key=position.get)
+            ordered.append(entity_id)
+            remaining.remove(entity_id)
+        return ordered
+
+    @staticmethod
+    def _reaches(source: str, target: str, depends_on: Dict[str, Set[str]], remaining: Set[str]) -> bool:
+        """True if target is reachable from source's dependencies, within remaining."""
+        visited = set()
+        stack = list(depends_on[source] & remaining)
+        while stack:
+            entity_id = stack.pop()
+            if entity_id == target:
+                return True
+            if entity_id in visited:
+                continue
+            visited.add(entity_id)
+            stack.extend(depends_on[entity_id] & remaining)
+        return False
 
     def fetch_profiles(self):
         """Ask entities to recursively fetch their FHIR profiles, add Entities to model."""
@@ -244,6 +307,74 @@ class Context(BaseModel):
     obj: dict = {}
 
 
+class SimplifiedSchemaNode(object):
+    """A path component of the simplified schema, list indices are wildcards."""
+
+    __slots__ = ('schema', 'children', 'template')
+
+    def __init__(self, schema: dict) -> None:
+        """No children resolved."""
+        self.schema = schema
+        """Simplified schema of the path, from the first resource that had it."""
+        self.children: Dict[str, 'SimplifiedSchemaNode'] = {}
+        self.template: Optional[Property] = None
+        """Property with the schema's metadata, value omitted."""
+
+
+class SimplifiedSchemaTrie(object):
+    """Simplified schema of a resource class, shared by all resources of that class.
+
+    The schema of a resource is only consulted for paths not seen before.
+    """
+
+    def __init__(self) -> None:
+        """Empty trie."""
+        self.root = SimplifiedSchemaNode({})
+        self.misses = 0
+        """Number of paths resolved from a resource's schema."""
+
+    @staticmethod
+    def _walk(schema: dict, parts: List[str]) -> dict:
+        """Schema of the path, list indices and unknown components are skipped."""
+        dict_ = schema
+        for part in parts:
+            if part in dict_:
+                dict_ = dict_[part]
+        return dict_
+
+    def resolve(self, flattened_key: str, schema: dict) -> SimplifiedSchemaNode:
+        """Node of a '|' separated key.
+
+        :param flattened_key: key flattened from as_simplified_json().
+        :param schema: simplified schema of the resource, used if the key introduces a new path.
+        """
+        node = self.root
+        parts = flattened_key.split('|')
+        for depth, part in enumerate(parts):
+            if part.isnumeric():
+                # traverse over list index
+                continue
+            child = node.children.get(part)
+            if child is None:
+                self.misses += 1
+                child = node.children[part] = SimplifiedSchemaNode(
+                    self._walk(schema, [part_ for part_ in parts[:depth + 1] if not part_.isnumeric()]))
+            node = child
+        return node
+
+    def property(self, flattened_key: str, value: Any, schema: dict) -> Property:
+        """Property of a '|' separated key."""
+        node = self.resolve(flattened_key, schema)
+        flattened_key = flattened_key.replace('|', '.')
+        if node.template is None:
+            node.template = Property(**node.schema, value=None, flattened_key=flattened_key)
+        return node.template.copy(update={'value': value, 'flattened_key': flattened_key})
+
+
+SIMPLIFIED_SCHEMAS: Dict[type, SimplifiedSchemaTrie] = {}
+"""Resource class to its simplified schema."""
+
+
 class TransformerContext(Context):
     """Typed context."""
     class Config:
@@ -271,17 +402,13 @@ class TransformerContext(Context):
         if self.simplify:
             js, simplified_schema = self.resource.as_simplified_json()
             flattened = flatten(js, separator='|')
+            trie = SIMPLIFIED_SCHEMAS.get(self.resource.__class__)
+            if trie is None:
+                trie = SIMPLIFIED_SCHEMAS[self.resource.__class__] = SimplifiedSchemaTrie()
 
             for flattened_key, value in flattened.items():
-                dict_ = simplified_schema
-                for flattened_key_part in flattened_key.split('|'):
-                    if flattened_key_part not in dict_ and flattened_key_part.isnumeric():
-                        # traverse over list index
-                        continue
-                    if flattened_key_part in dict_:
-                        dict_ = dict_[flattened_key_part]
-                flattened_key = flattened_key.replace('|', '.')
-                self.properties[flattened_key] = Property(**dict_, value=value, flattened_key=flattened_key)
+                property_ = trie.property(flattened_key, value, simplified_schema)
+                self.properties[property_.flattened_key] = property_
         else:
             js = self.resource.as_json(strict=False)
 
@@ -359,12 +486,150 @@ class TransformerContext(Context):
                     )
 
 
+JSON_TYPE_WIDTH = {
+    'boolean': 0,
+    'integer': 1,
+    'number': 2,
+    'string': 3,
+}
+"""Observed json types, narrowest to widest."""
+
+PYTHON_JSON_TYPES = {
+    bool: 'boolean',
+    int: 'integer',
+    float: 'number',
+    str: 'string',
+}
+"""Map python value types to json types, anything else is a string."""
+
+NUMPY_JSON_TYPES = {
+    'b': 'boolean',
+    'i': 'integer',
+    'f': 'number',
+}
+"""Map numpy dtype kinds of unboxed batch columns to json types."""
+
+
+class PropertySchema(BaseModel):
+    """Accumulated statistics for a flattened key."""
+
+    flattened_key: str
+    """The key in a flattened representation."""
+    metadata: Property
+    """FHIR definition, from the first occurrence, value omitted."""
+    json_type: Optional[str] = None
+    """Widest json type observed, None if only nulls observed."""
+    count: int = 0
+    """Number of non null values observed."""
+
+    def widen(self, json_type: str) -> None:
+        """Keep the widest json type observed."""
+        if json_type != self.json_type and JSON_TYPE_WIDTH[json_type] > JSON_TYPE_WIDTH.get(self.json_type, -1):
+            self.json_type = json_type
+
+
+class EntitySchema(BaseModel):
+    """Accumulated schema for an entity, the union of all flattened keys observed."""
+
+    id: str
+    """Entity id."""
+    entity: Entity
+    """Model Entity, category and links."""
+    description: Optional[str]
+    """FHIR documentation for the resource."""
+    count: int = 0
+    """Number of resources observed."""
+    properties: Dict[str, PropertySchema] = {}
+    """Flattened key to statistics, in order first observed."""
+
+    def observe(self, context: 'TransformerContext') -> None:
+        """Update statistics with context's properties."""
+        self.count += 1
+        properties = self.properties
+        for flattened_key, property_ in context.properties.items():
+            property_schema = properties.get(flattened_key)
+            if property_schema is None:
+                property_schema = PropertySchema(flattened_key=flattened_key,
+                                                 metadata=property_.copy(update={'value': None}))
+                properties[flattened_key] = property_schema
+            value = property_.value
+            if value is None:
+                continue
+            property_schema.count += 1
+            property_schema.widen(PYTHON_JSON_TYPES.get(value.__class__, 'string'))
+
+    def observe_batch(self, batch: 'ColumnarBatch') -> None:
+        """Update statistics a column at a time."""
+        self.count += len(batch)
+        properties = self.properties
+        for flattened_key, column in batch.columns.items():
+            property_schema = properties.get(flattened_key)
+            if property_schema is None:
+                property_schema = PropertySchema(flattened_key=flattened_key, metadata=batch.metadata[flattened_key])
+                properties[flattened_key] = property_schema
+            if column.dtype != object:
+                # unboxed, every value present
+                property_schema.count += len(column)
+                property_schema.widen(NUMPY_JSON_TYPES[column.dtype.kind])
+                continue
+            classes = set()
+            for value in column:
+                if value is not None:
+                    property_schema.count += 1
+                    classes.add(value.__class__)
+            for class_ in classes:
+                property_schema.widen(PYTHON_JSON_TYPES.get(class_, 'string'))
+
+    def null_count(self, flattened_key: str) -> int:
+        """Number of resources without a value for flattened_key."""
+        property_schema = self.properties.get(flattened_key)
+        if property_schema is None:
+            return self.count
+        return self.count - property_schema.count
+
+    def columns(self) -> List[str]:
+        """Flattened keys in a stable order, independent of the order resources were observed."""
+        return sorted(self.properties, key=natural_key)
+
+
+def natural_key(flattened_key: str) -> tuple:
+    """Sort key, list indices compare numerically, e.g. name.2 < name.10"""
+    return tuple((0, int(part), '') if part.isnumeric() else (1, 0, part) for part in flattened_key.split('.'))
+
+
+class SchemaAccumulator(BaseModel):
+    """Streaming schema for all entities, single pass over the data."""
+
+    entities: Dict[str, EntitySchema] = {}
+    """Entity id to accumulated schema."""
+
+    def observe(self, context: 'TransformerContext') -> EntitySchema:
+        """Update the schema of context's entity."""
+        entity_schema = self.entities.get(context.entity.id)
+        if entity_schema is None:
+            entity_schema = EntitySchema(id=context.entity.id, entity=context.entity, description=context.resource.__doc__)
+            self.entities[context.entity.id] = entity_schema
+        entity_schema.observe(context)
+        return entity_schema
+
+    def observe_batch(self, batch: 'ColumnarBatch') -> EntitySchema:
+        """Update the schema of the batch's entity."""
+        entity_schema = self.entities.get(batch.entity.id)
+        if entity_schema is None:
+            entity_schema = EntitySchema(id=batch.entity.id, entity=batch.entity, description=batch.description)
+            self.entities[batch.entity.id] = entity_schema
+        entity_schema.observe_batch(batch)
+        return entity_schema
+
+
 class EdgeSummary(BaseModel):
     """Summary of edge in PFB."""
 
     src: str = None
     dst: str = None
     count: int = 0
+    dangling: int = 0
+    """Links whose destination was not found earlier in the PFB."""
 
 
 class EntitySummary(BaseModel):
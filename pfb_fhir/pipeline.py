@@ -0,0 +1,231 @@
+"""Streaming pipeline: stages connected by bounded queues, each stage inline, on a thread or in worker processes."""
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Iterable, Iterator, List, Union
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+STAGE_MODES = ['inline', 'thread', 'process']
+DEFAULT_QUEUE_SIZE = 64
+"""Items buffered between a thread stage and its consumer, or in flight to worker processes."""
+
+_END_OF_ITEMS = object()
+"""Sentinel, the stage is exhausted."""
+
+
+class _Failure(object):
+    """Error raised on a stage's thread, wrapped so an item that is an exception is delivered as an item."""
+
+    def __init__(self, error: BaseException) -> None:
+        """Wrap error."""
+        self.error = error
+
+
+class StageMetrics(BaseModel):
+    """Throughput of a stage, and how long its consumer waited on it."""
+
+    name: str
+    """Stage name."""
+    mode: str
+    """One of STAGE_MODES."""
+    items: int = 0
+    """Number of items the stage yielded."""
+    seconds: float = 0.0
+    """Time spent in the stage, excluding time waiting on its upstream."""
+    stall_seconds: float = 0.0
+    """Time the consumer waited for the stage's queue, thread and process stages only."""
+    max_occupancy: int = 0
+    """High water mark of the stage's queue."""
+
+    @property
+    def items_per_second(self) -> float:
+        """Throughput of the stage."""
+        return self.items / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        """Human friendly summary."""
+        return (f"{self.name} ({self.mode}) items: {self.items} time: {self.seconds:.3f}s "
+                f"items/s: {self.items_per_second:.1f} stall: {self.stall_seconds:.3f}s "
+                f"max occupancy: {self.max_occupancy}")
+
+
+class Stage(object):
+    """A step of a pipeline.
+
+    inline and thread stages are functions from an iterator of items to an iterator of items, so they can keep
+    state, batch, filter or expand. inline stages run lazily on their consumer's thread: an item is handled by
+    every downstream inline stage before the stage resumes. A thread stage runs ahead of its consumer on its own
+    thread, at most queue_size items.
+    process stages map a function over items in worker processes, the function and the items must be picklable;
+    at most queue_size items are in flight, results are yielded in input order.
+    """
+
+    def __init__(self, name: str, function: Callable, mode: str = 'inline', queue_size: int = DEFAULT_QUEUE_SIZE,
+                 processes: int = 2) -> None:
+        """Configure stage.
+
+        :param name: used in metrics and thread names.
+        :param function: iterator to iterator, or for process stages item to item.
+        :param mode: one of STAGE_MODES.
+        :param queue_size: bound of the queue to the consumer, or of the items in flight to worker processes.
+        :param processes: number of worker processes, process stages only.
+        """
+        assert mode in STAGE_MODES, f"mode should be one of {STAGE_MODES}"
+        assert queue_size > 0, "queue_size should be positive"
+        self.name = name
+        self.function = function
+        self.mode = mode
+        self.queue_size = queue_size
+        self.processes = processes
+        self.metrics = StageMetrics(name=name, mode=mode)
+
+    def run(self, items: Iterable) -> Iterator:
+        """Yield the stage's output."""
+        upstream = _TimedIterator(items)
+        if self.mode == 'process':
+            output = self._map_processes(upstream)
+        else:
+            output = self.function(upstream)
+        output = self._timed(output, upstream)
+        if self.mode == 'thread':
+            return self._threaded(output)
+        return output
+
+    def _timed(self, output: Iterator, upstream: '_TimedIterator') -> Iterator:
+        """Count items, accumulate time spent producing them less time spent waiting on upstream."""
+        output = iter(output)
+        while True:
+            start = time.perf_counter()
+            upstream_seconds = upstream.seconds
+            try:
+                item = next(output)
+            except StopIteration:
+                self.metrics.seconds += time.perf_counter() - start - (upstream.seconds - upstream_seconds)
+                return
+            self.metrics.seconds += time.perf_counter() - start - (upstream.seconds - upstream_seconds)
+            self.metrics.items += 1
+            yield item
+
+    def _map_processes(self, items: Iterable) -> Iterator:
+        """Map the function over items in worker processes, in order, at most queue_size in flight."""
+        from concurrent.futures import ProcessPoolExecutor
+
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            for item in items:
+                pending.append(executor.submit(self.function, item))
+                if len(pending) >= self.queue_size:
+                    yield self._result(pending.popleft())
+            while pending:
+                yield self._result(pending.popleft())
+
+    def _result(self, future) -> Any:
+        """Wait for a worker."""
+        start = time.perf_counter()
+        result = future.result()
+        self.metrics.stall_seconds += time.perf_counter() - start
+        return result
+
+    def _threaded(self, output: Iterator) -> Iterator:
+        """Run output on a background thread, deliver items through a bounded queue."""
+        queue_ = queue.Queue(maxsize=self.queue_size)
+        stopped = threading.Event()
+
+        def _put(item) -> bool:
+            """Block until there is room in the queue, or we are stopped."""
+            while not stopped.is_set():
+                try:
+                    queue_.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def _produce() -> None:
+            """Stage thread, stop on first error; always ends with the sentinel or the error."""
+            end: Union[object, _Failure] = _END_OF_ITEMS
+            try:
+                for item in output:
+                    if not _put(item):
+                        return
+            except BaseException as exc:
+                end = _Failure(exc)
+            finally:
+                try:
+                    output.close()
+                except BaseException as exc:
+                    if end is _END_OF_ITEMS:
+                        end = _Failure(exc)
+                _put(end)
+
+        thread = threading.Thread(target=_produce, name=f"pfb_fhir-{self.name}", daemon=True)
+        thread.start()
+        try:
+            while True:
+                self.metrics.max_occupancy = max(self.metrics.max_occupancy, queue_.qsize())
+                start = time.perf_counter()
+                item: Union[Any, _Failure, object] = queue_.get()
+                self.metrics.stall_seconds += time.perf_counter() - start
+                if item is _END_OF_ITEMS:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        finally:
+            stopped.set()
+            thread.join()
+
+
+class _TimedIterator(object):
+    """Accumulate time spent waiting on an iterator."""
+
+    def __init__(self, items: Iterable) -> None:
+        """Wrap items."""
+        self._items = iter(items)
+        self.seconds = 0.0
+
+    def __iter__(self) -> '_TimedIterator':
+        """Iterator."""
+        return self
+
+    def __next__(self) -> Any:
+        """Next item, timed."""
+        start = time.perf_counter()
+        try:
+            return next(self._items)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+
+class Pipeline(object):
+    """Stages connected in order, each consumes the output of the one before.
+
+    Backpressure: thread and process stages hold at most queue_size items, a slow stage blocks its upstream.
+    """
+
+    def __init__(self, stages: List[Stage]) -> None:
+        """Configure pipeline.
+
+        :param stages: in order, the first consumes the source.
+        """
+        assert stages, "A pipeline needs at least one stage"
+        self.stages = stages
+
+    @property
+    def metrics(self) -> List[StageMetrics]:
+        """Per stage metrics, in order."""
+        return [stage.metrics for stage in self.stages]
+
+    def run(self, source: Iterable) -> Iterator:
+        """Stream source through the stages, yield the last stage's output; log metrics when exhausted."""
+        items = source
+        for stage in self.stages:
+            items = stage.run(items)
+        yield from items
+        for metrics in self.metrics:
+            logger.info(f"pipeline {metrics}")
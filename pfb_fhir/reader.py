@@ -0,0 +1,27 @@
+"""Read input files with large sequential reads, see the read stage of cli.transform_stages."""
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_READ_AHEAD = 0
+"""Number of files buffered ahead of the consumer, 0 reads inline."""
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024
+"""Size of each sequential read."""
+
+
+def read_file(file_path: str, block_size: int = DEFAULT_BLOCK_SIZE) -> bytes:
+    """Read the entire file using large sequential reads."""
+    chunks = []
+    with open(file_path, 'rb', buffering=0) as fp:
+        if hasattr(os, 'posix_fadvise'):
+            # hint the kernel (and network filesystems) to read ahead aggressively
+            os.posix_fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            chunk = fp.read(block_size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    if len(chunks) == 1:
+        return chunks[0]
+    return b''.join(chunks)
@@ -0,0 +1,23 @@
+"""Marshall raw json dictionaries into fhirclient.models FHIR resources."""
+import importlib
+
+from fhirclient.models.domainresource import DomainResource
+
+
+def resource_class(resource_type: str) -> type:
+    """The fhirclient.models class of a resource type."""
+    # dynamically import model
+    module_name = f"fhirclient.models.{resource_type.lower()}"
+    module = importlib.import_module(module_name)
+    assert module
+    clazz = getattr(module, resource_type)
+    assert clazz
+    return clazz
+
+
+def instantiate(resource_dict: dict, strict=True) -> DomainResource:
+    """Marshall a json raw dictionary into fhirclient.models FHIR resource."""
+    assert 'resourceType' in resource_dict
+    clazz = resource_class(resource_dict['resourceType'])
+    # create instance
+    return clazz(resource_dict, strict=strict)
@@ -0,0 +1,241 @@
+"""Split PFB records into dependency closed shards."""
+import json
+import logging
+import os
+import pathlib
+import zlib
+from typing import List, Dict, Optional, Tuple, Set
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+SHARD_BY = ['entity', 'size', 'patient']
+"""How records are assigned to shards."""
+DEFAULT_SHARD_SIZE = 256 * 1024 * 1024
+"""Approximate size of a shard in bytes of json records, shard_by=size."""
+DEFAULT_SHARD_COUNT = 8
+"""Number of patient shards, shard_by=patient."""
+
+SHARED = 0
+"""shard_by=patient: records that don't reference a patient, loaded first."""
+
+
+class Shard(BaseModel):
+    """A subset of records, every link target is in this shard or a shard it depends on."""
+
+    path: str = None
+    """PFB file."""
+    spool: str = None
+    """Transient ndjson records, in dependency order."""
+    records: int = 0
+    """Number of records."""
+    bytes: int = 0
+    """Size of json records."""
+    counts: Dict[str, int] = {}
+    """Records per entity."""
+    depends_on: List[int] = []
+    """Shards that must be loaded first (index in manifest)."""
+    level: int = 0
+    """Shards with the same level can be loaded concurrently."""
+
+
+class ShardManifest(BaseModel):
+    """Describes shards and their load order."""
+
+    shard_by: str
+    """entity, size or patient."""
+    shards: List[Shard] = []
+    """In dependency order."""
+
+    @property
+    def load_order(self) -> List[List[str]]:
+        """Shard paths grouped by level, levels must be loaded in order, shards within a level concurrently."""
+        levels = []
+        for shard in self.shards:
+            while len(levels) <= shard.level:
+                levels.append([])
+            levels[shard.level].append(shard.path)
+        return levels
+
+    def write(self, path: str) -> None:
+        """Write manifest, including load_order."""
+        manifest = self.dict(exclude={'shards': {'__all__': {'spool'}}})
+        manifest['load_order'] = self.load_order
+        with open(path, 'w') as fp:
+            json.dump(manifest, fp, indent=2)
+
+
+def shard_base(file_path: str) -> str:
+    """File path without .pfb.avro suffix."""
+    for suffix in ['.pfb.avro', '.avro']:
+        if file_path.endswith(suffix):
+            return file_path[:-len(suffix)]
+    return file_path
+
+
+def manifest_path(file_path: str) -> str:
+    """Location of the manifest."""
+    return f"{shard_base(file_path)}.manifest.json"
+
+
+class _Spooler(object):
+    """Assign records to shards, append them to a transient file per shard."""
+
+    def __init__(self, work_dir: str, shard_by: str, shard_size: int, shard_count: int,
+                 keys: Optional[Set[Tuple[str, str]]] = None) -> None:
+        """Create shards.
+
+        :param keys: if set, every record's (name, id); links to other keys are outside the PFB and ignored.
+        """
+        assert shard_by in SHARD_BY, f"Unknown shard_by {shard_by}, expected one of {SHARD_BY}"
+        self.work_dir = work_dir
+        self.shard_by = shard_by
+        self.shard_size = shard_size
+        self.shard_count = shard_count
+        self.shards: List[Shard] = []
+        self._files = []
+        self._entity_shard: Dict[str, int] = {}
+        self._key_shard: Dict[Tuple[str, str], int] = {}
+        self._depends_on: List[Set[int]] = []
+        self._forward_references: List[Tuple[int, Tuple[str, str]]] = []
+        self._keys = keys
+        pathlib.Path(work_dir).mkdir(parents=True, exist_ok=True)
+        if shard_by == 'patient':
+            # shared, patient buckets, overflow
+            for _ in range(shard_count + 2):
+                self._new_shard()
+
+    @property
+    def overflow(self) -> int:
+        """shard_by=patient: records that reference more than one patient shard, loaded last."""
+        return self.shard_count + 1
+
+    def _new_shard(self) -> int:
+        index = len(self.shards)
+        shard = Shard(spool=os.path.join(self.work_dir, f"{index:05d}.ndjson"))
+        self.shards.append(shard)
+        self._depends_on.append(set())
+        self._files.append(open(shard.spool, 'w'))
+        return index
+
+    def _assign(self, name: str, id_: str, targets: List[Optional[int]], size: int) -> int:
+        """Pick a shard for the record, targets are shards of the link targets, None if not seen yet."""
+        if self.shard_by == 'entity':
+            if name not in self._entity_shard:
+                self._entity_shard[name] = self._new_shard()
+            return self._entity_shard[name]
+        if self.shard_by == 'size':
+            if not self.shards or (self.shards[-1].bytes + size > self.shard_size and self.shards[-1].records > 0):
+                self._new_shard()
+            return len(self.shards) - 1
+        # patient
+        if None in targets:
+            # target not seen yet, only safe if loaded last
+            return self.overflow
+        buckets = set(targets) - {SHARED}
+        if name == 'Patient':
+            bucket = 1 + zlib.crc32(id_.encode()) % self.shard_count
+            # a patient linked to another bucket's records would make the buckets depend on each other
+            return bucket if buckets <= {bucket} else self.overflow
+        if len(buckets) == 0:
+            return SHARED
+        if len(buckets) == 1:
+            return buckets.pop()
+        return self.overflow
+
+    def add(self, line: str) -> None:
+        """Assign record to a shard, spool it."""
+        record = json.loads(line)
+        name, id_ = record['name'], record['id']
+        relations = [(relation['dst_name'], relation['dst_id']) for relation in record.get('relations', [])]
+        if self._keys is not None:
+            relations = [relation for relation in relations if relation in self._keys]
+        targets = [self._key_shard.get(relation) for relation in relations]
+        index = self._assign(name, id_, targets, len(line))
+        self._key_shard[(name, id_)] = index
+        shard = self.shards[index]
+        shard.records += 1
+        shard.bytes += len(line)
+        shard.counts[name] = shard.counts.get(name, 0) + 1
+        self._depends_on[index].update(target for target in targets if target is not None and target != index)
+        # resolved on close, once every record has a shard
+        self._forward_references.extend((index, relation) for relation, target in zip(relations, targets)
+                                        if target is None)
+        self._files[index].write(line if line.endswith('\n') else line + '\n')
+
+    def close(self) -> List[Shard]:
+        """Resolve forward references, drop empty shards, order and renumber by level."""
+        for fp in self._files:
+            fp.close()
+        for index, relation in self._forward_references:
+            target = self._key_shard.get(relation)
+            # targets that are never seen are outside the PFB
+            if target is not None and target != index:
+                self._depends_on[index].add(target)
+        if self.shard_by == 'patient':
+            # overflow may reference targets not seen yet, load it last
+            self._depends_on[self.overflow] = set(range(self.overflow))
+        depends_on = {}
+        for index, shard in enumerate(self.shards):
+            if shard.records == 0:
+                os.unlink(shard.spool)
+                continue
+            depends_on[index] = {dependency for dependency in self._depends_on[index]
+                                 if self.shards[dependency].records > 0}
+        levels = _levels(depends_on)
+        order = sorted(depends_on, key=lambda index: (levels[index], index))
+        renumbered = {index: position for position, index in enumerate(order)}
+        shards = []
+        for index in order:
+            shard = self.shards[index]
+            shard.depends_on = sorted(renumbered[dependency] for dependency in depends_on[index])
+            shard.level = levels[index]
+            shards.append(shard)
+        return shards
+
+
+def _levels(depends_on: Dict[int, Set[int]]) -> Dict[int, int]:
+    """Topological sort: level of each shard, one more than its highest dependency; raise ValueError on a cycle."""
+    levels = {}
+    remaining = dict(depends_on)
+    level = 0
+    while remaining:
+        ready = [index for index, dependencies in remaining.items()
+                 if all(dependency in levels for dependency in dependencies)]
+        if not ready:
+            raise ValueError(f"Shards {sorted(remaining)} depend on each other, records link in a cycle across "
+                             f"shards; try another shard_by or larger shards")
+        for index in ready:
+            levels[index] = level
+            del remaining[index]
+        level += 1
+    return levels
+
+
+def spool_shards(record_paths: List[str], work_dir: str, shard_by: str, shard_size: int = DEFAULT_SHARD_SIZE,
+                 shard_count: int = DEFAULT_SHARD_COUNT) -> List[Shard]:
+    """Assign records to shards.
+
+    :param record_paths: pfb ndjson records, in dependency order.
+    :param work_dir: transient files.
+    :param shard_by: entity, size or patient.
+    :param shard_size: shard_by=size, approximate size of a shard in bytes of json records.
+    :param shard_count: shard_by=patient, number of patient shards.
+    :return: shards in dependency order, spooled but not written.
+    """
+    keys = None
+    if shard_by == 'patient':
+        # a link to a record not seen yet sends the record to overflow, unless the target is outside the PFB
+        keys = set()
+        for record_path in record_paths:
+            with open(record_path) as fp:
+                for line in fp:
+                    record = json.loads(line)
+                    keys.add((record['name'], record['id']))
+    spooler = _Spooler(work_dir, shard_by, shard_size, shard_count, keys=keys)
+    for record_path in record_paths:
+        with open(record_path) as fp:
+            for line in fp:
+                spooler.add(line)
+    return spooler.close()
@@ -0,0 +1,187 @@
+"""Read-only snapshot of expanded value sets, shared by workers without a build step or network."""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from pfb_fhir.terminology.value_sets import ValueSets
+
+logger = logging.getLogger("valuesets")
+
+SNAPSHOT_VERSION = 1
+"""Bump when the snapshot tables change, older snapshots are ignored."""
+SNAPSHOT_FILE_NAME = f"terminology-v{SNAPSHOT_VERSION}.sqlite"
+"""Default name of the snapshot in PFB_FHIR_CACHE_PATH."""
+
+_create_expansions_table_sql = """
+-- codes of each value set, keyed by fullUrl and canonical url
+CREATE TABLE expansions (
+    url text PRIMARY KEY,
+    codes json NOT NULL
+) WITHOUT ROWID;
+"""
+
+_create_meta_table_sql = """
+-- snapshot version and provenance
+CREATE TABLE meta (
+    key text PRIMARY KEY,
+    value text
+) WITHOUT ROWID;
+"""
+
+
+def snapshot_path() -> Path:
+    """Location of the snapshot, PFB_FHIR_TERMINOLOGY_PATH or SNAPSHOT_FILE_NAME in PFB_FHIR_CACHE_PATH."""
+    path = os.environ.get("PFB_FHIR_TERMINOLOGY_PATH")
+    if path:
+        return Path(path)
+    return Path(os.environ.get("PFB_FHIR_CACHE_PATH", 'cache'), SNAPSHOT_FILE_NAME)
+
+
+def _file_hash(path: Path, block_size: int = 1024 * 1024) -> str:
+    """sha256 of the file's content."""
+    hash_ = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(block_size), b''):
+            hash_.update(chunk)
+    return hash_.hexdigest()
+
+
+def _file_stat(path: Path) -> Dict[str, str]:
+    """Size, modification time and inode of the file, changed by a rebuild without reading its content."""
+    stat = os.stat(path)
+    return {'source_size': str(stat.st_size), 'source_mtime_ns': str(stat.st_mtime_ns),
+            'source_inode': str(stat.st_ino)}
+
+
+def build_snapshot(value_sets: ValueSets, path: Path) -> Dict[str, str]:
+    """Expand every ValueSet and write the snapshot, return its meta data.
+
+    The snapshot is written next to path and renamed, readers never see a partial file.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    source = sqlite3.connect(value_sets.database_file_name)
+    value_set_urls = source.execute(
+        "SELECT fullUrl, url FROM valuesets WHERE type='ValueSet' ORDER BY fullUrl").fetchall()
+    source.close()
+
+    rows = []
+    skipped = 0
+    for full_url, url in value_set_urls:
+        try:
+            codes = value_sets.codes(full_url)
+        except (KeyError, TypeError, AssertionError) as e:
+            logger.debug(f"Skipping {full_url} {e.__class__.__name__} {e}")
+            codes = None
+        if codes is None:
+            skipped += 1
+            continue
+        rows.append((full_url, json.dumps(codes)))
+        if url != full_url:
+            rows.append((url, rows[-1][1]))
+
+    meta = {
+        'version': str(SNAPSHOT_VERSION),
+        'created': datetime.now(timezone.utc).isoformat(),
+        'source': str(value_sets.database_file_name),
+        'source_sha256': _file_hash(value_sets.database_file_name),
+        **_file_stat(value_sets.database_file_name),
+        'value_sets': str(len(value_set_urls) - skipped),
+        'skipped': str(skipped),
+    }
+
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    if tmp_path.exists():
+        tmp_path.unlink()
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute(_create_expansions_table_sql)
+        conn.execute(_create_meta_table_sql)
+        # fullUrl rows first, a canonical url shared by several value sets resolves to the first
+        conn.executemany("INSERT OR IGNORE INTO expansions VALUES (?, ?)", rows)
+        conn.executemany("INSERT INTO meta VALUES (?, ?)", meta.items())
+        conn.commit()
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+    logger.info(f"Wrote {meta['value_sets']} value sets to {path}, skipped {skipped}")
+    return meta
+
+
+class TerminologySnapshot(object):
+    """Lookup expanded value sets from a snapshot, opened read-only and memory mapped.
+
+    Same `codes` lookup as ValueSets, the connection is opened on first use and not pickled,
+    so an instance can be handed to worker processes.
+    """
+
+    def __init__(self, path: Path) -> None:
+        """Check the snapshot version.
+
+        :param path: snapshot written by build_snapshot.
+        """
+        self.path = Path(path)
+        self._conn: Optional[sqlite3.Connection] = None
+        self.meta = dict(self._connection().execute("SELECT key, value FROM meta").fetchall())
+        if self.meta.get('version') != str(SNAPSHOT_VERSION):
+            raise ValueError(f"{self.path} is version {self.meta.get('version')}, expected {SNAPSHOT_VERSION}")
+
+    def _connection(self) -> sqlite3.Connection:
+        """Read-only connection, immutable: no locks or journal, pages shared through the os page cache."""
+        if self._conn is None:
+            uri = f"{self.path.resolve().as_uri()}?mode=ro&immutable=1"
+            self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            self._conn.execute(f"PRAGMA mmap_size={os.path.getsize(self.path)}")
+        return self._conn
+
+    def __getstate__(self) -> dict:
+        """Pickle without the connection."""
+        return {'path': self.path, 'meta': self.meta, '_conn': None}
+
+    def codes(self, fullUrl) -> Optional[List[str]]:
+        """Get all codes for valueset, None if it is not in the snapshot."""
+        row = self._connection().execute(
+            "SELECT codes FROM expansions WHERE url=?", [fullUrl.split('|')[0]]).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def __len__(self) -> int:
+        """Number of urls."""
+        return self._connection().execute("SELECT count(*) FROM expansions").fetchone()[0]
+
+    def is_stale(self, verify: bool = False) -> bool:
+        """True if the source database changed since the snapshot was built, unknown (a missing source) is current.
+
+        :param verify: also compare the content hash, otherwise size, modification time and inode.
+        """
+        source = self.meta.get('source')
+        if not source or not os.path.isfile(source):
+            return False
+        if any(self.meta.get(key) != value for key, value in _file_stat(Path(source)).items()):
+            return True
+        return verify and _file_hash(Path(source)) != self.meta.get('source_sha256')
+
+
+def open_value_sets(verify: bool = False):
+    """The snapshot if there is a current one, otherwise ValueSets (built, and if need be downloaded, on first use).
+
+    :param verify: also compare the content hash of the source database, see TerminologySnapshot.is_stale.
+    """
+    path = snapshot_path()
+    if path.is_file():
+        try:
+            snapshot = TerminologySnapshot(path)
+            if not snapshot.is_stale(verify=verify):
+                return snapshot
+            logger.warning(f"Ignoring terminology snapshot {path}, "
+                           f"{snapshot.meta['source']} changed since it was built")
+        except (ValueError, sqlite3.DatabaseError) as e:
+            logger.warning(f"Ignoring terminology snapshot {e}")
+    return ValueSets()
@@ -3,7 +3,7 @@
 import sqlite3
 import json
 import logging
-from typing import List
+from typing import List, Dict, Iterator, Tuple
 
 import pkg_resources
 import requests
@@ -31,6 +31,38 @@ CREATE TABLE IF NOT EXISTS valuesets (
 );
 """
 
+_create_concepts_table_sql = """
+-- CodeSystem concepts, flattened in pre-order
+CREATE TABLE IF NOT EXISTS concepts (
+    system text NOT NULL,
+    code text NOT NULL,
+    position integer NOT NULL,
+    concept json,
+    PRIMARY KEY (system, code)
+);
+"""
+
+_create_closure_table_sql = """
+-- CodeSystem hierarchy, every (ancestor, descendant) pair, a concept is not its own ancestor
+CREATE TABLE IF NOT EXISTS closure (
+    system text NOT NULL,
+    ancestor text NOT NULL,
+    descendant text NOT NULL,
+    PRIMARY KEY (system, ancestor, descendant)
+);
+"""
+
+_descendants_sql = """
+SELECT concepts.concept FROM closure
+JOIN concepts ON concepts.system = closure.system AND concepts.code = closure.descendant
+WHERE closure.system = ? AND closure.ancestor = ?
+ORDER BY concepts.position;
+"""
+
+_not_self_sql = """
+SELECT concept FROM concepts WHERE system = ? AND code != ? ORDER BY position;
+"""
+
 
 def _get_config():
     """Load our default configuration."""
@@ -60,6 +92,66 @@ def _resource_count(database_path):
     return data['resource_count']
 
 
+def _hierarchy(concepts: List[dict]) -> Iterator[Tuple[dict, List[str]]]:
+    """Yield concepts in pre-order with their parent codes, from nesting and subsumedBy properties."""
+    stack = [(concept, None) for concept in reversed(concepts)]
+    while stack:
+        concept, parent = stack.pop()
+        parents = [parent] if parent else []
+        parents.extend(property_['valueCode'] for property_ in concept.get('property', [])
+                       if property_.get('code') == 'subsumedBy' and 'valueCode' in property_)
+        yield concept, parents
+        stack.extend((child, concept['code']) for child in reversed(concept.get('concept', [])))
+
+
+def _closure(parents: Dict[str, List[str]]) -> Iterator[Tuple[str, str]]:
+    """Yield (ancestor, descendant) pairs, walks up from each code."""
+    for code in parents:
+        ancestors = set()
+        pending = list(parents[code])
+        while pending:
+            ancestor = pending.pop()
+            if ancestor in ancestors or ancestor == code:
+                continue
+            ancestors.add(ancestor)
+            pending.extend(parents.get(ancestor, []))
+        for ancestor in ancestors:
+            yield ancestor, code
+
+
+def _index_code_system(conn, url: str, resource: dict) -> int:
+    """Replace the concepts and closure of a CodeSystem, return number of concepts."""
+    conn.execute("DELETE FROM concepts WHERE system=?", [url])
+    conn.execute("DELETE FROM closure WHERE system=?", [url])
+    parents: Dict[str, List[str]] = {}
+    rows = []
+    for concept, concept_parents in _hierarchy(resource.get('concept', [])):
+        if concept['code'] not in parents:
+            parents[concept['code']] = []
+            flat = {k: v for k, v in concept.items() if k != 'concept'}
+            rows.append([url, concept['code'], len(rows), json.dumps(flat)])
+        parents[concept['code']].extend(concept_parents)
+    conn.executemany("insert into concepts values (?, ?, ?, ?)", rows)
+    conn.executemany("insert into closure values (?, ?, ?)",
+                     ([url, ancestor, descendant] for ancestor, descendant in _closure(parents)))
+    return len(rows)
+
+
+def _index(conn) -> None:
+    """Create the concepts and closure tables from all CodeSystems."""
+    _create_table(conn, _create_concepts_table_sql)
+    _create_table(conn, _create_closure_table_sql)
+    code_systems = conn.execute("SELECT url, resource FROM valuesets WHERE type='CodeSystem'").fetchall()
+    for url, resource in code_systems:
+        _index_code_system(conn, url, json.loads(resource))
+    conn.commit()
+
+
+def _is_indexed(conn) -> bool:
+    """True if the closure table exists, databases built by older versions don't have it."""
+    return conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='closure'").fetchone() is not None
+
+
 def _load(database_path, json_path):
     """Load the json into a sqlite table"""
 
@@ -89,6 +181,9 @@ def _load(database_path, json_path):
         resource_count += 1
         conn.commit()
 
+    # hierarchy of all code systems, queried by filters
+    _index(conn)
+
     # no longer need json
     os.unlink(json_path)
     return resource_count
@@ -128,6 +223,9 @@ def _load_curated(database_path, valueset_config):
 
     # logger.debug(f"{type_}, {id_}, {fullUrl}, {url}")
     c.execute("replace into valuesets values (?, ?, ?, ?, ?)", [fullUrl, type_, id_, url, json.dumps(codesystem)])
+    _create_table(conn, _create_concepts_table_sql)
+    _create_table(conn, _create_closure_table_sql)
+    _index_code_system(conn, url, codesystem)
     conn.commit()
 
 
@@ -194,6 +292,11 @@ class ValueSets(object):
                 _load_curated(self.database_file_name, valueset)
         else:
             self.resource_count = _resource_count(self.database_file_name)
+            conn = _create_connection(self.database_file_name)
+            if not _is_indexed(conn):
+                logger.debug(f"Indexing code systems in {self.database_file_name}")
+                _index(conn)
+            conn.close()
 
     def resource(self, fullUrl):
         """Lookup valueset, fetch referenced includes."""
@@ -245,22 +348,7 @@ class ValueSets(object):
                     filter_op = filter['op']
                     if filter_op not in ['is-a', 'is-not-a', 'descendent-of']:
                         logger.error(f"UNSUPPORTED FILTER OP {fullUrl} {filter_op}")
-                    filtered_concepts = []
-                    for concept in included_concepts:
-                        if 'property' in concept and filter_op == 'is-a':
-                            is_subsumed_by = next(iter([p for p in concept['property'] if p['code'] == 'subsumedBy' and p['valueCode'] == filter_value]), None)
-                            if is_subsumed_by:
-                                filtered_concepts.append(concept)
-                                # we need to drill down at least one level
-                                parent_code = concept['code']
-                                self._drill_down(filtered_concepts, included_concepts, parent_code)
-                                continue
-                        if concept['code'] == filter_value and (filter_op == 'is-a' or filter_op == 'descendent-of'):
-                            if 'concept' in concept:
-                                filtered_concepts = concept['concept']
-                                continue
-                        if concept['code'] != filter_value and filter_op == 'is-not-a':
-                            filtered_concepts.append(concept)
+                    filtered_concepts = self._filter(c, included_data['url'], filter_op, filter_value)
                     if len(filtered_concepts) > 0:
                         included_concepts = filtered_concepts
                 accumulated_concepts.extend(included_concepts)
@@ -271,16 +359,19 @@ class ValueSets(object):
 
         return data['resource']
 
-    def _drill_down(self, filtered_concepts, included_concepts, parent_code):
-        """Find all subsumed children, add to filtered concepts"""
-        for child_concept in included_concepts:
-            is_subsumed_by_parent = next(iter([p for p in child_concept['property'] if
-                                               p['code'] == 'subsumedBy' and p[
-                                                   'valueCode'] == parent_code]), None)
-            if is_subsumed_by_parent:
-                filtered_concepts.append(child_concept)
-                # recurse
-                self._drill_down(filtered_concepts, included_concepts, child_concept['code'])
+    @staticmethod
+    def _filter(cursor, system, filter_op, filter_value) -> List[dict]:
+        """Concepts of the code system matching the filter, from the closure table.
+
+        is-a and descendent-of: descendants of filter_value, is-not-a: all concepts except filter_value.
+        """
+        if filter_op in ['is-a', 'descendent-of']:
+            rows = cursor.execute(_descendants_sql, [system, filter_value]).fetchall()
+        elif filter_op == 'is-not-a':
+            rows = cursor.execute(_not_self_sql, [system, filter_value]).fetchall()
+        else:
+            return []
+        return [json.loads(row['concept']) for row in rows]
 
     def codes(self, fullUrl) -> List[str]:
         """Get all codes for valueset."""
@@ -0,0 +1,388 @@
+"""Skip re-transforming resources that haven't changed, rendered PFB records keyed by a hash of the resource."""
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from collections import deque
+from functools import partial
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, Optional
+
+from pydantic import BaseModel
+
+from pfb_fhir.model import Model, Property, TransformerContext
+from pfb_fhir.pipeline import DEFAULT_QUEUE_SIZE, _Failure
+from pfb_fhir.resources import resource_class
+from pfb_fhir.transform_pool import MetadataKey, contained_type, rebuild_property
+
+logger = logging.getLogger(__name__)
+
+TRANSFORM_CACHE_VERSION = 3
+"""Bump when the entries change, or when rendering changes in a way the code hash doesn't capture."""
+TRANSFORM_CACHE_FILE_NAME = "transform.sqlite"
+"""Default name of the cache in PFB_FHIR_CACHE_PATH."""
+COMMIT_INTERVAL = 1000
+"""Entries written per transaction."""
+KEEP_NAMESPACES = 4
+"""Most recently used namespaces kept, entries of older ones are evicted when the cache is opened."""
+CODE_FILES = ['common.py', 'context_simplifier.py', 'emitter.py', 'metadata.py', 'model.py', 'resources.py',
+              'transform_cache.py', 'transform_pool.py']
+"""Modules that transform or render records, part of the namespace."""
+
+_END_OF_MISSES = object()
+"""Sentinel, no more resources to transform."""
+
+_create_records_table_sql = """
+-- rendered PFB record and flattened properties, keyed by namespace and content hash
+CREATE TABLE IF NOT EXISTS records (
+    namespace text NOT NULL,
+    key blob NOT NULL,
+    entry json NOT NULL,
+    PRIMARY KEY (namespace, key)
+) WITHOUT ROWID;
+"""
+
+_create_namespaces_table_sql = """
+-- last use of each namespace, least recently used are evicted
+CREATE TABLE IF NOT EXISTS namespaces (
+    namespace text PRIMARY KEY,
+    used real NOT NULL
+) WITHOUT ROWID;
+"""
+
+_create_metadata_table_sql = """
+-- property metadata, value omitted
+CREATE TABLE IF NOT EXISTS metadata (
+    namespace text NOT NULL,
+    resource_type text NOT NULL,
+    flattened_key text NOT NULL,
+    -- type of the contained resource a contained.* key belongs to, empty otherwise
+    contained_type text NOT NULL,
+    property json NOT NULL,
+    PRIMARY KEY (namespace, resource_type, flattened_key, contained_type)
+) WITHOUT ROWID;
+"""
+
+
+def transform_cache_path() -> Path:
+    """Default location of the cache."""
+    return Path(os.environ.get("PFB_FHIR_CACHE_PATH", 'cache'), TRANSFORM_CACHE_FILE_NAME)
+
+
+def transform_namespace(model: Model, simplify: bool, strict: bool) -> str:
+    """Hash of everything other than the resource that determines its record: model, flags and code."""
+    from fhirclient import client
+
+    hash_ = hashlib.sha256()
+    hash_.update(model.json().encode())
+    hash_.update(f"{simplify} {strict} {TRANSFORM_CACHE_VERSION} {client.__version__}".encode())
+    package_path = Path(__file__).parent
+    for file_name in CODE_FILES:
+        hash_.update(Path(package_path, file_name).read_bytes())
+    return hash_.hexdigest()
+
+
+class TransformCacheMetrics(BaseModel):
+    """Hits and misses of a run."""
+
+    hits: int = 0
+    """Records read from the cache."""
+    misses: int = 0
+    """Resources transformed."""
+    written: int = 0
+    """Records written to the cache."""
+    uncacheable: int = 0
+    """Records not written, their links were resolved through identifiers of other records."""
+    unrendered: int = 0
+    """Records not written, no emitter rendered them."""
+    evicted: int = 0
+    """Namespaces evicted when the cache was opened."""
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of resources read from the cache."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __str__(self) -> str:
+        """Human friendly summary."""
+        return (f"hits: {self.hits} misses: {self.misses} hit rate: {self.hit_rate:.1%} "
+                f"written: {self.written} uncacheable: {self.uncacheable} unrendered: {self.unrendered} "
+                f"evicted: {self.evicted}")
+
+
+class TransformCache(object):
+    """Rendered PFB records and flattened properties, keyed by a hash of the canonical resource json.
+
+    A hit yields a context with the cached record in `obj['pfb_record']` as soon as it is looked up, emitters
+    write it through. Misses are transformed on a background thread, a miss yields the transformed context with
+    a callback in `obj['on_render']`, the emitter that renders the record calls it (on any thread) to write the
+    record back.
+    Records whose links were resolved through other records' identifiers are not cached.
+    """
+
+    def __init__(self, path: Path, namespace: str, simplify: bool = False,
+                 keep_namespaces: int = KEEP_NAMESPACES, queue_size: int = DEFAULT_QUEUE_SIZE) -> None:
+        """Open or create the cache, evict the least recently used namespaces.
+
+        :param path: sqlite file.
+        :param namespace: see transform_namespace, entries of other namespaces are ignored.
+        :param simplify: properties are typed by the simplified schema, not their value.
+        :param keep_namespaces: most recently used namespaces kept, including this one.
+        :param queue_size: misses handed to the transform, and transformed contexts waiting for the consumer.
+        """
+        assert keep_namespaces > 0, "keep_namespaces should be positive"
+        assert queue_size > 0, "queue_size should be positive"
+        self.queue_size = queue_size
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.namespace = namespace
+        self.simplify = simplify
+        self.metrics = TransformCacheMetrics()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._create_tables()
+        self._evict(keep_namespaces)
+        self._digest_key = bytes.fromhex(namespace)[:64]
+        self._metadata: Dict[MetadataKey, Property] = {}
+        self._empty_resources = {}
+        self._uncommitted = 0
+        self._unrendered = 0
+
+    def _create_tables(self) -> None:
+        """Create the tables, drop those of another cache version."""
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != TRANSFORM_CACHE_VERSION:
+            if version:
+                logger.info(f"Dropping transform cache version {version}, expected {TRANSFORM_CACHE_VERSION}")
+            for table in ['records', 'metadata', 'namespaces']:
+                self._conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self._conn.commit()
+            # freed pages are returned to the file system on eviction, takes effect once rebuilt
+            self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self._conn.execute("VACUUM")
+            self._conn.execute(f"PRAGMA user_version={TRANSFORM_CACHE_VERSION}")
+        self._conn.execute(_create_records_table_sql)
+        self._conn.execute(_create_metadata_table_sql)
+        self._conn.execute(_create_namespaces_table_sql)
+
+    def _evict(self, keep_namespaces: int) -> None:
+        """Mark the namespace as used, delete the entries of all but the keep_namespaces most recently used."""
+        self._conn.execute("REPLACE INTO namespaces VALUES (?, julianday('now'))", [self.namespace])
+        evicted = [row[0] for row in self._conn.execute(
+            "SELECT namespace FROM namespaces ORDER BY used DESC LIMIT -1 OFFSET ?", [keep_namespaces])]
+        for namespace in evicted:
+            for table in ['records', 'metadata', 'namespaces']:
+                self._conn.execute(f"DELETE FROM {table} WHERE namespace=?", [namespace])
+        self._conn.commit()
+        if evicted:
+            self._conn.execute("PRAGMA incremental_vacuum")
+            logger.info(f"Evicted {len(evicted)} transform cache namespaces")
+        self.metrics.evicted = len(evicted)
+
+    def __enter__(self) -> 'TransformCache':
+        """Context manager."""
+        return self
+
+    def __exit__(self, *args) -> None:
+        """Commit and close."""
+        self.close()
+
+    def close(self) -> None:
+        """Commit pending entries, close the file, log metrics."""
+        with self._lock:
+            if self._conn is None:
+                return
+            self._conn.commit()
+            self._conn.close()
+            self._conn = None
+        if self._unrendered:
+            self.metrics.unrendered += self._unrendered
+            logger.warning(f"{self._unrendered} transformed records were not rendered by an emitter, not cached")
+            self._unrendered = 0
+        logger.info(f"transform cache {self.metrics}")
+
+    def key(self, resource_dict: dict) -> bytes:
+        """Keyed hash of the canonical json, keys sorted and no whitespace."""
+        canonical = json.dumps(resource_dict, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.blake2b(canonical.encode(), digest_size=20, key=self._digest_key).digest()
+
+    def get(self, key: bytes) -> Optional[dict]:
+        """Entry, None if missing."""
+        with self._lock:
+            row = self._conn.execute("SELECT entry FROM records WHERE namespace=? AND key=?",
+                                     [self.namespace, key]).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: bytes, context: TransformerContext) -> bool:
+        """Write the rendered record and properties of a transformed context, return False if not cacheable."""
+        if 'pfb_record' not in context.obj or context.obj.get('aliased'):
+            with self._lock:
+                self.metrics.uncacheable += 1
+            return False
+        resource = context.resource
+        resource_type = resource.resource_type
+        properties = [
+            (flattened_key, contained_type(resource, flattened_key) if resource.contained else None, property_)
+            for flattened_key, property_ in context.properties.items()
+        ]
+        entry = {
+            'resource_type': resource_type,
+            'record': context.obj['pfb_record'],
+            'properties': [[flattened_key, contained_type_, property_.value]
+                           for flattened_key, contained_type_, property_ in properties],
+        }
+        with self._lock:
+            for flattened_key, contained_type_, property_ in properties:
+                if (resource_type, flattened_key, contained_type_) not in self._metadata:
+                    metadata = property_.copy(update={'value': None})
+                    self._metadata[(resource_type, flattened_key, contained_type_)] = metadata
+                    self._conn.execute("REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)",
+                                       [self.namespace, resource_type, flattened_key, contained_type_ or '',
+                                        metadata.json()])
+            self._conn.execute("REPLACE INTO records VALUES (?, ?, ?)", [self.namespace, key, json.dumps(entry)])
+            self.metrics.written += 1
+            self._uncommitted += 1
+            if self._uncommitted >= COMMIT_INTERVAL:
+                self._conn.commit()
+                self._uncommitted = 0
+        return True
+
+    def _rendered(self, key: bytes, context: TransformerContext) -> bool:
+        """Callback of a miss, put once the emitter has rendered the record."""
+        with self._lock:
+            self._unrendered -= 1
+        return self.put(key, context)
+
+    def _property_metadata(self, resource_type: str, flattened_key: str, contained_type_: Optional[str]) -> Property:
+        """Metadata seen this run, or written by a previous one."""
+        metadata_key = (resource_type, flattened_key, contained_type_)
+        metadata = self._metadata.get(metadata_key)
+        if metadata is None:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT property FROM metadata WHERE namespace=? AND resource_type=? AND flattened_key=? "
+                    "AND contained_type=?",
+                    [self.namespace, resource_type, flattened_key, contained_type_ or '']).fetchone()
+            assert row, f"No metadata for {resource_type}.{flattened_key}"
+            metadata = self._metadata[metadata_key] = Property.parse_raw(row[0])
+        return metadata
+
+    def _empty_resource(self, resource_type: str):
+        """Resource without data, emitters use its type and documentation."""
+        if resource_type not in self._empty_resources:
+            self._empty_resources[resource_type] = resource_class(resource_type)()
+        return self._empty_resources[resource_type]
+
+    def context(self, model: Model, entry: dict) -> TransformerContext:
+        """Context of a hit, the record is written through by the emitters."""
+        resource_type = entry['resource_type']
+        properties = {
+            flattened_key: rebuild_property(self._property_metadata(resource_type, flattened_key, contained_type_),
+                                            value, self.simplify)
+            for flattened_key, contained_type_, value in entry['properties']
+        }
+        return TransformerContext.construct(resource=self._empty_resource(resource_type), properties=properties,
+                                            simplify=self.simplify, entity=model.entities[resource_type],
+                                            obj={'pfb_record': entry['record']})
+
+    def contexts(self, model: Model, resource_dicts: Iterable[dict],
+                 transform: Callable[[Iterable[dict]], Iterator[TransformerContext]]) -> Iterator[TransformerContext]:
+        """Yield a context per resource: a hit as soon as it is looked up, a miss once transform yields it.
+
+        Misses are handed to transform, running on a background thread, through a queue of at most queue_size
+        resources; only the keys of misses in flight are kept. A hit may be yielded ahead of earlier misses.
+
+        :param transform: contexts of the misses, in order; may read ahead of what it yields.
+        """
+        in_flight = deque()
+        handoff = queue.Queue(maxsize=self.queue_size)
+        transformed = queue.Queue(maxsize=self.queue_size)
+        stopped = threading.Event()
+
+        def _put(queue_: queue.Queue, item) -> bool:
+            """Block until there is room in the queue, or we are stopped."""
+            while not stopped.is_set():
+                try:
+                    queue_.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def _misses() -> Iterator[dict]:
+            """Resources handed off by the consumer."""
+            while not stopped.is_set():
+                try:
+                    resource_dict = handoff.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if resource_dict is _END_OF_MISSES:
+                    return
+                yield resource_dict
+
+        def _transform() -> None:
+            """Transform thread, always ends with the sentinel or the error."""
+            end = _END_OF_MISSES
+            outputs = transform(_misses())
+            try:
+                for context in outputs:
+                    if not _put(transformed, context):
+                        return
+            except BaseException as exc:
+                end = _Failure(exc)
+            finally:
+                if hasattr(outputs, 'close'):
+                    outputs.close()
+                _put(transformed, end)
+
+        def _transformed(wait: bool) -> Iterator[TransformerContext]:
+            """Yield the misses transform has yielded, if wait until none are in flight."""
+            while in_flight:
+                try:
+                    context = transformed.get() if wait else transformed.get_nowait()
+                except queue.Empty:
+                    return
+                if isinstance(context, _Failure):
+                    raise context.error
+                assert context is not _END_OF_MISSES, f"transform ended with {len(in_flight)} misses in flight"
+                key = in_flight.popleft()
+                self.metrics.misses += 1
+                with self._lock:
+                    self._unrendered += 1
+                context.obj['on_render'] = partial(self._rendered, key)
+                yield context
+
+        def _hand_off(item) -> Iterator[TransformerContext]:
+            """Put item in the handoff queue, yield transformed misses while it is full."""
+            while True:
+                try:
+                    handoff.put(item, timeout=0.01)
+                    return
+                except queue.Full:
+                    yield from _transformed(wait=False)
+
+        thread = threading.Thread(target=_transform, name='pfb_fhir-transform_cache', daemon=True)
+        thread.start()
+        try:
+            for resource_dict in resource_dicts:
+                key = self.key(resource_dict)
+                entry = self.get(key)
+                if entry is not None:
+                    self.metrics.hits += 1
+                    yield self.context(model, entry)
+                else:
+                    in_flight.append(key)
+                    yield from _hand_off(resource_dict)
+                yield from _transformed(wait=False)
+            yield from _hand_off(_END_OF_MISSES)
+            yield from _transformed(wait=True)
+            end = transformed.get()
+            if isinstance(end, _Failure):
+                raise end.error
+        finally:
+            stopped.set()
+            thread.join()
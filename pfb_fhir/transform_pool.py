@@ -0,0 +1,233 @@
+"""Transform resources in a pool of processes, only keys and values cross the process boundary."""
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from fhirclient.models.domainresource import DomainResource
+from pydantic import BaseModel
+
+from pfb_fhir.model import Model, Property, TransformerContext
+from pfb_fhir.resources import instantiate
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROCESSES = 1
+"""Transform on the calling process."""
+DEFAULT_TRANSFORM_BATCH_SIZE = 500
+"""Resources per task sent to a worker."""
+BATCHES_PER_PROCESS = 2
+"""Batches in flight per worker, bounds memory while keeping workers busy."""
+EMITTER_ELEMENTS = ('id', 'identifier', 'content')
+"""Elements emitters read from the resource itself, besides the entity's links."""
+
+MetadataKey = Tuple[str, str, Optional[str]]
+"""(resource type, flattened key, contained resource type), the metadata of a key depends on all three."""
+
+_SENT: Dict[str, Set[MetadataKey]] = {}
+"""Per worker process: run id to metadata keys whose metadata was already returned."""
+
+
+class TransformedBatch(BaseModel):
+    """Properties of a batch of resources, in compact form."""
+
+    metadata: Dict[MetadataKey, Property] = {}
+    """Metadata key to FHIR definition, value omitted; only keys new to the worker."""
+    keys: List[Tuple[str, Optional[str]]] = []
+    """(flattened key, contained resource type) used by rows."""
+    rows: List[Tuple[Tuple[int, ...], Tuple[Any, ...]]] = []
+    """Per resource: (indices into keys, values)."""
+    resources: List[Any] = []
+    """Per resource: the elements emitters read, see skeleton."""
+    seconds: float = 0.0
+    """Time the worker spent transforming."""
+
+
+def rebuild_property(metadata: Property, value: Any, simplify: bool) -> Property:
+    """Property from its metadata and a value, same as TransformerContext would create."""
+    update = {'value': value}
+    if not simplify:
+        # the simplified schema types keys, otherwise the value does
+        update['typ'] = value.__class__.__name__
+    return metadata.copy(update=update)
+
+
+def contained_type(resource: DomainResource, flattened_key: str) -> Optional[str]:
+    """Resource type of the contained resource a flattened key belongs to, None if it isn't in one."""
+    parts = flattened_key.split('.', 2)
+    if parts[0] != 'contained' or len(parts) < 2 or not parts[1].isnumeric():
+        return None
+    contained = resource.contained or []
+    index = int(parts[1])
+    return contained[index].resource_type if index < len(contained) else None
+
+
+def emitter_elements(model: Model) -> Dict[str, List[str]]:
+    """Resource type to the names of the elements emitters read: EMITTER_ELEMENTS and the entity's links."""
+    return {
+        resource_type: list(EMITTER_ELEMENTS) + [name for link_key in entity.links
+                                                 for name in [link_key, f"{link_key}_fhir"]]
+        for resource_type, entity in model.entities.items()
+    }
+
+
+def skeleton(resource: DomainResource, names: List[str]) -> DomainResource:
+    """Resource with only the named elements, cheaper to send back from a worker than to marshal again."""
+    skeleton_ = resource.__class__()
+    for name in names:
+        value = getattr(resource, name, None)
+        if value is None:
+            continue
+        for element in value if isinstance(value, list) else [value]:
+            # don't pickle the whole resource with its elements
+            if hasattr(element, '_owner'):
+                element._owner = skeleton_
+        setattr(skeleton_, name, value)
+    if resource.contained:
+        # empty, the metadata of contained.* keys depends on their type
+        skeleton_.contained = [contained.__class__() for contained in resource.contained]
+    return skeleton_
+
+
+def transform_batch(run_id: str, resources: List[dict], simplify: bool, strict: bool,
+                    elements: Dict[str, List[str]]) -> TransformedBatch:
+    """Marshall and flatten resources, return keys, values, skeletons and the metadata of keys not sent before.
+
+    :param elements: resource type to the elements emitters read, see emitter_elements.
+    """
+    start = time.perf_counter()
+    sent = _SENT.setdefault(run_id, set())
+    batch = TransformedBatch()
+    metadata = {}
+    key_indices: Dict[Tuple[str, Optional[str]], int] = {}
+    rows = []
+    skeletons = []
+    for resource_dict in resources:
+        resource = instantiate(resource_dict, strict=strict)
+        assert isinstance(resource, DomainResource), \
+            f"Should be DomainResource, was {resource.__class__} {resource_dict.get('id')}"
+        context = TransformerContext(resource=resource, simplify=simplify)
+        indices = []
+        values = []
+        for flattened_key, property_ in context.properties.items():
+            key = (flattened_key, contained_type(resource, flattened_key) if resource.contained else None)
+            metadata_key = (resource.resource_type, *key)
+            if metadata_key not in sent:
+                sent.add(metadata_key)
+                metadata[metadata_key] = property_.copy(update={'value': None})
+            index = key_indices.get(key)
+            if index is None:
+                index = key_indices[key] = len(key_indices)
+            indices.append(index)
+            values.append(property_.value)
+        rows.append((tuple(indices), tuple(values)))
+        skeletons.append(skeleton(resource, elements.get(resource.resource_type, EMITTER_ELEMENTS)))
+    # assign without validation
+    batch.metadata = metadata
+    batch.keys = list(key_indices)
+    batch.rows = rows
+    batch.resources = skeletons
+    batch.seconds = time.perf_counter() - start
+    return batch
+
+
+class TransformMetrics(BaseModel):
+    """Aggregate statistics of a transform, replaces per resource logging."""
+
+    processes: int = 0
+    """Number of worker processes."""
+    resources: int = 0
+    """Number of resources transformed."""
+    batches: int = 0
+    """Number of batches sent to workers."""
+    keys: int = 0
+    """Distinct (resource type, flattened key) whose metadata was returned."""
+    worker_seconds: float = 0.0
+    """Time workers spent transforming."""
+    wait_seconds: float = 0.0
+    """Time the consumer waited for workers."""
+
+    def __str__(self) -> str:
+        """Human friendly summary."""
+        return (f"processes: {self.processes} resources: {self.resources} batches: {self.batches} "
+                f"keys: {self.keys} worker: {self.worker_seconds:.3f}s wait: {self.wait_seconds:.3f}s")
+
+
+class TransformPool(object):
+    """Transform resources in worker processes, yield contexts in input order.
+
+    Resources are sent to workers as raw dictionaries, workers return keys and values.
+    Metadata is returned once per metadata key and worker, contexts are rebuilt from it. Workers also return a
+    skeleton of the FHIR resource, the elements emitters read, so resources are marshalled once.
+    """
+
+    def __init__(self, model: Model, processes: int = DEFAULT_PROCESSES,
+                 batch_size: int = DEFAULT_TRANSFORM_BATCH_SIZE, simplify: bool = False, strict: bool = True) -> None:
+        """Configure pool.
+
+        :param model: resource type to Entity.
+        :param processes: number of worker processes.
+        :param batch_size: resources per task.
+        :param simplify: remove FHIR scaffolding.
+        :param strict: passed to fhirclient.
+        """
+        self.model = model
+        self.processes = processes
+        self.batch_size = batch_size
+        self.simplify = simplify
+        self.strict = strict
+        self.metadata: Dict[MetadataKey, Property] = {}
+        self.metrics = TransformMetrics(processes=processes)
+        self._elements = emitter_elements(model)
+
+    def _batches(self, resources: Iterable[dict]) -> Iterator[List[dict]]:
+        """Group resources into batches."""
+        batch = []
+        for resource in resources:
+            batch.append(resource)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _contexts(self, batch: TransformedBatch) -> Iterator[TransformerContext]:
+        """Rebuild contexts from a worker's keys, values and skeletons."""
+        self.metadata.update(batch.metadata)
+        self.metrics.keys = len(self.metadata)
+        self.metrics.worker_seconds += batch.seconds
+        for resource, (indices, values) in zip(batch.resources, batch.rows):
+            properties = {}
+            for index, value in zip(indices, values):
+                flattened_key, contained_type_ = batch.keys[index]
+                properties[flattened_key] = rebuild_property(
+                    self.metadata[(resource.resource_type, flattened_key, contained_type_)], value, self.simplify)
+            self.metrics.resources += 1
+            yield TransformerContext.construct(resource=resource, properties=properties, simplify=self.simplify,
+                                               entity=self.model.entities[resource.resource_type], obj={})
+
+    def transform(self, resources: Iterable[dict]) -> Iterator[TransformerContext]:
+        """Yield a context per resource, in order."""
+        from concurrent.futures import ProcessPoolExecutor
+
+        run_id = f"{os.getpid()}-{id(self)}-{time.time()}"
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            for batch in self._batches(resources):
+                pending.append(executor.submit(transform_batch, run_id, batch, self.simplify, self.strict,
+                                               self._elements))
+                self.metrics.batches += 1
+                if len(pending) < self.processes * BATCHES_PER_PROCESS:
+                    continue
+                yield from self._next(pending)
+            while pending:
+                yield from self._next(pending)
+
+    def _next(self, pending: deque) -> Iterator[TransformerContext]:
+        """Wait for the oldest batch, yield its contexts."""
+        future = pending.popleft()
+        start = time.perf_counter()
+        batch = future.result()
+        self.metrics.wait_seconds += time.perf_counter() - start
+        yield from self._contexts(batch)
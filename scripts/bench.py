@@ -0,0 +1,285 @@
+"""Micro benchmarks, run against a synthetic corpus."""
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, Iterator
+
+import click
+from tabulate import tabulate
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.WARNING)
+logger = logging.getLogger("bench")
+logger.setLevel(logging.INFO)
+
+
+def _synthetic_resources(count: int) -> Iterator[Dict]:
+    """Yield Patients, each followed by an Observation that references it."""
+    for i in range(count):
+        patient_id = f"patient-{i}"
+        yield {
+            'resourceType': 'Patient',
+            'id': patient_id,
+            'identifier': [{'system': 'https://example.org/patient', 'value': patient_id}],
+            'gender': ['male', 'female', 'other', 'unknown'][i % 4],
+            'birthDate': f"{1940 + i % 60}-01-{1 + i % 28:02d}",
+            'name': [{'family': f"Family{i}", 'given': [f"Given{i}", 'Middle']}],
+        }
+        yield {
+            'resourceType': 'Observation',
+            'id': f"observation-{i}",
+            'status': 'final',
+            'code': {'coding': [{'system': 'http://loinc.org', 'code': '8302-2', 'display': 'Body height'}]},
+            'subject': {'reference': f"Patient/{patient_id}"},
+            'valueQuantity': {'value': 150 + i % 50, 'unit': 'cm', 'system': 'http://unitsofmeasure.org', 'code': 'cm'},
+        }
+
+
+def _write_corpus(path: str, count: int) -> str:
+    """Write synthetic ndjson, return path."""
+    file_path = os.path.join(path, 'synthetic.ndjson')
+    with open(file_path, 'w') as fp:
+        for resource in _synthetic_resources(count):
+            json.dump(resource, fp)
+            fp.write('\n')
+    return file_path
+
+
+def _timed(func, repeat: int) -> float:
+    """Best of repeat, in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+@click.group()
+def cli():
+    """Micro benchmarks."""
+    pass
+
+
+@cli.command('io')
+@click.option('--count', default=50000, show_default=True, help='Number of synthetic patients (each with an observation).')
+@click.option('--repeat', default=3, show_default=True, help='Best of repeat.')
+@click.option('--instantiate', is_flag=True, default=False, show_default=True, help='Also marshall into fhirclient models.')
+def io_(count, repeat, instantiate):
+    """Compare buffered text and mmap ndjson readers."""
+    from pfb_fhir.cli import _sniff, _sniff_mmap, read_resources
+
+    with tempfile.TemporaryDirectory() as path:
+        file_path = _write_corpus(path, count)
+        size = os.path.getsize(file_path)
+        rows = []
+        for io_mode, sniff in [('buffered', _sniff), ('mmap', _sniff_mmap)]:
+            if instantiate:
+                def _run():
+                    for _ in read_resources(file_path, strict=False, io=io_mode):
+                        pass
+            else:
+                def _run():
+                    for _ in sniff(file_path):
+                        pass
+            elapsed = _timed(_run, repeat)
+            rows.append([io_mode, count * 2, f"{elapsed:.3f}", f"{size / elapsed / 1e6:.1f}", f"{count * 2 / elapsed:.0f}"])
+        print(tabulate(rows, headers=['io', 'resources', 'seconds', 'MB/s', 'resources/s']))
+
+
+def _available_codecs():
+    """Codecs whose libraries are installed."""
+    from pfb_fhir.emitter import PFB_CODECS, check_codec
+
+    available = []
+    for codec in PFB_CODECS:
+        try:
+            check_codec(codec)
+            available.append(codec)
+        except ValueError as e:
+            logger.warning(e)
+    return available
+
+
+@cli.command('codec')
+@click.option('--count', default=5000, show_default=True, help='Number of synthetic patients (each with an observation).')
+@click.option('--repeat', default=3, show_default=True, help='Best of repeat.')
+@click.option('--config_path', default='tests/fixtures/ncpi/config.yaml', show_default=True,
+              help='Model used to transform the synthetic corpus.')
+@click.option('--avro_block_size', multiple=True, type=int, default=[16000, 1024 * 1024], show_default=True,
+              help='Approximate size of avro blocks in bytes, before compression.')
+def codec(count, repeat, config_path, avro_block_size):
+    """Compare PFB size, write and read throughput per codec and block size."""
+    import fastavro
+    from pfb_fhir import initialize_model
+    from pfb_fhir.cli import process_files
+    from pfb_fhir.emitter import pfb
+
+    with tempfile.TemporaryDirectory() as path:
+        file_path = _write_corpus(path, count)
+        model = initialize_model(config_path)
+        pfb_path = os.path.join(path, 'synthetic.pfb.avro')
+        with pfb(os.path.join(path, 'output'), pfb_path, model) as pfb_:
+            for context in process_files(model, file_path, strict=False):
+                pfb_.emit(context)
+
+        # re-encode the same records, isolates the codec from the transform
+        with open(pfb_path, 'rb') as fp:
+            avro_reader = fastavro.reader(fp)
+            schema = avro_reader.writer_schema
+            records = list(avro_reader)
+
+        rows = []
+        baseline = None
+        for codec_ in _available_codecs():
+            for sync_interval in avro_block_size:
+                codec_path = os.path.join(path, f"{codec_}-{sync_interval}.avro")
+
+                def _write():
+                    with open(codec_path, 'wb') as fp_:
+                        fastavro.writer(fp_, schema, records, codec=codec_, sync_interval=sync_interval)
+
+                def _read():
+                    with open(codec_path, 'rb') as fp_:
+                        for _ in fastavro.reader(fp_):
+                            pass
+
+                write_seconds = _timed(_write, repeat)
+                read_seconds = _timed(_read, repeat)
+                size = os.path.getsize(codec_path)
+                baseline = baseline or size
+                rows.append([codec_, sync_interval, size, f"{baseline / size:.2f}",
+                             f"{len(records) / write_seconds:.0f}", f"{len(records) / read_seconds:.0f}"])
+        print(tabulate(rows, headers=['codec', 'block size', 'bytes', 'ratio', 'write records/s', 'read records/s']))
+
+
+@cli.command('batch')
+@click.option('--count', default=5000, show_default=True, help='Number of synthetic patients (each with an observation).')
+@click.option('--repeat', default=3, show_default=True, help='Best of repeat.')
+@click.option('--config_path', default='tests/fixtures/ncpi/config.yaml', show_default=True,
+              help='Model used to transform the synthetic corpus.')
+@click.option('--batch_size', default=10000, show_default=True, help='Resources per batch.')
+def batch(count, repeat, config_path, batch_size):
+    """Compare row wise and columnar batch transforms of homogeneous resources."""
+    from pfb_fhir import initialize_model
+    from pfb_fhir.batch import iter_batches
+    from pfb_fhir.resources import instantiate
+    from pfb_fhir.model import TransformerContext
+
+    model = initialize_model(config_path)
+    # homogeneous, as in a per resource type ndjson export
+    resources = sorted(_synthetic_resources(count), key=lambda resource: resource['resourceType'])
+
+    def _row_wise():
+        for resource in resources:
+            TransformerContext(resource=instantiate(resource, strict=False),
+                               entity=model.entities[resource['resourceType']])
+
+    def _batch():
+        for _ in iter_batches(model, resources, batch_size=batch_size):
+            pass
+
+    rows = []
+    for name, func in [('row', _row_wise), ('batch', _batch)]:
+        elapsed = _timed(func, repeat)
+        rows.append([name, len(resources), f"{elapsed:.3f}", f"{len(resources) / elapsed:.0f}"])
+    print(tabulate(rows, headers=['transform', 'resources', 'seconds', 'resources/s']))
+
+
+def _synthetic_code_system(path: str, count: int, branching: int = 4) -> str:
+    """Write a bundle with a flat subsumedBy code system and an is-a value set of its root, return path."""
+    concepts = [{'code': 'c0', 'property': []}]
+    for i in range(1, count):
+        concepts.append({'code': f"c{i}", 'property': [{'code': 'subsumedBy', 'valueCode': f"c{(i - 1) // branching}"}]})
+    bundle = {'resourceType': 'Bundle', 'entry': [
+        {'fullUrl': 'http://example.org/CodeSystem/synthetic',
+         'resource': {'resourceType': 'CodeSystem', 'id': 'synthetic', 'url': 'http://example.org/CodeSystem/synthetic',
+                      'concept': concepts}},
+        {'fullUrl': 'http://example.org/ValueSet/synthetic',
+         'resource': {'resourceType': 'ValueSet', 'id': 'synthetic', 'url': 'http://example.org/ValueSet/synthetic',
+                      'compose': {'include': [{'system': 'http://example.org/CodeSystem/synthetic',
+                                               'filter': [{'property': 'concept', 'op': 'is-a', 'value': 'c0'}]}]}}},
+    ]}
+    file_path = os.path.join(path, 'valuesets.json')
+    with open(file_path, 'w') as fp:
+        json.dump(bundle, fp)
+    return file_path
+
+
+@cli.command('terminology')
+@click.option('--repeat', default=3, show_default=True, help='Best of repeat.')
+@click.option('--count', default=10000, show_default=True, help='Concepts in the synthetic code system.')
+def terminology(repeat, count):
+    """Expand the curated value sets in terminology.yaml, and an is-a filter over a synthetic code system."""
+    from pfb_fhir.terminology.snapshot import TerminologySnapshot, build_snapshot
+    from pfb_fhir.terminology.value_sets import ValueSets, _get_config, _load
+
+    rows = []
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        _load(os.path.join(path, 'valuesets.sqlite'), _synthetic_code_system(path, count))
+        rows.append(['synthetic (load and index)', count, f"{(time.perf_counter() - start) * 1000:.1f}"])
+        cache_path = os.environ.get('PFB_FHIR_CACHE_PATH')
+        os.environ['PFB_FHIR_CACHE_PATH'] = path
+        try:
+            value_sets = ValueSets()
+        finally:
+            if cache_path is None:
+                del os.environ['PFB_FHIR_CACHE_PATH']
+            else:
+                os.environ['PFB_FHIR_CACHE_PATH'] = cache_path
+        codes = []
+        elapsed = _timed(lambda: codes.append(value_sets.codes('http://example.org/ValueSet/synthetic')), repeat)
+        rows.append(['http://example.org/ValueSet/synthetic', len(codes[-1]), f"{elapsed * 1000:.1f}"])
+        build_snapshot(value_sets, os.path.join(path, 'snapshot.sqlite'))
+        snapshot = TerminologySnapshot(os.path.join(path, 'snapshot.sqlite'))
+        elapsed = _timed(lambda: codes.append(snapshot.codes('http://example.org/ValueSet/synthetic')), repeat)
+        rows.append(['synthetic (snapshot)', len(codes[-1]), f"{elapsed * 1000:.1f}"])
+    # curated, uses (and if missing builds) the terminology cache
+    value_sets = ValueSets()
+    for valueset in _get_config()['valuesets']:
+        codes = []
+        elapsed = _timed(lambda: codes.append(value_sets.codes(valueset['fullUrl'])), repeat)
+        rows.append([valueset['fullUrl'], len(codes[-1] or []), f"{elapsed * 1000:.1f}"])
+    print(tabulate(rows, headers=['value set', 'codes', 'ms']))
+
+
+def _import_times(module: str) -> Dict[str, int]:
+    """Cumulative import time per module in microseconds, from `python -X importtime`."""
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+                               stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+@cli.command('importtime')
+@click.option('--module', default='pfb_fhir.cli', show_default=True, help='Module to import.')
+@click.option('--repeat', default=5, show_default=True, help='Best of repeat, each in a fresh interpreter.')
+@click.option('--top', default=10, show_default=True, help='Show the slowest imports.')
+@click.option('--budget', default=None, type=float, help='Fail if the import takes longer, in milliseconds.')
+def importtime(module, repeat, top, budget):
+    """Measure cold-start import time of the CLI."""
+    best = None
+    for _ in range(repeat):
+        times = _import_times(module)
+        if best is None or times[module] < best[module]:
+            best = times
+    rows = sorted(best.items(), key=lambda item: item[1], reverse=True)[:top]
+    print(tabulate([[name, f"{cumulative / 1000:.1f}"] for name, cumulative in rows], headers=['module', 'ms']))
+    total = best[module] / 1000
+    if budget is not None and total > budget:
+        logger.error(f"import {module} took {total:.1f}ms, budget {budget:.1f}ms")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
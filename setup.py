@@ -108,6 +108,13 @@ setup(
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=requirements,
 
+    # Optional dependencies, e.g. `pip install pfb_fhir[parquet]`
+    extras_require={
+        'parquet': ['pyarrow'],
+        'snappy': ['python-snappy'],
+        'zstandard': ['zstandard'],
+    },
+
     # If there are data files included in your packages that need to be
     # installed, specify them here.
     #
@@ -27,8 +27,17 @@ def cleanup_emitter(output_path, pfb_path):
         os.remove(path)
         logger.debug(f"Removed {path}")
 
+    for path in glob.glob(f"{output_path}/parquet/*/*.parquet") + glob.glob(f"{output_path}/parquet/*/_common_metadata"):
+        os.remove(path)
+        logger.debug(f"Removed {path}")
+    for path in glob.glob(f"{output_path}/parquet/*"):
+        os.rmdir(path)
+
     os.remove(pfb_path)
     logger.debug(f"Removed {pfb_path}")
+    for path in glob.glob(f"{pfb_path}.summary.json") + glob.glob(f"{pfb_path}.png"):
+        os.remove(path)
+        logger.debug(f"Removed {path}")
 
     dump_path = f"{output_path}/dump-ordered.json"
     if os.path.isfile(dump_path):
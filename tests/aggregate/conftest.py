@@ -0,0 +1,20 @@
+"""Test fixtures."""
+from _pytest.fixtures import fixture
+
+
+@fixture
+def config_path():
+    """Fixture our config."""
+    return 'tests/fixtures/anvil/config.yaml'
+
+
+@fixture
+def input_path():
+    """Fixture where to read data."""
+    return 'tests/fixtures/anvil/fhir/public/Public/1000G-high-coverage-2019/public/*.ndjson'
+
+
+@fixture
+def output_path():
+    """Fixture where to write data."""
+    return 'tests/fixtures/anvil/output/aggregate'
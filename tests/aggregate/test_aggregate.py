@@ -0,0 +1,44 @@
+"""Test aggregate."""
+import os
+import shutil
+
+from pfb_fhir import initialize_model
+from pfb_fhir.aggregate import aggregate, scan_file, from_results
+from pfb_fhir.cli import process_files
+from pfb_fhir.emitter import pfb
+from pfb_fhir.inspector import summary_path
+
+
+def test_aggregate(config_path, input_path, output_path):
+    """Summaries come from the sidecar, the cache, or a scan of changed files."""
+    model = initialize_model(config_path)
+    first_pfb = f"{output_path}/first.pfb.avro"
+    with pfb(f"{output_path}/work", first_pfb, model) as pfb_:
+        for context in process_files(model, input_path):
+            pfb_.emit(context)
+    second_pfb = f"{output_path}/second.pfb.avro"
+    shutil.copy(first_pfb, second_pfb)
+
+    # sidecar and scan agree
+    assert scan_file(first_pfb).dict() == from_results(first_pfb, pfb_.results).dict()
+
+    table_path = f"{output_path}/network_table.tsv"
+    cache_path = f"{output_path}/aggregate-cache.json"
+    file_paths = [first_pfb, second_pfb]
+    metrics = aggregate(file_paths, table_path, cache_path=cache_path, processes=2)
+    assert (metrics.sidecar, metrics.cached, metrics.scanned) == (1, 0, 1)
+    with open(table_path) as fp:
+        lines = fp.read().splitlines()
+    assert lines[0] == "source\ttarget\tsource_count\tedge_count"
+    assert "Observation\tResearchStudy\t2\t2" in lines
+
+    metrics = aggregate(file_paths, table_path, cache_path=cache_path)
+    assert (metrics.sidecar, metrics.cached, metrics.scanned) == (1, 1, 0)
+
+    # without a sidecar, the cache is used; modified files are re-scanned
+    os.remove(summary_path(first_pfb))
+    os.utime(second_pfb, ns=(0, 0))
+    metrics = aggregate(file_paths, table_path, cache_path=cache_path)
+    assert (metrics.sidecar, metrics.cached, metrics.scanned) == (0, 1, 1)
+
+    shutil.rmtree(output_path)
@@ -3,13 +3,18 @@ import glob
 import json
 import os.path
 
+import fastavro
+import pytest
 import yaml
 
 from pfb_fhir import initialize_model
 from pfb_fhir.cli import process_files
 from pfb_fhir.emitter import pfb
+from pfb_fhir.inspector import inspect_pfb, block_offsets, load_results, read_summary, summary_path, \
+    summarize_chunk, KEY_DIGEST_SIZE
 import logging
 
+from pfb_fhir.shard import manifest_path
 from tests import cleanup_emitter
 
 logger = logging.getLogger(__name__)
@@ -20,13 +25,16 @@ def test_research_study(config_path, data_path, output_path):
     model = initialize_model(config_path)
     my_pfb = f"{output_path}/my.pfb.avro"
 
-    with pfb(output_path, my_pfb, model) as pfb_:
+    with pfb(output_path, my_pfb, model, write_schemas=True) as pfb_:
         for context in process_files(model, f"{data_path}/public/ResearchStudy.ndjson"):
             pfb_.emit(context)
             assert os.path.isdir(output_path), f"{output_path} must exist"
             for emitter in pfb_.emitters:
                 assert os.path.isdir(emitter.work_dir), f"{type(emitter)} {emitter.work_dir} must exist"
-                assert len(glob.glob(f"{emitter.work_dir}/ResearchStudy.*")) > 0, f"{type(emitter)} {emitter.work_dir}/ResearchStudy.* must exist"
+
+    # schemas are rendered on close
+    for emitter in pfb_.emitters:
+        assert len(glob.glob(f"{emitter.work_dir}/ResearchStudy.*")) > 0, f"{type(emitter)} {emitter.work_dir}/ResearchStudy.* must exist"
 
     cleanup_emitter(output_path, my_pfb)
 
@@ -37,7 +45,7 @@ def test_public_resources(config_path, data_path, output_path):
     my_pfb = f"{output_path}/my.pfb.avro"
     schema_work_dir = f"{output_path}/gen3"
 
-    with pfb(output_path, my_pfb, model) as pfb_:
+    with pfb(output_path, my_pfb, model, write_schemas=True) as pfb_:
         for context in process_files(model, f"{data_path}/public/*.ndjson"):
             pfb_.emit(context)
     for path in glob.glob(f"{schema_work_dir}/*.yaml"):
@@ -55,7 +63,7 @@ def test_protected_resources(config_path, data_path, output_path):
     my_pfb = f"{output_path}/my.pfb.avro"
     schema_work_dir = f"{output_path}/gen3"
 
-    with pfb(output_path, my_pfb, model) as pfb_:
+    with pfb(output_path, my_pfb, model, write_schemas=True) as pfb_:
         for context in process_files(model, f"{data_path}/protected/*.ndjson"):
             pfb_.emit(context)
     for path in glob.glob(f"{schema_work_dir}/*.yaml"):
@@ -73,7 +81,7 @@ def test_research_study_observation(config_path, data_path, output_path):
     my_pfb = f"{output_path}/my.pfb.avro"
     schema_work_dir = f"{output_path}/gen3"
 
-    with pfb(output_path, my_pfb, model) as pfb_:
+    with pfb(output_path, my_pfb, model, write_schemas=True) as pfb_:
         for context in process_files(model, f"{data_path}/public/ResearchStudyObservationSummary.ndjson"):
             pfb_.emit(context)
             assert os.path.isdir(output_path), f"{output_path} must exist"
@@ -90,6 +98,81 @@ def test_research_study_observation(config_path, data_path, output_path):
     cleanup_emitter(output_path, my_pfb)
 
 
+def test_dictionary_has_all_properties(config_path, data_path, output_path, observation_expected_properties):
+    """Every property observed, not just the first resource's, should be in the schema."""
+    model = initialize_model(config_path)
+    my_pfb = f"{output_path}/my.pfb.avro"
+
+    with pfb(output_path, my_pfb, model, write_schemas=True) as pfb_:
+        for context in process_files(model, f"{data_path}/public/*.ndjson"):
+            pfb_.emit(context)
+
+    schema = yaml.safe_load(open(f"{output_path}/gen3/Observation.yaml"))
+    expected = set(k.replace('.', '_') for k in observation_expected_properties)
+    assert expected <= set(schema['properties'])
+
+    cleanup_emitter(output_path, my_pfb)
+
+
+def test_parquet(config_path, data_path, output_path):
+    """Write a parquet dataset per entity."""
+    pq = pytest.importorskip("pyarrow.parquet")
+    model = initialize_model(config_path)
+    my_pfb = f"{output_path}/my.pfb.avro"
+
+    with pfb(output_path, my_pfb, model, parquet=True, row_group_size=2) as pfb_:
+        for context in process_files(model, f"{data_path}/public/*.ndjson"):
+            pfb_.emit(context)
+
+    for entity_id in ['Observation', 'Organization', 'ResearchStudy']:
+        dataset_path = f"{output_path}/parquet/{entity_id}"
+        assert glob.glob(f"{dataset_path}/*.parquet") == [f"{dataset_path}/part-00000.parquet"]
+        assert not glob.glob(f"{dataset_path}/.segment-*"), "segments should be removed"
+        with open(f"{output_path}/pfb/{entity_id}.ndjson") as fp:
+            records = [json.loads(line) for line in fp]
+        # read as a dataset, every row group conforms to the common schema
+        table = pq.read_table(dataset_path)
+        assert table.num_rows == len(records)
+        assert 'submitter_id' in table.column_names
+        assert set(table.column('id').to_pylist()) == set(record['id'] for record in records)
+        common_schema = pq.read_schema(f"{dataset_path}/_common_metadata")
+        assert table.schema.remove_metadata() == common_schema.remove_metadata()
+        metadata = pq.ParquetFile(f"{dataset_path}/part-00000.parquet").metadata
+        assert [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)][:-1] == \
+               [2] * (metadata.num_row_groups - 1)
+
+    cleanup_emitter(output_path, my_pfb)
+
+
+def test_parquet_widened_column(config_path, tmp_path):
+    """A column typed integer by early rows, number by later ones, should be readable as one type."""
+    pq = pytest.importorskip("pyarrow.parquet")
+    pandas = pytest.importorskip("pandas")
+    from pfb_fhir.resources import instantiate
+    from pfb_fhir.emitter import ParquetEmitter
+    from pfb_fhir.model import SchemaAccumulator, TransformerContext
+
+    model = initialize_model(config_path)
+    schemas = SchemaAccumulator()
+    emitter = ParquetEmitter(work_dir=str(tmp_path), schemas=schemas, row_group_size=1)
+    for id_, value in [('o1', 5), ('o2', 5.5), ('o3', 'not-a-number')]:
+        observation = {'resourceType': 'Observation', 'id': id_, 'status': 'final',
+                       'code': {'text': 'test'}, 'valueQuantity': {'value': value}}
+        if isinstance(value, str):
+            observation['valueString'] = observation.pop('valueQuantity')['value']
+        context = TransformerContext(resource=instantiate(observation, strict=False),
+                                     entity=model.entities['Observation'])
+        schemas.observe(context)
+        emitter.emit(context)
+    emitter.close()
+
+    dataset_path = tmp_path / 'parquet' / 'Observation'
+    table = pq.read_table(str(dataset_path))
+    assert table.column('valueQuantity_value').to_pylist() == [5.0, 5.5, None]
+    assert str(table.schema.field('valueQuantity_value').type) == 'double'
+    assert pandas.read_parquet(str(dataset_path))['id'].tolist() == ['o1', 'o2', 'o3']
+
+
 def _assert_aggregated_schema(expected_keys, aggregated_schema_path):
     """Check the schema for entity keys and property names."""
     assert os.path.isfile(aggregated_schema_path), f"{aggregated_schema_path} must exist"
@@ -139,3 +222,141 @@ def _is_gen3_fixture(path_):
         if gen3_fixture in path_:
             return True
     return False
+
+
+def test_parallel_inspection(config_path, data_path, output_path):
+    """Parallel block decoding should match a serial scan."""
+    model = initialize_model(config_path)
+    my_pfb = f"{output_path}/my.pfb.avro"
+
+    with pfb(output_path, my_pfb, model) as pfb_:
+        for context in process_files(model, f"{data_path}/protected/*.ndjson"):
+            pfb_.emit(context)
+
+    header_size, offsets = block_offsets(my_pfb)
+    assert len(offsets) > 1, "Expected more than one avro block"
+    assert offsets[0][0] == header_size
+    assert offsets[-1][1] == os.path.getsize(my_pfb)
+
+    serial = inspect_pfb(my_pfb, processes=1)
+    parallel = inspect_pfb(my_pfb, processes=2)
+    assert serial.dict() == parallel.dict()
+
+    # workers send back counts and digests, not ids
+    chunk = summarize_chunk(my_pfb, header_size, offsets[0][0], offsets[-1][1])
+    assert len(chunk.keys) == len(chunk.ids) == chunk.record_count * KEY_DIGEST_SIZE
+    assert sum(chunk.counts.values()) == chunk.record_count
+    assert all(len(link[0]) == KEY_DIGEST_SIZE for link in chunk.links)
+
+    cleanup_emitter(output_path, my_pfb)
+
+
+def test_summary_sidecar(config_path, data_path, output_path):
+    """Summary gathered while writing should match a scan, and be ignored once stale."""
+    model = initialize_model(config_path)
+    my_pfb = f"{output_path}/my.pfb.avro"
+
+    with pfb(output_path, my_pfb, model) as pfb_:
+        for context in process_files(model, f"{data_path}/public/*.ndjson"):
+            pfb_.emit(context)
+
+    assert os.path.isfile(summary_path(my_pfb))
+    summary = read_summary(my_pfb, verify=True)
+    assert summary == pfb_.results
+    assert summary.dict() == inspect_pfb(my_pfb).dict()
+
+    # touch the pfb, sidecar is stale
+    os.utime(my_pfb, ns=(0, 0))
+    assert read_summary(my_pfb) is None
+    assert load_results(my_pfb).dict() == summary.dict()
+    assert read_summary(my_pfb) is not None, "sidecar should be refreshed by a scan"
+
+    cleanup_emitter(output_path, my_pfb)
+
+
+@pytest.mark.parametrize("codec", ["null", "deflate"])
+def test_codec(config_path, data_path, output_path, codec):
+    """PFB written with codec and small blocks should read back the same."""
+    model = initialize_model(config_path)
+    my_pfb = f"{output_path}/my.pfb.avro"
+
+    with pfb(output_path, my_pfb, model, codec=codec, sync_interval=1024) as pfb_:
+        for context in process_files(model, f"{data_path}/public/*.ndjson"):
+            pfb_.emit(context)
+
+    with open(my_pfb, 'rb') as fp:
+        avro_reader = fastavro.reader(fp)
+        assert avro_reader.codec == codec
+    _, offsets = block_offsets(my_pfb)
+    assert len(offsets) > 1, "Expected small blocks"
+    assert inspect_pfb(my_pfb, processes=2).dict() == pfb_.results.dict()
+
+    cleanup_emitter(output_path, my_pfb)
+
+
+def test_unknown_codec():
+    """An unknown codec should raise ValueError, also under python -O."""
+    from pfb_fhir.emitter import check_codec
+
+    with pytest.raises(ValueError, match='Unknown codec'):
+        check_codec('lz77')
+
+
+@pytest.mark.parametrize("shard_by", ["entity", "size", "patient"])
+def test_shards(config_path, data_path, output_path, shard_by):
+    """Every link target should be in the same shard or a shard it depends on."""
+    model = initialize_model(config_path)
+    my_pfb = f"{output_path}/my.pfb.avro"
+
+    with pfb(output_path, my_pfb, model, shard_by=shard_by, shard_size=100000, shard_count=2) as pfb_:
+        for context in process_files(model, f"{data_path}/protected/*.ndjson"):
+            pfb_.emit(context)
+    assert not os.path.isfile(my_pfb), "Shards replace the PFB"
+
+    with open(manifest_path(my_pfb)) as fp:
+        manifest = json.load(fp)
+    shards = manifest['shards']
+    assert len(shards) > 1
+    assert sorted(path for level in manifest['load_order'] for path in level) == sorted(shard['path'] for shard in shards)
+
+    shard_records = []
+    for shard in shards:
+        with open(shard['path'], 'rb') as fp:
+            shard_records.append([record for record in fastavro.reader(fp) if record['name'] != 'Metadata'])
+    keys = [{(record['name'], record['id']) for record in records} for records in shard_records]
+    all_keys = set().union(*keys)
+    assert len(all_keys) == sum(shard['records'] for shard in shards)
+    assert len(all_keys) == sum(summary.count for summary in pfb_.results.counts.values()) - 1, "Excluding Metadata"
+
+    for shard, records, shard_keys in zip(shards, shard_records, keys):
+        available = set().union(shard_keys, *[keys[index] for index in shard['depends_on']])
+        for record in records:
+            for relation in record['relations']:
+                key = (relation['dst_name'], relation['dst_id'])
+                # the protected fixture references public records
+                if key in all_keys:
+                    assert key in available, (shard['path'], relation)
+        for index in shard['depends_on']:
+            assert shards[index]['level'] < shard['level']
+
+    for shard in shards:
+        os.remove(shard['path'])
+    os.remove(manifest_path(my_pfb))
+    with open(my_pfb, 'w'):
+        pass  # cleanup_emitter expects a pfb
+    cleanup_emitter(output_path, my_pfb)
+
+
+def test_validate_codes(config_path, data_path, output_path):
+    """Coded values should be checked against required bindings."""
+    model = initialize_model(config_path)
+    my_pfb = f"{output_path}/my.pfb.avro"
+
+    with pfb(output_path, my_pfb, model, validate_codes=True) as pfb_:
+        for context in process_files(model, f"{data_path}/public/*.ndjson"):
+            pfb_.emit(context)
+
+    assert "'Codes checked': 2" in pfb_.results.info, pfb_.results.info
+    assert "'Codes not in required ValueSet': 0" in pfb_.results.info, pfb_.results.info
+
+    cleanup_emitter(output_path, my_pfb)
@@ -6,7 +6,7 @@ from typing import List
 
 from pfb_fhir import initialize_model
 from pfb_fhir.cli import process_files
-from pfb_fhir.model import fhir_profile_retriever
+from pfb_fhir.model import fhir_profile_retriever, SchemaAccumulator, natural_key
 
 logger = logging.getLogger(__name__)
 
@@ -103,6 +103,29 @@ def test_model_document_reference(config_path, data_path, document_reference_exp
     assert set(resource_properties['DocumentReference']) == document_reference_expected_properties
 
 
+def test_schema_accumulator(config_path, data_path, observation_expected_properties):
+    """Schema should be the union of properties, with counts and widest types."""
+    model = initialize_model(config_path)
+    schemas = SchemaAccumulator()
+    observation_count = 0
+    for context in process_files(model, f"{data_path}/public/*.ndjson"):
+        schemas.observe(context)
+        if context.entity.id == 'Observation':
+            observation_count += 1
+
+    observation_schema = schemas.entities['Observation']
+    assert observation_schema.count == observation_count
+    assert set(observation_schema.properties) == observation_expected_properties
+    assert observation_schema.properties['id'].count == observation_count
+    assert observation_schema.null_count('id') == 0
+    assert observation_schema.properties['id'].json_type == 'string'
+    assert observation_schema.properties['component.0.valueInteger'].json_type in ['integer', 'number']
+    columns = observation_schema.columns()
+    assert set(columns) == observation_expected_properties
+    assert sorted(['component.10.valueString', 'component.2.valueString'], key=natural_key) == \
+           ['component.2.valueString', 'component.10.valueString']
+
+
 def description(property_) -> List[str]:
     """Concatenates descriptions (utility)."""
     descriptions = [property_.root_element['short']]
@@ -0,0 +1,19 @@
+"""Test fixtures."""
+from _pytest.fixtures import fixture
+
+ANVIL_FIXTURES = 'tests/fixtures/anvil'
+
+
+@fixture
+def config_path():
+    """Fixture our config."""
+    return f'{ANVIL_FIXTURES}/config.yaml'
+
+
+@fixture
+def resource_paths():
+    """Fixture of homogeneous ndjson."""
+    return [
+        f'{ANVIL_FIXTURES}/fhir/public/Public/1000G-high-coverage-2019/protected/Patient.ndjson',
+        f'{ANVIL_FIXTURES}/fhir/public/Public/1000G-high-coverage-2019/protected/Specimen.ndjson',
+    ]
@@ -0,0 +1,77 @@
+"""Test columnar batch transform."""
+import json
+from itertools import islice
+
+import pytest
+
+from pfb_fhir import initialize_model
+from pfb_fhir.batch import iter_batches, BatchTransformer
+from pfb_fhir.resources import instantiate
+from pfb_fhir.emitter import ParquetEmitter
+from pfb_fhir.model import TransformerContext, SchemaAccumulator
+
+
+def _resources(resource_paths, count=200):
+    """First count resources of each file."""
+    for resource_path in resource_paths:
+        with open(resource_path) as fp:
+            for line in islice(fp, count):
+                yield json.loads(line)
+
+
+def test_batch_properties(config_path, resource_paths):
+    """Row wise view of a batch is the same as the row wise transform."""
+    model = initialize_model(config_path)
+    resources = list(_resources(resource_paths))
+    batches = list(iter_batches(model, resources, batch_size=150))
+    assert [batch.resource_type for batch in batches] == ['Patient', 'Patient', 'Specimen', 'Specimen']
+    index = 0
+    for batch in batches:
+        for row in range(len(batch)):
+            resource = resources[index]
+            context = TransformerContext(resource=instantiate(resource, strict=False),
+                                         entity=model.entities[resource['resourceType']])
+            assert batch.properties(row) == context.properties
+            index += 1
+    assert index == len(resources)
+
+
+def test_batch_resolves_metadata_once(config_path, resource_paths):
+    """Homogeneous resources are only marshalled when they introduce new keys."""
+    model = initialize_model(config_path)
+    transformer = BatchTransformer(model.entities['Patient'])
+    batch = transformer.transform(list(_resources(resource_paths[:1])))
+    assert len(batch) == 200
+    assert transformer.resolved < 10
+    assert batch.columns['id'].dtype == object
+    assert 'resourceType' in batch.columns
+
+
+def test_batch_parquet(config_path, resource_paths, tmp_path):
+    """Batch and row wise parquet datasets have the same content."""
+    pq = pytest.importorskip("pyarrow.parquet")
+    model = initialize_model(config_path)
+    resources = list(_resources(resource_paths))
+
+    batch_schemas = SchemaAccumulator()
+    batch_emitter = ParquetEmitter(work_dir=str(tmp_path / 'batch'), schemas=batch_schemas)
+    for batch in iter_batches(model, resources, batch_size=150):
+        batch_schemas.observe_batch(batch)
+        batch_emitter.emit_batch(batch)
+    batch_emitter.close()
+
+    row_schemas = SchemaAccumulator()
+    row_emitter = ParquetEmitter(work_dir=str(tmp_path / 'row'), schemas=row_schemas)
+    for resource in resources:
+        context = TransformerContext(resource=instantiate(resource, strict=False),
+                                     entity=model.entities[resource['resourceType']])
+        row_schemas.observe(context)
+        row_emitter.emit(context)
+    row_emitter.close()
+
+    for entity_id in ['Patient', 'Specimen']:
+        assert batch_schemas.entities[entity_id].count == row_schemas.entities[entity_id].count
+        batch_table = pq.read_table(str(tmp_path / 'batch' / 'parquet' / entity_id))
+        row_table = pq.read_table(str(tmp_path / 'row' / 'parquet' / entity_id))
+        assert batch_table.schema == row_table.schema
+        assert batch_table.to_pylist() == row_table.to_pylist()
@@ -0,0 +1,8 @@
+"""Test fixtures."""
+from _pytest.fixtures import fixture
+
+
+@fixture
+def heavy_modules():
+    """Modules that should only be imported by the commands that need them."""
+    return ['matplotlib', 'networkx', 'fastavro', 'dictionaryutils', 'pkg_resources', 'requests']
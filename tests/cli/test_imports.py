@@ -0,0 +1,12 @@
+"""Test cli imports."""
+import json
+import subprocess
+import sys
+
+
+def test_lazy_imports(heavy_modules):
+    """Importing the cli should not pull in heavy dependencies."""
+    script = f"import json, sys, pfb_fhir.cli; print(json.dumps([m for m in {heavy_modules!r} if m in sys.modules]))"
+    completed = subprocess.run([sys.executable, '-c', script], stdout=subprocess.PIPE, universal_newlines=True,
+                               check=True)
+    assert json.loads(completed.stdout.strip().splitlines()[-1]) == []
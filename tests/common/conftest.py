@@ -0,0 +1,10 @@
+"""Test fixtures."""
+import logging
+
+from _pytest.fixtures import fixture
+
+
+@fixture
+def warning_logger():
+    """Logger passed to the aggregator."""
+    return logging.getLogger('test_warnings')
@@ -0,0 +1,26 @@
+"""Test warning aggregation."""
+from pfb_fhir.common import WarningAggregator
+
+
+def test_warning_counts(warning_logger, caplog):
+    """Warnings are counted per template, logged at powers of ten."""
+    warnings = WarningAggregator(max_exemplars=2)
+    logged = [warnings.warn(warning_logger, 'link', "Could not find {key} in {id}", key='subject', id=i)
+              for i in range(1000)]
+    assert [i for i, logged_ in enumerate(logged) if logged_] == [0, 9, 99, 999]
+    assert len(caplog.records) == 4
+    assert caplog.records[-1].message == "Could not find subject in 999 (seen 1000 times)"
+    summary, = warnings.summary()
+    assert summary.count == 1000
+    assert list(summary.exemplars) == ["Could not find subject in 998", "Could not find subject in 999"]
+
+
+def test_warning_bounds(warning_logger):
+    """Least recently seen templates are dropped."""
+    warnings = WarningAggregator(max_warnings=2)
+    for template in ['a', 'b', 'a', 'c']:
+        warnings.warn(warning_logger, 'test', template)
+    assert [summary.template for summary in warnings.summary()] == ['a', 'c']
+    assert warnings.dropped == 1
+    warnings.clear()
+    assert warnings.summary() == []
@@ -0,0 +1,34 @@
+"""Test fixtures."""
+from _pytest.fixtures import fixture
+
+ANVIL_DATA = 'tests/fixtures/anvil/fhir/public/Public/1000G-high-coverage-2019'
+
+
+@fixture
+def config_path():
+    """Fixture our config."""
+    return 'tests/fixtures/anvil/config.yaml'
+
+
+@fixture
+def public_path():
+    """Fixture public resources."""
+    return f'{ANVIL_DATA}/public/*.ndjson'
+
+
+@fixture
+def patient_path():
+    """Fixture patients."""
+    return f'{ANVIL_DATA}/protected/Patient.ndjson'
+
+
+@fixture
+def specimen_paths():
+    """Fixture resources that reference patients."""
+    return [f'{ANVIL_DATA}/protected/ResearchSubject.ndjson', f'{ANVIL_DATA}/protected/Specimen.ndjson']
+
+
+@fixture
+def output_path():
+    """Fixture where to write data."""
+    return 'tests/fixtures/anvil/output/merge'
@@ -0,0 +1,86 @@
+"""Test merge."""
+import shutil
+
+import fastavro
+import pytest
+
+from pfb_fhir import initialize_model
+from pfb_fhir.cli import process_files
+from pfb_fhir.emitter import pfb
+from pfb_fhir.inspector import inspect_pfb, InspectionAccumulator, KEY_DIGEST_SIZE
+from pfb_fhir.merge import merge_order, merge_pfbs, merge_schemas
+
+
+def _transform(config_path, input_path, output_path, name):
+    """Create a PFB, return path and results."""
+    model = initialize_model(config_path)
+    pfb_path = f"{output_path}/{name}.pfb.avro"
+    with pfb(f"{output_path}/{name}", pfb_path, model) as pfb_:
+        for context in process_files(model, input_path):
+            pfb_.emit(context)
+    return pfb_path, pfb_.results
+
+
+def test_merge_order():
+    """New names follow their predecessor."""
+    assert merge_order([['a', 'c'], ['a', 'b', 'c', 'd'], ['x', 'c']]) == ['x', 'a', 'b', 'c', 'd']
+
+
+def test_merge(config_path, public_path, patient_path, specimen_paths, output_path):
+    """Merged PFB resolves links across inputs and has no duplicates."""
+    public_pfb, public_results = _transform(config_path, public_path, output_path, 'public')
+    patient_pfb, patient_results = _transform(config_path, patient_path, output_path, 'patient')
+    specimen_pfb, specimen_results = _transform(config_path, specimen_paths, output_path, 'specimen')
+    assert specimen_results.counts['Specimen'].relationships['Patient'].dangling > 0
+
+    merged_pfb = f"{output_path}/merged.pfb.avro"
+    # public twice, duplicates are skipped
+    results = merge_pfbs([public_pfb, patient_pfb, specimen_pfb, public_pfb], merged_pfb, output_path)
+
+    # links to patients now resolve
+    assert results.counts['Specimen'].relationships['Patient'].dangling == 0
+    assert results.counts['ResearchSubject'].relationships['Patient'].dangling == 0
+    assert not [error for error in results.errors if error.startswith('Duplicate')]
+    assert "'Duplicates skipped': " + str(sum(summary.count for summary in public_results.counts.values()) - 1) \
+        in results.info
+    for inputs in [public_results, patient_results, specimen_results]:
+        for name, summary in inputs.counts.items():
+            if name != 'Metadata':
+                assert results.counts[name].count == summary.count, name
+    scanned = inspect_pfb(merged_pfb)
+    assert scanned.counts == results.counts
+    assert scanned.errors == results.errors
+
+    with open(merged_pfb, 'rb') as fp:
+        entities = [entity['name'] for entity in fastavro.reader(fp).writer_schema['fields'][2]['type']]
+    assert entities.index('Patient') < entities.index('Specimen')
+
+    shutil.rmtree(output_path)
+
+
+def test_conflicting_types():
+    """A field typed differently in two PFBs can't be merged."""
+
+    def _schema(type_):
+        return {'type': 'record', 'name': 'Entity', 'fields': [
+            {'name': 'object', 'type': [{'type': 'record', 'name': 'Metadata', 'fields': []},
+                                        {'type': 'record', 'name': 'Patient', 'fields': [{'name': 'age', 'type': type_}]}]}
+        ]}
+
+    metadata = {'nodes': [], 'misc': {}}
+    assert merge_schemas([_schema(['null', 'long']), _schema(['null', 'string'])], metadata)[1] == ['Patient']
+    with pytest.raises(ValueError, match='Patient.age'):
+        merge_schemas([_schema('long'), _schema('string')], metadata)
+
+
+def test_accumulator_digests():
+    """The accumulator keeps digests, not ids."""
+    accumulator = InspectionAccumulator()
+    accumulator.observe('Metadata', None, [])
+    accumulator.observe('Patient', 'p' * 1000, [])
+    accumulator.observe('Specimen', 's1', [('Patient', 'p' * 1000), ('Patient', 'missing')])
+    accumulator.observe('Specimen', 's1', [])
+    assert all(len(digest) == KEY_DIGEST_SIZE for digest in accumulator._seen | accumulator._seen_ids)
+    results = accumulator.finish('test')
+    assert results.counts['Specimen'].relationships['Patient'].dangling == 1
+    assert results.errors[-1] == "Duplicate Specimen/s1"
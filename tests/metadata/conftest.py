@@ -0,0 +1,58 @@
+"""Test fixtures."""
+from _pytest.fixtures import fixture
+
+from pfb_fhir.model import AttributeEnum, Property
+
+
+class StaticValueSets(object):
+    """Expansions from a dict, same interface as ValueSets.codes."""
+
+    def __init__(self, expansions):
+        """Url to codes."""
+        self.expansions = expansions
+        self.lookups = 0
+
+    def codes(self, url):
+        """Codes of url."""
+        self.lookups += 1
+        return self.expansions.get(url)
+
+
+@fixture
+def value_sets():
+    """Fixture of expansions."""
+    return StaticValueSets({'http://hl7.org/fhir/ValueSet/example': ['a', 'b']})
+
+
+@fixture
+def gender():
+    """Fixture of a property enumerated by the FHIR class."""
+    return Property(flattened_key='gender', docstring='male | female', name='gender', jsname='gender', typ='str',
+                    is_list=False, of_many=None, not_optional=False, value=None,
+                    enum=AttributeEnum(url='http://hl7.org/fhir/ValueSet/administrative-gender',
+                                       restricted_to=['male', 'female', 'other', 'unknown'],
+                                       binding_strength='required', class_name='AdministrativeGender'))
+
+
+@fixture
+def example_codes():
+    """Fixture of properties bound to a Value set the FHIR class doesn't enumerate."""
+    return [
+        Property(flattened_key=f'code.coding.{i}.code', docstring='Symbol', name='code', jsname='code', typ='str',
+                 is_list=False, of_many=None, not_optional=False, value=None,
+                 enum=AttributeEnum(url='http://hl7.org/fhir/ValueSet/example', restricted_to=[],
+                                    binding_strength='example', class_name='Example'))
+        for i in range(3)
+    ]
+
+
+@fixture
+def statuses():
+    """Fixture of records with a required binding, some values not in the Value set."""
+    enum = AttributeEnum(url='http://hl7.org/fhir/task-status', restricted_to=['requested', 'completed'],
+                         binding_strength='required', class_name='TaskStatus')
+    return [
+        {'status': Property(flattened_key='status', docstring='status', name='status', jsname='status', typ='str',
+                            is_list=False, of_many=None, not_optional=True, value=value, enum=enum)}
+        for value in ['completed', 'done', 'requested', 'done', 'finished']
+    ]
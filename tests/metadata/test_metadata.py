@@ -0,0 +1,71 @@
+"""Test dictionary metadata compiler."""
+import pytest
+
+from pfb_fhir.metadata import MetadataCompiler, CodeValidator, TermMetadata, MAX_DESCRIPTION_CODES, normalize_type
+from pfb_fhir.model import InspectionResults
+
+
+def test_normalize_type():
+    """FHIR type codes and python class names map to json types."""
+    assert normalize_type('dateTime') == 'string'
+    assert normalize_type('int') == 'number'
+    assert normalize_type('bool') == 'boolean'
+    assert normalize_type('http://hl7.org/fhirpath/System.Decimal') == 'decimal'
+    assert normalize_type('Unknown') == 'string'
+
+
+def test_compile_property(gender, value_sets):
+    """Codes from the FHIR class, metadata is frozen."""
+    metadata = MetadataCompiler(value_sets).compile_property(gender)
+    assert metadata.json_type == 'string'
+    assert metadata.description == 'male | female. http://hl7.org/fhir/ValueSet/administrative-gender'
+    assert metadata.term.codes == ('male', 'female', 'other', 'unknown')
+    assert metadata.term.constrained
+    assert dict(metadata.term.term_def)['strength'] == 'required'
+    assert value_sets.lookups == 0
+    with pytest.raises(TypeError):
+        metadata.description = 'changed'
+
+
+def test_value_set_expansion(example_codes, value_sets):
+    """The dictionary renders the FHIR class's codes, ValueSets are expanded for validation, once per url."""
+    compiler = MetadataCompiler(value_sets)
+    terms = [compiler.compile_property(property_).term for property_ in example_codes]
+    assert all(term == terms[0] for term in terms)
+    assert terms[0].codes == ()
+    assert not terms[0].constrained
+    assert value_sets.lookups == 0
+    assert [compiler.expansion(property_.enum) for property_ in example_codes] == [('a', 'b')] * 3
+    assert CodeValidator(compiler).members(example_codes[0].enum) == frozenset(['a', 'b'])
+    assert value_sets.lookups == 1
+
+
+def test_code_list(gender):
+    """Codes appended to a description are capped."""
+    term = MetadataCompiler().term(gender.enum)
+    assert term.code_list == 'male|female|other|unknown'
+    term = TermMetadata(url=term.url, term_def=term.term_def, codes=tuple(map(str, range(MAX_DESCRIPTION_CODES + 1))))
+    assert term.code_list.split('|')[-2:] == [str(MAX_DESCRIPTION_CODES - 1), '...']
+
+
+def test_code_validator(statuses):
+    """Values not in a required binding are counted, the report is bounded."""
+    validator = CodeValidator(MetadataCompiler(), max_values=1)
+    assert [validator.check('Task', properties) for properties in statuses] == [0, 1, 0, 1, 1]
+    assert validator.checked == 5
+    violation, = validator.report()
+    assert violation.count == 3
+    assert violation.values == ['done']
+
+    results = InspectionResults()
+    validator.update_results(results)
+    assert "'Codes not in required ValueSet': 3" in results.info
+    assert results.warnings == [str(violation)]
+
+    validator = CodeValidator(MetadataCompiler(), max_violations=0)
+    for properties in statuses:
+        validator.check('Task', properties)
+    assert validator.report() == []
+    results = InspectionResults()
+    validator.update_results(results)
+    assert results.warnings == ["3 other values not in their required ValueSet."]
@@ -1,4 +1,7 @@
-from pfb_fhir import initialize_model, Model
+import shutil
+
+import pfb_fhir
+from pfb_fhir import initialize_model, load_model, Model
 
 
 def test_model(config_paths):
@@ -22,3 +25,62 @@ def test_initialize_model(config_paths):
             assert entity.id
             for link_name, link in entity.links.items():
                 assert link.id
+
+
+def test_dependency_order(config_paths):
+    """Link targets precede the entities that link to them."""
+    for config_path in config_paths:
+        model = initialize_model(config_path)
+        position = {entity_id: index for index, entity_id in enumerate(model.dependency_order)}
+        assert len(position) == len(model.dependency_order), "no duplicates"
+        for entity in model.entities.values():
+            assert entity.id in position
+            for link in entity.links.values():
+                target = model.link_target(link.targetProfile)
+                if target and target != entity.id:
+                    assert position[target] < position[entity.id], (config_path, entity.id, target)
+
+
+def test_dependency_cycle():
+    """Cycles are broken by config order."""
+    profile = 'http://hl7.org/fhir/StructureDefinition'
+    model = Model.parse_obj({'entities': {
+        'Observation': {'id': 'Observation', 'category': 'Clinical',
+                        'links': {'subject': {'id': 'subject', 'targetProfile': f'{profile}/Patient'}}},
+        'Patient': {'id': 'Patient', 'category': 'Administrative',
+                    'links': {'link': {'id': 'link', 'targetProfile': f'{profile}/Specimen'}}},
+        'Specimen': {'id': 'Specimen', 'category': 'Biospecimen',
+                     'links': {'subject': {'id': 'subject', 'targetProfile': f'{profile}/Patient'},
+                               'parent': {'id': 'parent', 'targetProfile': f'{profile}/Specimen'}}},
+        'Organization': {'id': 'Organization', 'category': 'Administrative'},
+    }})
+    # Observation is not in the Patient <-> Specimen cycle, Patient is the first entity in it
+    assert model.topological_order() == ['Organization', 'Patient', 'Observation', 'Specimen']
+
+
+def test_load_model(config_paths, tmp_path, monkeypatch):
+    """Compiled model is cached by config content."""
+    monkeypatch.setenv("PFB_FHIR_CACHE_PATH", str(tmp_path))
+    config_path = config_paths[0]
+    model = load_model(config_path)
+    compiled = list(tmp_path.glob('models/*.json'))
+    assert len(compiled) == 1
+    assert load_model(config_path).dict() == model.dict() == initialize_model(config_path).dict()
+
+    # a changed config is compiled again
+    changed_config_path = tmp_path / 'config.yaml'
+    shutil.copy(config_path, changed_config_path)
+    with open(changed_config_path, 'a') as fp:
+        fp.write('\n# changed\n')
+    load_model(str(changed_config_path))
+    assert len(list(tmp_path.glob('models/*.json'))) == 2
+
+    # so is a new release
+    monkeypatch.setattr(pfb_fhir, '_package_version', lambda: '999.0.0')
+    load_model(config_path)
+    assert len(list(tmp_path.glob('models/*.json'))) == 3
+
+    # a corrupt compiled model is ignored and rewritten
+    for compiled_path in tmp_path.glob('models/*.json'):
+        compiled_path.write_text('{"entities": 1}')
+    assert load_model(config_path).dict() == model.dict()
@@ -64,7 +64,7 @@ def test_emitter(config_path, input_ncpi_patient_paths, output_path, pfb_path):
 def test_patient_emitter(config_path, patient_input_path, output_path, pfb_path):
     """Test all patient term_def."""
     model = initialize_model(config_path)
-    with pfb(output_path, pfb_path, model) as pfb_:
+    with pfb(output_path, pfb_path, model, write_schemas=True) as pfb_:
         for context in process_files(model, patient_input_path):
             pfb_.emit(context)
     dump_path = f"{output_path}/dump-ordered.json"
@@ -0,0 +1,8 @@
+"""Test fixtures."""
+from _pytest.fixtures import fixture
+
+
+@fixture
+def item_count():
+    """Fixture number of items streamed through a pipeline."""
+    return 100
@@ -0,0 +1,81 @@
+"""Test stages connected by bounded queues."""
+import threading
+
+import pytest
+
+from pfb_fhir.pipeline import Pipeline, Stage
+
+
+def _square(item: int) -> int:
+    """Process stage, module level so it can be pickled."""
+    return item * item
+
+
+def _increment(items):
+    """Inline or thread stage."""
+    for item in items:
+        yield item + 1
+
+
+def test_order_and_metrics(item_count):
+    """Inline, thread and process stages yield in order, each stage counts its items."""
+    pipeline = Pipeline([
+        Stage('increment', _increment),
+        Stage('square', _square, mode='process', queue_size=4),
+        Stage('evens', lambda items: (item for item in items if item % 2 == 0), mode='thread', queue_size=2),
+    ])
+    assert list(pipeline.run(range(item_count))) == [(i + 1) ** 2 for i in range(item_count) if (i + 1) % 2 == 0]
+    assert [metrics.items for metrics in pipeline.metrics] == [item_count, item_count, item_count // 2]
+    assert pipeline.metrics[2].max_occupancy <= 2
+    assert all(metrics.seconds >= 0 for metrics in pipeline.metrics)
+
+
+def test_backpressure(item_count):
+    """A thread stage runs at most queue_size items ahead of its consumer, and stops when the consumer does."""
+    produced = []
+    blocked = threading.Event()
+
+    def _produce(items):
+        for item in items:
+            produced.append(item)
+            if len(produced) > 3:
+                blocked.set()
+            yield item
+
+    outputs = Pipeline([Stage('produce', _produce, mode='thread', queue_size=2)]).run(range(item_count))
+    assert next(outputs) == 0
+    blocked.wait(timeout=5)
+    # one consumed, two queued, one waiting for room
+    assert len(produced) == 4
+    outputs.close()
+    assert len(produced) < item_count
+
+
+def test_thread_error():
+    """Errors on a stage's thread are raised to the consumer."""
+    def _fail(items):
+        for item in items:
+            if item == 3:
+                raise ValueError(f"bad item {item}")
+            yield item
+
+    with pytest.raises(ValueError, match='bad item 3'):
+        list(Pipeline([Stage('fail', _fail, mode='thread'), Stage('increment', _increment)]).run(range(10)))
+
+
+def test_thread_base_exception():
+    """BaseExceptions on a stage's thread are raised to the consumer, it doesn't wait forever."""
+    def _exit(items):
+        for item in items:
+            if item == 3:
+                raise SystemExit(f"exit at {item}")
+            yield item
+
+    with pytest.raises(SystemExit, match='exit at 3'):
+        list(Pipeline([Stage('exit', _exit, mode='thread')]).run(range(10)))
+
+
+def test_thread_exception_items():
+    """Exceptions yielded as items are delivered, not raised."""
+    errors = [ValueError(i) for i in range(3)]
+    assert list(Pipeline([Stage('errors', lambda items: iter(items), mode='thread')]).run(errors)) == errors
@@ -0,0 +1,17 @@
+"""Test fixtures."""
+from _pytest.fixtures import fixture
+
+
+@fixture
+def config_path():
+    """Fixture our config."""
+    return 'tests/fixtures/anvil/config.yaml'
+
+
+@fixture
+def input_paths():
+    """Fixture where to read data."""
+    return [
+        'tests/fixtures/anvil/fhir/public/Public/1000G-high-coverage-2019/public/*.ndjson',
+        'tests/fixtures/ncpi/examples/Patient-patient-example-3.json',
+    ]
@@ -0,0 +1,49 @@
+"""Test reading files ahead of the transform."""
+import pytest
+
+from pfb_fhir import initialize_model
+from pfb_fhir.cli import process_files, _expand_paths
+from pfb_fhir.reader import read_file
+
+
+def _keys(contexts):
+    """Identify contexts."""
+    return [(context.resource.resource_type, context.resource.id) for context in contexts]
+
+
+def test_read_file(input_paths, tmp_path):
+    """Sequential reads should deliver the whole file."""
+    for file_path in _expand_paths(input_paths):
+        with open(file_path, 'rb') as fp:
+            assert read_file(file_path, block_size=1024) == fp.read()
+    empty = tmp_path / 'empty.ndjson'
+    empty.write_bytes(b'')
+    assert read_file(str(empty)) == b''
+
+
+def test_process_files_read_ahead(config_path, input_paths):
+    """Reading ahead should not change results."""
+    model = initialize_model(config_path)
+    inline = _keys(process_files(model, input_paths))
+    ahead = _keys(process_files(model, input_paths, read_ahead=2, block_size=1024))
+    assert len(inline) > 0
+    assert inline == ahead
+
+
+def test_process_files_mmap(config_path, input_paths):
+    """Memory mapped reads should not change results."""
+    model = initialize_model(config_path)
+    buffered = _keys(process_files(model, input_paths))
+    mapped = _keys(process_files(model, input_paths, io='mmap'))
+    assert len(buffered) > 0
+    assert buffered == mapped
+
+
+@pytest.mark.parametrize('read_ahead,io', [(0, 'buffered'), (0, 'mmap'), (2, 'buffered')])
+def test_not_domain_resource(config_path, tmp_path, read_ahead, io):
+    """Resources that are not DomainResources should fail with the file they were read from."""
+    model = initialize_model(config_path)
+    file_path = tmp_path / 'Binary.ndjson'
+    file_path.write_text('{"resourceType": "Binary", "id": "1", "contentType": "text/plain"}\n' * 2)
+    with pytest.raises(AssertionError, match=f"Error reading {file_path}"):
+        list(process_files(model, [str(file_path)], read_ahead=read_ahead, io=io))
@@ -0,0 +1,19 @@
+"""Test fixtures."""
+import zlib
+
+from _pytest.fixtures import fixture
+
+
+@fixture
+def shard_count():
+    """Fixture number of patient shards."""
+    return 2
+
+
+@fixture
+def patient_ids(shard_count):
+    """Fixture patient ids, the first two in one patient shard, the third in another."""
+    ids = {0: [], 1: []}
+    for i in range(100):
+        ids[zlib.crc32(f"p{i}".encode()) % shard_count].append(f"p{i}")
+    return ids[0][:2] + ids[1][:1]
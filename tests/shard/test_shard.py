@@ -0,0 +1,85 @@
+"""Test records are split into dependency closed shards."""
+import json
+
+import pytest
+
+from pfb_fhir.shard import spool_shards
+
+
+def _record(name, id_, *targets):
+    """A pfb record, linked to targets (name, id)."""
+    return {'name': name, 'id': id_, 'object': {},
+            'relations': [{'dst_name': dst_name, 'dst_id': dst_id} for dst_name, dst_id in targets]}
+
+
+def _spool(tmp_path, records, shard_by, shard_count=2):
+    """Write records, assign them to shards."""
+    record_path = tmp_path / 'records.ndjson'
+    with open(record_path, 'w') as fp:
+        for record in records:
+            fp.write(json.dumps(record) + '\n')
+    return spool_shards([str(record_path)], str(tmp_path / 'shards'), shard_by, shard_count=shard_count)
+
+
+def _assert_closed(shards):
+    """Every link target is in the same shard or a shard it depends on, loaded at a lower level."""
+    keys = []
+    for shard in shards:
+        with open(shard.spool) as fp:
+            keys.append([json.loads(line) for line in fp])
+    all_keys = {(record['name'], record['id']) for records in keys for record in records}
+    for shard, records in zip(shards, keys):
+        available = {(record['name'], record['id'])
+                     for index in [shards.index(shard)] + shard.depends_on for record in keys[index]}
+        for record in records:
+            for relation in record['relations']:
+                key = (relation['dst_name'], relation['dst_id'])
+                if key in all_keys:
+                    assert key in available, (shard, record)
+        for index in shard.depends_on:
+            assert shards[index].level < shard.level, (shard, shards[index])
+            assert index < shards.index(shard), "Shards should be in dependency order"
+
+
+def test_patient_forward_reference(tmp_path, patient_ids):
+    """A patient linked to a record not seen yet should be loaded after it."""
+    shards = _spool(tmp_path, [
+        _record('Patient', patient_ids[0], ('Organization', 'o1'), ('Organization', 'outside-the-pfb')),
+        _record('Organization', 'o1'),
+        _record('Patient', patient_ids[2], ('Organization', 'outside-the-pfb')),
+    ], 'patient')
+    _assert_closed(shards)
+    assert [shard.counts for shard in shards] == [{'Organization': 1}, {'Patient': 1}, {'Patient': 1}]
+    assert shards[-1].depends_on == [0, 1], "Patient linked forward should be in overflow"
+
+
+def test_patient_to_patient(tmp_path, patient_ids):
+    """Patients linked across patient shards should not make the shards depend on each other."""
+    shards = _spool(tmp_path, [
+        _record('Patient', patient_ids[0]),
+        _record('Patient', patient_ids[2], ('Patient', patient_ids[0])),
+        _record('Patient', patient_ids[1], ('Patient', patient_ids[2])),
+        _record('Observation', 'ob1', ('Patient', patient_ids[1])),
+    ], 'patient')
+    _assert_closed(shards)
+    assert [shard.counts for shard in shards] == [{'Patient': 1}, {'Patient': 2, 'Observation': 1}]
+
+
+def test_entity_forward_reference(tmp_path):
+    """A forward reference should order the target's shard first."""
+    shards = _spool(tmp_path, [
+        _record('Specimen', 's1', ('Patient', 'p1')),
+        _record('Patient', 'p1'),
+    ], 'entity')
+    _assert_closed(shards)
+    assert [shard.counts for shard in shards] == [{'Patient': 1}, {'Specimen': 1}]
+    assert [shard.level for shard in shards] == [0, 1]
+
+
+def test_cycle(tmp_path):
+    """Shards that depend on each other can't be loaded in order."""
+    with pytest.raises(ValueError, match='depend on each other'):
+        _spool(tmp_path, [
+            _record('Specimen', 's1', ('Patient', 'p1')),
+            _record('Patient', 'p1', ('Specimen', 's1')),
+        ], 'entity')
@@ -0,0 +1,39 @@
+"""Test the simplified schema trie."""
+from flatten_json import flatten
+
+from pfb_fhir import initialize_model
+from pfb_fhir.cli import process_files
+from pfb_fhir.model import Property, SimplifiedSchemaTrie
+
+
+def _legacy_property(flattened_key, value, schema) -> Property:
+    """Walk the resource's schema from the root."""
+    dict_ = schema
+    for flattened_key_part in flattened_key.split('|'):
+        if flattened_key_part not in dict_ and flattened_key_part.isnumeric():
+            continue
+        if flattened_key_part in dict_:
+            dict_ = dict_[flattened_key_part]
+    flattened_key = flattened_key.replace('|', '.')
+    return Property(**dict_, value=value, flattened_key=flattened_key)
+
+
+def test_list_indices_are_wildcards():
+    """Paths that differ by list index share a node, known paths don't consult the schema."""
+    schema = {'name': {'name': 'name', 'given': {'name': 'given'}}}
+    trie = SimplifiedSchemaTrie()
+    node = trie.resolve('name|0|given|0', schema)
+    assert node.schema == {'name': 'given'}
+    assert trie.misses == 2
+    assert trie.resolve('name|1|given|3', {}) is node
+    assert trie.misses == 2
+
+
+def test_same_as_legacy(config_path, input_ncpi_patient_paths, input_synthea_patient_paths):
+    """Properties match a walk of each resource's own schema."""
+    model = initialize_model(config_path)
+    trie = SimplifiedSchemaTrie()
+    for context in process_files(model, input_ncpi_patient_paths + input_synthea_patient_paths):
+        js, schema = context.resource.as_simplified_json()
+        for flattened_key, value in flatten(js, separator='|').items():
+            assert trie.property(flattened_key, value, schema) == _legacy_property(flattened_key, value, schema)
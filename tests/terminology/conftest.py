@@ -1,7 +1,28 @@
+import shutil
+
 from _pytest.fixtures import fixture
 
-from pfb_fhir.terminology.value_sets import ValueSets
+from pfb_fhir.terminology.value_sets import ValueSets, _load, DATABASE_FILE_NAME, VALUESET_FILE_NAME
 
 @fixture
 def value_sets():
     return ValueSets()
+
+
+@fixture
+def fixture_value_sets(tmp_path, monkeypatch):
+    """ValueSets loaded from a small bundle, no network."""
+    monkeypatch.setenv('PFB_FHIR_CACHE_PATH', str(tmp_path))
+    json_path = tmp_path / VALUESET_FILE_NAME
+    shutil.copy('tests/fixtures/terminology/valuesets.json', json_path)
+    _load(tmp_path / DATABASE_FILE_NAME, json_path)
+    return ValueSets()
+
+
+@fixture
+def snapshot(fixture_value_sets, tmp_path):
+    """Snapshot of the fixture bundle."""
+    from pfb_fhir.terminology.snapshot import build_snapshot, snapshot_path
+
+    build_snapshot(fixture_value_sets, snapshot_path())
+    return snapshot_path()
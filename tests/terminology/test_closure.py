@@ -0,0 +1,38 @@
+"""Test code system closure table."""
+from pfb_fhir.terminology.value_sets import _closure, _hierarchy
+
+
+def test_hierarchy():
+    """Parents from nesting and subsumedBy."""
+    concepts = [
+        {'code': 'a', 'concept': [{'code': 'a1', 'property': [{'code': 'subsumedBy', 'valueCode': 'b'}]}]},
+        {'code': 'b'},
+    ]
+    assert [(concept['code'], parents) for concept, parents in _hierarchy(concepts)] == [
+        ('a', []), ('a1', ['a', 'b']), ('b', [])
+    ]
+    assert sorted(_closure({'a': [], 'a1': ['a'], 'a1x': ['a1'], 'c': ['c']})) == [
+        ('a', 'a1'), ('a', 'a1x'), ('a1', 'a1x')
+    ]
+
+
+def test_is_a(fixture_value_sets):
+    """Descendants, in code system order, not the concept itself."""
+    assert fixture_value_sets.codes('http://example.org/fhir/ValueSet/family') == ['CHILD', 'SON', 'DAU', 'PRN', 'MTH']
+
+
+def test_is_not_a(fixture_value_sets):
+    """Every concept but the one excluded."""
+    assert fixture_value_sets.codes('http://example.org/fhir/ValueSet/not-friend') == [
+        'FAMMEMB', 'CHILD', 'SON', 'DAU', 'PRN', 'MTH'
+    ]
+
+
+def test_descendent_of(fixture_value_sets):
+    """Nested concepts, at any depth."""
+    assert fixture_value_sets.codes('http://example.org/fhir/ValueSet/nested-a') == ['a1', 'a1x', 'a2']
+
+
+def test_unfiltered(fixture_value_sets):
+    """Without a filter, top level concepts and their children, as before."""
+    assert fixture_value_sets.codes('http://example.org/fhir/ValueSet/nested') == ['a', 'b', 'a1', 'a2']
@@ -0,0 +1,69 @@
+"""Test the read-only terminology snapshot."""
+import pickle
+import sqlite3
+
+import pytest
+
+import pfb_fhir.terminology.snapshot as snapshot_module
+from pfb_fhir.terminology.snapshot import SNAPSHOT_VERSION, TerminologySnapshot, open_value_sets
+from pfb_fhir.terminology.value_sets import ValueSets
+
+URLS = ['http://example.org/fhir/ValueSet/family', 'http://example.org/fhir/ValueSet/not-friend',
+        'http://example.org/fhir/ValueSet/nested-a', 'http://example.org/fhir/ValueSet/nested']
+
+
+def test_snapshot_codes(fixture_value_sets, snapshot):
+    """Same expansions as ValueSets, versions are ignored, unknown urls are None."""
+    terminology = TerminologySnapshot(snapshot)
+    assert terminology.meta['version'] == str(SNAPSHOT_VERSION)
+    for url in URLS:
+        assert terminology.codes(url) == fixture_value_sets.codes(url), url
+    assert terminology.codes(f"{URLS[0]}|4.0.1") == fixture_value_sets.codes(URLS[0])
+    assert terminology.codes('http://example.org/fhir/ValueSet/missing') is None
+
+
+def test_snapshot_read_only(snapshot):
+    """Workers can't write to the snapshot, and can pickle it."""
+    terminology = TerminologySnapshot(snapshot)
+    with pytest.raises(sqlite3.OperationalError):
+        terminology._connection().execute("DELETE FROM expansions")
+    copy = pickle.loads(pickle.dumps(terminology))
+    assert copy.codes(URLS[0]) == terminology.codes(URLS[0])
+
+
+def test_open_value_sets(fixture_value_sets, snapshot, monkeypatch, tmp_path):
+    """Use the snapshot when present and current, otherwise ValueSets."""
+    assert isinstance(open_value_sets(), TerminologySnapshot)
+    conn = sqlite3.connect(snapshot)
+    conn.execute("UPDATE meta SET value='0' WHERE key='version'")
+    conn.commit()
+    conn.close()
+    assert isinstance(open_value_sets(), ValueSets)
+    monkeypatch.setenv('PFB_FHIR_TERMINOLOGY_PATH', str(tmp_path / 'missing.sqlite'))
+    assert isinstance(open_value_sets(), ValueSets)
+
+
+def test_stale_snapshot(fixture_value_sets, snapshot, caplog):
+    """A snapshot of an older source database is ignored, a snapshot without its source is used."""
+    assert not TerminologySnapshot(snapshot).is_stale()
+    source = sqlite3.connect(fixture_value_sets.database_file_name)
+    source.execute("DELETE FROM valuesets WHERE fullUrl=?", [URLS[0]])
+    source.commit()
+    source.close()
+    assert TerminologySnapshot(snapshot).is_stale()
+    assert isinstance(open_value_sets(), ValueSets)
+    assert 'changed since it was built' in caplog.text
+    fixture_value_sets.database_file_name.unlink()
+    assert not TerminologySnapshot(snapshot).is_stale()
+
+
+def test_verify_snapshot(fixture_value_sets, snapshot, monkeypatch):
+    """The source is hashed only when verifying, otherwise its size, modification time and inode are compared."""
+    hashed = []
+    monkeypatch.setattr(snapshot_module, '_file_hash', lambda path: hashed.append(path) or 'other')
+    assert not TerminologySnapshot(snapshot).is_stale()
+    assert isinstance(open_value_sets(), TerminologySnapshot)
+    assert hashed == []
+    assert TerminologySnapshot(snapshot).is_stale(verify=True)
+    assert isinstance(open_value_sets(verify=True), ValueSets)
+    assert len(hashed) == 2
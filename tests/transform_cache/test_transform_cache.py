@@ -0,0 +1,185 @@
+"""Test re-using the records of unchanged resources."""
+import hashlib
+import os
+import sqlite3
+from functools import partial
+
+import pytest
+
+from pfb_fhir import initialize_model
+from pfb_fhir.cli import process_files, _expand_paths, _parse_files, _transform_inline
+from pfb_fhir.emitter import pfb
+from pfb_fhir.transform_cache import TransformCache, transform_namespace
+from pfb_fhir.transform_pool import TransformPool
+
+
+def _transform(model, input_paths, work_dir, transform_cache=None, simplify=False):
+    """Write a PFB, return its records as written by the PFBJsonEmitter, and schema."""
+    with pfb(str(work_dir), str(work_dir / 'test.pfb.avro'), model) as pfb_:
+        for context in process_files(model, input_paths, simplify=simplify, transform_cache=transform_cache):
+            pfb_.emit(context)
+    records = {}
+    for file_name in sorted(os.listdir(work_dir / 'pfb')):
+        with open(work_dir / 'pfb' / file_name) as fp:
+            records[file_name] = fp.read()
+    schemas = {entity_id: [(key, p.json_type, p.metadata) for key, p in entity_schema.properties.items()]
+               for entity_id, entity_schema in pfb_.schemas.entities.items()}
+    return records, schemas
+
+
+def test_hits_same_as_transform(config_path, input_paths, tmp_path):
+    """The first run writes through, the second reads; same records and schema as without a cache."""
+    model = initialize_model(config_path)
+    expected = _transform(model, input_paths, tmp_path / 'plain')
+    namespace = transform_namespace(model, simplify=False, strict=True)
+    for run, (hits, misses) in enumerate([(0, 10), (10, 0)]):
+        with TransformCache(tmp_path / 'transform.sqlite', namespace) as transform_cache:
+            assert _transform(model, input_paths, tmp_path / str(run), transform_cache) == expected
+            assert (transform_cache.metrics.hits, transform_cache.metrics.misses) == (hits, misses), \
+                transform_cache.metrics
+            assert transform_cache.metrics.written == misses
+
+
+def test_namespace(config_path, input_paths, tmp_path):
+    """Simplified records are cached separately."""
+    model = initialize_model(config_path)
+    assert transform_namespace(model, False, True) != transform_namespace(model, True, True)
+    expected = _transform(model, input_paths, tmp_path / 'plain', simplify=True)
+    for run in range(2):
+        with TransformCache(tmp_path / 'transform.sqlite', transform_namespace(model, False, True)) as cache:
+            _transform(model, input_paths, tmp_path / f"unsimplified-{run}", cache)
+        with TransformCache(tmp_path / 'transform.sqlite', transform_namespace(model, True, True),
+                            simplify=True) as cache:
+            assert _transform(model, input_paths, tmp_path / f"simplified-{run}", cache, simplify=True) == expected
+            assert cache.metrics.hits == (0 if run == 0 else 10)
+
+
+def test_buffered_emitter(config_path, input_paths, tmp_path):
+    """Records are written back when rendered, not when the next context is read."""
+    model = initialize_model(config_path)
+    expected = _transform(model, input_paths, tmp_path / 'plain')
+    namespace = transform_namespace(model, simplify=False, strict=True)
+    with TransformCache(tmp_path / 'transform.sqlite', namespace) as transform_cache:
+        contexts = list(process_files(model, input_paths, transform_cache=transform_cache))
+        assert transform_cache.metrics.written == 0
+        with pfb(str(tmp_path / 'buffered'), str(tmp_path / 'buffered' / 'test.pfb.avro'), model) as pfb_:
+            for context in contexts:
+                pfb_.emit(context)
+        assert transform_cache.metrics.written == 10
+    with TransformCache(tmp_path / 'transform.sqlite', namespace) as transform_cache:
+        assert _transform(model, input_paths, tmp_path / 'hits', transform_cache) == expected
+        assert transform_cache.metrics.hits == 10
+
+
+def test_unrendered(config_path, input_paths, tmp_path):
+    """Records no emitter rendered are counted when the cache is closed."""
+    model = initialize_model(config_path)
+    namespace = transform_namespace(model, simplify=False, strict=True)
+    with TransformCache(tmp_path / 'transform.sqlite', namespace) as transform_cache:
+        for _ in process_files(model, input_paths, transform_cache=transform_cache):
+            pass
+    assert (transform_cache.metrics.written, transform_cache.metrics.unrendered) == (0, 10)
+
+
+def test_evict(config_path, input_paths, tmp_path):
+    """Entries of the least recently used namespaces are deleted when the cache is opened."""
+    model = initialize_model(config_path)
+    path = tmp_path / 'transform.sqlite'
+    namespaces = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(3)]
+    for namespace in namespaces:
+        with TransformCache(path, namespace, keep_namespaces=2) as transform_cache:
+            _transform(model, input_paths, tmp_path / namespace, transform_cache)
+    assert transform_cache.metrics.evicted == 1
+    conn = sqlite3.connect(path)
+    assert sorted(conn.execute("SELECT DISTINCT namespace FROM records")) == sorted((n,) for n in namespaces[1:])
+    assert conn.execute("SELECT count(*) FROM metadata WHERE namespace=?", [namespaces[0]]).fetchone() == (0,)
+    conn.close()
+    with TransformCache(path, namespaces[0], keep_namespaces=2) as transform_cache:
+        _transform(model, input_paths, tmp_path / 'again', transform_cache)
+        assert transform_cache.metrics.hits == 0
+
+
+def test_version(tmp_path):
+    """A cache written by another version is dropped."""
+    path = tmp_path / 'transform.sqlite'
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE records (key blob PRIMARY KEY, entry json NOT NULL) WITHOUT ROWID")
+    conn.execute("PRAGMA user_version=1")
+    conn.commit()
+    conn.close()
+    with TransformCache(path, hashlib.sha256(b'').hexdigest()) as transform_cache:
+        assert transform_cache.get(b'key') is None
+
+
+def test_hits_stream(config_path, input_paths, tmp_path):
+    """A hit is yielded as soon as it is looked up, before the rest of the input is read."""
+    model = initialize_model(config_path)
+    path = tmp_path / 'transform.sqlite'
+    namespace = transform_namespace(model, simplify=False, strict=True)
+    with TransformCache(path, namespace) as transform_cache:
+        _transform(model, input_paths, tmp_path / 'misses', transform_cache)
+    resource_dicts = list(_parse_files(_expand_paths(input_paths)))
+    read = []
+
+    def _read():
+        for resource_dict in resource_dicts:
+            read.append(resource_dict)
+            yield resource_dict
+
+    with TransformCache(path, namespace, queue_size=1) as transform_cache:
+        contexts = transform_cache.contexts(model, _read(), partial(_transform_inline, model))
+        assert next(contexts).obj['pfb_record']
+        assert len(read) == 1
+        assert len(list(contexts)) == len(resource_dicts) - 1
+        assert transform_cache.metrics.hits == len(resource_dicts)
+
+
+def test_hits_and_misses(config_path, input_paths, tmp_path):
+    """Hits and misses in the same run, a small handoff; same records as without a cache, in any order."""
+    model = initialize_model(config_path)
+    expected, _ = _transform(model, input_paths, tmp_path / 'plain')
+    path = tmp_path / 'transform.sqlite'
+    namespace = transform_namespace(model, simplify=False, strict=True)
+    with TransformCache(path, namespace) as transform_cache:
+        _transform(model, input_paths[::2], tmp_path / 'half', transform_cache)
+    with TransformCache(path, namespace, queue_size=1) as transform_cache:
+        records, _ = _transform(model, input_paths, tmp_path / 'mixed', transform_cache)
+        assert transform_cache.metrics.hits > 0 and transform_cache.metrics.misses > 0, transform_cache.metrics
+    assert {name: sorted(lines.splitlines()) for name, lines in records.items()} == \
+        {name: sorted(lines.splitlines()) for name, lines in expected.items()}
+
+
+def test_transform_error(config_path, input_paths, tmp_path):
+    """Errors raised by the transform thread are raised to the consumer."""
+    model = initialize_model(config_path)
+
+    def _fail(resource_dicts):
+        for _ in resource_dicts:
+            raise ValueError('bad resource')
+        yield
+
+    namespace = transform_namespace(model, simplify=False, strict=True)
+    with TransformCache(tmp_path / 'transform.sqlite', namespace) as transform_cache:
+        with pytest.raises(ValueError, match='bad resource'):
+            list(transform_cache.contexts(model, _parse_files(_expand_paths(input_paths)), _fail))
+
+
+def test_contained_metadata(config_path, tmp_path):
+    """Metadata of a contained resource's keys depends on its type, also for skeletons from workers."""
+    resources = [
+        {'resourceType': 'Patient', 'id': 'p-1', 'contained': [
+            {'resourceType': 'Specimen', 'id': 's', 'status': 'available'}]},
+        {'resourceType': 'Patient', 'id': 'p-2', 'contained': [
+            {'resourceType': 'Observation', 'id': 'o', 'status': 'final', 'code': {'text': 'code'}}]},
+    ]
+    model = initialize_model(config_path)
+    path = tmp_path / 'transform.sqlite'
+    namespace = transform_namespace(model, False, True)
+    with TransformCache(path, namespace) as transform_cache:
+        for key, context in zip([b'p-1', b'p-2'], TransformPool(model, processes=2, batch_size=1).transform(resources)):
+            context.obj['pfb_record'] = {'id': context.resource.id}
+            assert transform_cache.put(key, context)
+    with TransformCache(path, namespace) as transform_cache:
+        docstrings = [transform_cache.context(model, transform_cache.get(key)).properties['contained.0.status'].docstring
+                      for key in [b'p-1', b'p-2']]
+    assert docstrings[0] and docstrings[1] and docstrings[0] != docstrings[1]
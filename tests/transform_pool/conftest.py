@@ -0,0 +1,19 @@
+"""Test fixtures."""
+from _pytest.fixtures import fixture
+
+
+@fixture
+def config_path():
+    """Fixture our config."""
+    return 'tests/fixtures/ncpi/config.yaml'
+
+
+@fixture
+def input_paths():
+    """Fixture where to read data, several resource types."""
+    return [
+        'tests/fixtures/ncpi/examples/Patient-*.json',
+        'tests/fixtures/ncpi/examples/Specimen-*.json',
+        'tests/fixtures/ncpi/examples/Observation-family-relationship-*.json',
+        'tests/fixtures/ncpi/examples/ResearchSubject-*.json',
+    ]
@@ -0,0 +1,85 @@
+"""Test transforming in worker processes."""
+import os
+
+from pfb_fhir import initialize_model
+from pfb_fhir.cli import process_files
+from pfb_fhir.emitter import pfb
+from pfb_fhir.model import TransformerContext
+from pfb_fhir.resources import instantiate
+from pfb_fhir.transform_pool import TransformPool, transform_batch
+
+
+def _contexts(contexts):
+    """Comparable view of contexts."""
+    return [
+        (context.entity.id, context.resource.id, [property_.dict() for property_ in context.properties.values()])
+        for context in contexts
+    ]
+
+
+def test_same_as_inline(config_path, input_paths):
+    """Worker processes yield the same contexts, in the same order."""
+    model = initialize_model(config_path)
+    for simplify in [False, True]:
+        inline = _contexts(process_files(model, input_paths, simplify=simplify))
+        pooled = _contexts(process_files(model, input_paths, simplify=simplify, processes=2, batch_size=2))
+        assert len(inline) > 5
+        assert inline == pooled, simplify
+
+
+def test_metadata_sent_once(config_path):
+    """A worker returns the metadata of a key the first time it sees it."""
+    resources = [{'resourceType': 'Patient', 'id': f"p-{i}", 'gender': 'male'} for i in range(3)]
+    first = transform_batch('test', resources, False, True, {})
+    assert ('Patient', 'gender', None) in first.metadata
+    assert len(first.rows) == 3
+    assert dict(zip([first.keys[i] for i in first.rows[2][0]], first.rows[2][1]))[('id', None)] == 'p-2'
+    second = transform_batch('test', resources, False, True, {})
+    assert second.metadata == {}
+    assert [first.keys[i] for i in first.rows[0][0]] == [second.keys[i] for i in second.rows[0][0]]
+
+    pool = TransformPool(initialize_model(config_path), processes=2, batch_size=2)
+    assert [context.resource.id for context in pool.transform(resources)] == ['p-0', 'p-1', 'p-2']
+    assert pool.metrics.resources == 3 and pool.metrics.batches == 2
+
+
+def test_same_records_as_inline(config_path, input_paths, tmp_path):
+    """Emitters render the same records from the skeletons workers return."""
+    model = initialize_model(config_path)
+    records = []
+    for processes in [1, 2]:
+        work_dir = tmp_path / str(processes)
+        with pfb(str(work_dir), str(work_dir / 'test.pfb.avro'), model) as pfb_:
+            for context in process_files(model, input_paths, processes=processes, batch_size=2):
+                pfb_.emit(context)
+        records.append({file_name: (work_dir / 'pfb' / file_name).read_text()
+                        for file_name in sorted(os.listdir(work_dir / 'pfb'))})
+    assert records[0] and records[0] == records[1]
+
+
+def test_contained_metadata(config_path):
+    """Metadata of a contained resource's keys depends on its type."""
+    resources = [
+        {'resourceType': 'Patient', 'id': 'p-1', 'contained': [
+            {'resourceType': 'Specimen', 'id': 's', 'status': 'available'}]},
+        {'resourceType': 'Patient', 'id': 'p-2', 'contained': [
+            {'resourceType': 'Observation', 'id': 'o', 'status': 'final', 'code': {'text': 'code'}}]},
+    ]
+    model = initialize_model(config_path)
+    inline = [TransformerContext(resource=instantiate(resource), entity=model.entities['Patient']).properties
+              for resource in resources]
+    pool = TransformPool(model, processes=2, batch_size=1)
+    pooled = [context.properties for context in pool.transform(resources)]
+    for expected, actual in zip(inline, pooled):
+        assert expected['contained.0.status'].dict() == actual['contained.0.status'].dict()
+    assert pooled[0]['contained.0.status'].docstring != pooled[1]['contained.0.status'].docstring
+
+
+def test_skeleton(config_path):
+    """Workers return only the elements emitters read."""
+    resources = [{'resourceType': 'Patient', 'id': 'p-1', 'gender': 'male',
+                  'identifier': [{'system': 'https://example.org', 'value': 'x'}]}]
+    batch = transform_batch('test-skeleton', resources, False, True, {'Patient': ['id', 'identifier']})
+    resource = batch.resources[0]
+    assert resource.id == 'p-1' and resource.gender is None
+    assert resource.identifier[0].value == 'x' and resource.identifier[0]._owner is resource